@@ -1,9 +1,10 @@
+import multiprocessing
 import os
 import sys
 import threading
-import time
 import tkinter as tk
 import traceback
+from collections import OrderedDict
 from datetime import datetime, timezone
 from tkinter import messagebox
 
@@ -13,11 +14,65 @@ from firebase_admin import firestore
 from PIL import Image, ImageTk
 
 import config
+import services.conversations as conversations
+from services.archive import compacted
 from services.auth_service import AuthService
+from services.costs import get_meter as get_cost_meter
+from services.costs import tagged
 from services.firestore_client import get_db as get_firestore_db
-from services.firestore_client import (get_history_paginated, init_firestore,
-                                       stream_room)
-from utils.notify import notify_dm
+from services.firestore_client import get_history_paginated, init_firestore, stream_room
+from services.listeners import ListenerHub, ListenerSupervisor
+from services.message_store import get_store
+from services.presence import (
+    STATE_ACTIVE,
+    PresenceHeartbeat,
+    PresenceRoster,
+    ScopedPresenceWatcher,
+    browse_online_page,
+    cleanup_stale_presence,
+    clear_presence,
+    is_aggregated,
+    is_scoped,
+    presence_query,
+    set_presence,
+)
+from services.rooms import (
+    RoomRegistry,
+    find_legacy_dm_room,
+    load_rooms_for_user,
+    save_room,
+    scan_dm_rooms,
+)
+from services.session_snapshot import SessionSnapshot, SnapshotStore
+from services.sync_process import SyncProcess, expand_message
+from utils.events import (
+    ChannelSwitched,
+    EventBus,
+    MessagesAdded,
+    MessagesModified,
+    MessagesRemoved,
+    PresenceChanged,
+    RoomsLoaded,
+    ScrollbackTrimmed,
+    SendAcked,
+    SessionRestored,
+)
+from utils.message_window import MessageWindow
+from utils.notify import get_worker as get_notification_worker
+from utils.notify import stop_worker as stop_notification_worker
+from utils.render import OTHER_TAG, USER_TAG, build_batch, time_label
+from utils.state import (
+    ChatStore,
+    add_dms,
+    mark_read,
+    mark_unread,
+    remove_dm,
+    reset,
+    select_channel,
+    set_unread,
+    unread_count,
+)
+from utils.tasks import TaskExecutor
 
 # --- 1. КОНФИГУРАЦИЯ И ИНИЦИАЛИЗАЦИЯ ---
 
@@ -38,29 +93,55 @@ COLOR_MUTED = "#9AA6B2"  # muted / secondary text
 COLOR_USER_MSG = "#4DA6FF"  # color for user's messages
 COLOR_OTHER_MSG = "#DDDDDD"  # color for other users' messages
 COLOR_CHANNEL_INACTIVE = "transparent"  # Прозрачен цвят за неактивни бутони
+# Newest messages loaded when a room is opened
+INITIAL_HISTORY_LIMIT = 100
 
-# Initialize AuthService (pyrebase) using config
-try:
-    auth_service = AuthService(config.FIREBASE_CONFIG)
-    auth = auth_service.get_auth()
-    print("[LOG] Pyrebase Auth initialized successfully.")
-except Exception as e:
-    print(f"[CRITICAL ERROR] Pyrebase Auth failed: {e}")
-    sys.exit()
+# Set by init_app()
+auth_service = None
+auth = None
+firestore_db = None
 
-# Initialize Firestore via services wrapper
-firestore_db = init_firestore(config.KEY_JSON_PATH)
-if firestore_db is None:
-    print("[CRITICAL ERROR] Firestore initialization failed! Check key.json.")
-else:
-    print("[LOG] Firestore Client initialized successfully (DB Active).")
 
-# --- 2. GUI SETUP (CustomTkinter) ---
+def init_app():
+    """Инициализира Auth, Firestore и CustomTkinter преди първия AuthApp.
 
-ctk.set_widget_scaling(SCALING_FACTOR)
-ctk.set_window_scaling(SCALING_FACTOR)
-ctk.set_appearance_mode(APPEARANCE_MODE)
-ctk.set_default_color_theme(COLOR_THEME)
+    Only the entry points call it: a spawned sync worker re-imports the main
+    module and must not sign in, connect or exit again.
+    """
+    global auth_service, auth, firestore_db
+    if auth_service is not None:
+        return
+
+    # Initialize AuthService (pyrebase) using config
+    try:
+        auth_service = AuthService(config.FIREBASE_CONFIG)
+        auth = auth_service.get_auth()
+        print("[LOG] Pyrebase Auth initialized successfully.")
+    except Exception as e:
+        print(f"[CRITICAL ERROR] Pyrebase Auth failed: {e}")
+        sys.exit()
+
+    # Initialize Firestore via services wrapper
+    firestore_db = init_firestore(config.KEY_JSON_PATH)
+    if firestore_db is None:
+        print("[CRITICAL ERROR] Firestore initialization failed! Check key.json.")
+    else:
+        print("[LOG] Firestore Client initialized successfully (DB Active).")
+
+    # --- 2. GUI SETUP (CustomTkinter) ---
+
+    ctk.set_widget_scaling(SCALING_FACTOR)
+    ctk.set_window_scaling(SCALING_FACTOR)
+    ctk.set_appearance_mode(APPEARANCE_MODE)
+    ctk.set_default_color_theme(COLOR_THEME)
+
+
+def _not_older(timestamp, oldest):
+    """timestamp >= oldest; False when either is missing or incomparable."""
+    try:
+        return timestamp is not None and oldest is not None and timestamp >= oldest
+    except TypeError:
+        return False
 
 
 class AuthApp(ctk.CTk):
@@ -85,16 +166,69 @@ class AuthApp(ctk.CTk):
 
         self.username = None
         self._heartbeat_running = False
+        self._presence_heartbeat = None
         self._message_stop_watcher = None
         self._global_message_stop_watcher = None
         self._presence_stop_watcher = None
-        # track unread DM channels (usernames)
-        self._unread_channels = set()
-        # track displayed message ids to avoid duplicates (optimistic insert + listener)
-        self._displayed_message_ids = set()
-        self.current_channel = "lobby"
-        # dm_list съдържа активните DM стаи: {'otheruser': 'dm_admin_otheruser'}
-        self.dm_list = {}
+        # Keeps the snapshot listeners alive (health checks, resubscribe, resume)
+        self._listeners = ListenerSupervisor()
+        # One shared listener per source (room, global feed, presence)
+        self.hub = ListenerHub(self._listeners)
+        # Typed UI events; handlers run on the Tk thread
+        self.events = EventBus(post=lambda fn: self.after(0, fn))
+        self.events.subscribe(MessagesRemoved, self._on_messages_removed)
+        self.events.subscribe(MessagesModified, self._on_messages_modified)
+        self.events.subscribe(MessagesAdded, self._on_messages_added)
+        self.events.subscribe(SendAcked, self._on_send_acked)
+        self.events.subscribe(
+            PresenceChanged, lambda event: self._update_user_list_ui(event.online)
+        )
+        # Background loads; a newer channel switch supersedes older ones
+        self.tasks = TaskExecutor(dispatch=lambda fn: self.after(0, fn))
+        # Optional sync process: listeners run there, deltas are polled here
+        self._sync = SyncProcess() if config.SYNC_PROCESS else None
+        self._sync_poll_job = None
+        self._sync_scope = None
+        self._sync_online = []
+        # online users seen by the presence listener, expired client-side by TTL
+        self._presence_roster = PresenceRoster()
+        self._presence_expire_job = None
+        # scoped presence: watcher over DM partners + recent lobby senders
+        self._scoped_presence = None
+        self._lobby_senders = {}
+        # Active channel, sidebar DMs and unread markers: immutable snapshots,
+        # replaced only on the Tk thread (other threads' changes are posted)
+        self.chat_state = ChatStore(post=lambda fn: self.after(0, fn))
+        self.chat_state.subscribe(self._on_state_changed)
+        self._channel_list_job = None
+        # Rendered messages: doc id -> (start_mark, end_mark), in render order.
+        # Doubles as the dedupe index (optimistic insert + listener echo) and is
+        # bounded by the scrollback limit, so it never outgrows the view.
+        self._message_window = MessageWindow(config.CHAT_SCROLLBACK_LIMIT)
+        # Регистър на стаите: канал <-> room_id и участници в DM
+        self.rooms = RoomRegistry()
+        # Warm start: the session snapshot is painted right after login
+        self._snapshots = SnapshotStore()
+        self._snapshot_job = None
+        # channel -> newest rendered messages by doc id (what the snapshot keeps)
+        self._recent_messages = {}
+        # doc id -> message shown from the snapshot, until a server page
+        # confirms, corrects or removes it
+        self._unconfirmed = {}
+        # last roster shown in the user list (None until one is shown)
+        self._online_users = None
+        # conversation index: room_id -> unread count (None before the first
+        # snapshot), whether this login's DM rooms were announced yet and
+        # whether the index is being seeded from 'rooms'
+        self._conversation_unread = None
+        self._rooms_loaded = False
+        self._seeding_index = False
+        self._conversations_watch = None
+        # this login's MessageStore (config.MESSAGE_STORE), created on first
+        # use, and its DM stream when it is not Firestore
+        self._store = None
+        self._store_lock = threading.Lock()
+        self._direct_watch = None
 
         # Дефиниране на CTkFont обекти за избягване на грешката със скалирането при tag_config
         self.chat_font_normal = ctk.CTkFont(family="Arial", size=11)
@@ -120,6 +254,16 @@ class AuthApp(ctk.CTk):
 
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
 
+        # Restore a persisted session in the background instead of a full sign-in
+        threading.Thread(target=self._try_restore_session, daemon=True).start()
+
+        # Activity / visibility tracking for the adaptive presence heartbeat
+        self.bind_all("<Any-KeyPress>", self._on_user_activity, add="+")
+        self.bind_all("<Motion>", self._on_user_activity, add="+")
+        self.bind_all("<Button>", self._on_user_activity, add="+")
+        self.bind("<Unmap>", self._on_window_visibility, add="+")
+        self.bind("<Map>", self._on_window_visibility, add="+")
+
     # --- 3. UI BUILDERS ---
 
     def setup_login_register_ui(self):
@@ -210,6 +354,14 @@ class AuthApp(ctk.CTk):
         ctk.CTkLabel(
             user_list_frame, text="ПОТРЕБИТЕЛИ ONLINE", font=self.font_header_medium
         ).pack(pady=5)
+        ctk.CTkButton(
+            user_list_frame,
+            text="Всички онлайн…",
+            command=self._open_online_browser,
+            height=24,
+            fg_color="transparent",
+            border_width=1,
+        ).pack(fill="x", padx=5, pady=(0, 5))
         self.user_list_container = ctk.CTkScrollableFrame(
             user_list_frame, fg_color="transparent"
         )
@@ -258,9 +410,16 @@ class AuthApp(ctk.CTk):
         ).grid(row=0, column=1, pady=0)
 
         self.update_channel_list_ui()
+        if not self._firestore_messages():
+            # relay/memory backend: its DM stream replaces the global listener
+            if self._direct_watch is None:
+                threading.Thread(target=self._start_direct_stream, daemon=True).start()
         # start global message listener to detect incoming DMs for channels we're not viewing
-        if firestore_db is not None and not getattr(
-            self, "_global_message_stop_watcher", None
+        elif (
+            firestore_db is not None
+            and self._sync is None
+            and not config.CONVERSATION_INDEX
+            and not getattr(self, "_global_message_stop_watcher", None)
         ):
             try:
                 threading.Thread(
@@ -275,11 +434,14 @@ class AuthApp(ctk.CTk):
 
     def update_channel_list_ui(self):
         """Обновява списъка с канали и DM стаи."""
+        state = self.chat_state.snapshot
+        # DM partners changed or not - keep presence scope in step (cheap diff)
+        self._refresh_presence_scope()
         for widget in self.channel_scroll_frame.winfo_children():
             widget.destroy()
 
         # 1. Лоби канал
-        is_lobby_active = self.current_channel == "lobby"
+        is_lobby_active = state.current_channel == "lobby"
         lobby_color = COLOR_PRIMARY if is_lobby_active else COLOR_CHANNEL_INACTIVE
         btn = ctk.CTkButton(
             self.channel_scroll_frame,
@@ -299,28 +461,26 @@ class AuthApp(ctk.CTk):
             pass
 
         # 2. Активни DM стаи
-        if self.dm_list:
+        if state.dm_channels:
             ctk.CTkLabel(
                 self.channel_scroll_frame,
                 text="ЛИЧНИ СЪОБЩЕНИЯ",
                 font=self.font_small_bold,
             ).pack(pady=(10, 5))
-            dm_users = sorted(self.dm_list.keys(), key=str.lower)
-            for user in dm_users:
-                is_dm_active = self.current_channel == user
+            for user in state.dm_channels:
+                is_dm_active = state.current_channel == user
                 dm_color = COLOR_PRIMARY if is_dm_active else COLOR_CHANNEL_INACTIVE
+                unread = unread_count(state, user)
                 btn = ctk.CTkButton(
                     self.channel_scroll_frame,
-                    text=f"• {user}",
+                    text=f"• {user} ({unread})" if unread else f"• {user}",
                     command=lambda u=user: self.switch_channel(u),
                     anchor="w",
                     fg_color=dm_color,
                     hover_color=COLOR_PRIMARY
                     if not is_dm_active
                     else COLOR_PRIMARY_DARK,
-                    text_color=(
-                        COLOR_USER_MSG if user in self._unread_channels else COLOR_TEXT
-                    ),
+                    text_color=(COLOR_USER_MSG if user in state.unread else COLOR_TEXT),
                 )
                 btn.pack(fill="x", pady=2, padx=2)
                 try:
@@ -331,6 +491,16 @@ class AuthApp(ctk.CTk):
                 except Exception:
                     pass
 
+    def _on_state_changed(self, old, new):
+        """Store subscriber: one sidebar redraw per burst of state changes."""
+        if self._channel_list_job is None:
+            self._channel_list_job = self.after_idle(self._redraw_channel_list)
+
+    def _redraw_channel_list(self):
+        self._channel_list_job = None
+        if self.username:
+            self.update_channel_list_ui()
+
     def _on_channel_right_click(self, event, channel_name):
         """Показва контекстно меню при десен бутон върху канал/DM.
 
@@ -369,9 +539,7 @@ class AuthApp(ctk.CTk):
         if channel_name == "lobby":
             messagebox.showinfo("Инфо", "Не може да се изтрие историята на лоби.")
             return
-        room_id = self.dm_list.get(channel_name) or self.get_dm_room_id(
-            self.username, channel_name
-        )
+        room_id = self.rooms.room_for_channel(channel_name)
         # delete in background; pass channel_name so UI can refresh when done
         threading.Thread(
             target=lambda: self._delete_messages_for_room(
@@ -389,27 +557,26 @@ class AuthApp(ctk.CTk):
         if channel_name == "lobby":
             messagebox.showinfo("Инфо", "Лобито не може да бъде изтрито.")
             return
-        room_id = self.dm_list.get(channel_name) or self.get_dm_room_id(
-            self.username, channel_name
-        )
+        room_id = self.rooms.room_for_channel(channel_name)
 
         # delete messages and remove DM locally
         def _job():
             self._delete_messages_for_room(
                 room_id, notify=False, channel_name=channel_name
             )
-            # remove dm locally and update UI on main thread
-            try:
-                if channel_name in self.dm_list:
-                    del self.dm_list[channel_name]
-            except Exception:
-                pass
-            # after deleting chat, switch back to lobby and refresh UI
+            if config.CONVERSATION_INDEX:
+                try:
+                    conversations.forget(self.username, room_id)
+                except Exception as e:
+                    print(f"[WARN] Неуспешно премахване от индекса: {e}")
+            # remove dm locally; the store redraws the sidebar
+            self.rooms.remove(channel_name)
+            self.chat_state.dispatch(remove_dm, channel_name)
+            # after deleting chat, switch back to lobby
             self.after(
                 0,
                 lambda: (
                     self.switch_channel("lobby"),
-                    self.update_channel_list_ui(),
                     messagebox.showinfo(
                         "Изтриване", f"Чатът с {channel_name} е изтрит."
                     ),
@@ -418,54 +585,18 @@ class AuthApp(ctk.CTk):
 
         threading.Thread(target=_job, daemon=True).start()
 
+    @tagged("bulk_delete")
     def _delete_messages_for_room(self, room_id, notify=True, channel_name=None):
-        """Deletes all messages with given room_id using batched deletes."""
-        if firestore_db is None:
+        """Deletes all messages with given room_id through the message store."""
+        if not self._messages_available():
             self.after(
                 0, lambda: messagebox.showerror("Грешка", "Firestore не е наличен.")
             )
             return
         try:
             print(f"[LOG] Изтриване на съобщения за room_id={room_id} ...")
-            query = firestore_db.collection("messages").where("room_id", "==", room_id)
-            # stream() or get()
-            try:
-                docs = list(query.get())
-            except Exception:
-                docs = list(query.stream())
-
-            batch = firestore_db.batch()
-            count = 0
-            batch_count = 0
-            for d in docs:
-                try:
-                    batch.delete(
-                        firestore_db.collection("messages").document(
-                            getattr(d, "id", None)
-                        )
-                    )
-                    count += 1
-                    batch_count += 1
-                except Exception:
-                    # fallback: try using d.reference if available
-                    try:
-                        ref = getattr(d, "reference", None)
-                        if ref is not None:
-                            batch.delete(ref)
-                            count += 1
-                            batch_count += 1
-                    except Exception:
-                        continue
-
-                # commit every 400 deletes to avoid large batches
-                if batch_count >= 400:
-                    batch.commit()
-                    batch = firestore_db.batch()
-                    batch_count = 0
-
-            if batch_count > 0:
-                batch.commit()
-
+            # batched deletes (Firestore) or a single relay call
+            count = self.message_store().delete_room(room_id)
             print(f"[LOG] Изтриване приключи. Изтрити документи: {count}")
             if notify:
                 self.after(
@@ -475,27 +606,12 @@ class AuthApp(ctk.CTk):
                         f"Изтрити {count} съобщения за {room_id}.",
                     ),
                 )
-            # If we deleted history for the current channel, clear the chat UI
-            try:
-                if channel_name and channel_name == self.current_channel:
-                    self.after(
-                        0,
-                        lambda: (
-                            self.chat_history.configure(state="normal"),
-                            self.chat_history.delete("1.0", tk.END),
-                            self.chat_history.configure(state="disabled"),
-                            self._displayed_message_ids.clear(),
-                        ),
-                    )
+            if channel_name:
+                # If we deleted history for the current channel, clear the chat UI
+                if channel_name == self.current_channel:
+                    self.after(0, self._clear_chat_history)
                 # Also remove unread marker if present
-                if channel_name:
-                    try:
-                        self._unread_channels.discard(channel_name)
-                        self.after(0, self.update_channel_list_ui)
-                    except Exception:
-                        pass
-            except Exception:
-                pass
+                self.chat_state.dispatch(mark_read, channel_name)
         except Exception as e:
             print(f"[ERROR] Неуспешно изтриване на съобщения за {room_id}: {e}")
             self.after(0, lambda: messagebox.showerror("Грешка при изтриване", str(e)))
@@ -503,29 +619,361 @@ class AuthApp(ctk.CTk):
     # --- 5. AUTH & NAVIGATION ---
 
     def attempt_login(self):
-        """Опитва да влезе в системата."""
+        """Опитва да влезе в системата (мрежовата заявка е извън UI нишката)."""
         email = self.email_entry.get().strip()
         password = self.pass_entry.get().strip()
+
+        def _job():
+            try:
+                auth_service.sign_in(email, password)
+            except Exception as e:
+                print(f"[ERROR] Грешка при вход: {e}")
+                traceback.print_exc()
+                self.after(
+                    0,
+                    lambda: messagebox.showerror(
+                        "Грешка при вход",
+                        "Невалиден имейл/парола или вътрешна грешка. Проверете конзолата за подробности.",
+                    ),
+                )
+                return
+            self.after(0, lambda: self._on_login_success(email))
+
+        threading.Thread(target=_job, daemon=True).start()
+
+    def _try_restore_session(self):
+        """Възстановява запазена сесия с едно опресняване на токена (без вход)."""
+        session = auth_service.restore_session()
+        if session is not None:
+            self.after(0, lambda: self._on_login_success(session.email))
+
+    def _on_login_success(self, email):
+        if self.username:
+            return
+        self.username = email.split("@")[0]
+        self.rooms.reset(self.username)
+        self.chat_state.dispatch(reset)
+        self._recent_messages = {}
+        self._unconfirmed = {}
+        self._online_users = None
+        self._conversation_unread = None
+        self._rooms_loaded = False
+        self._seeding_index = False
+        print(f"[LOG] Успешен вход като {self.username}.")
+        snapshot = (
+            self._snapshots.load(self.username) if config.SESSION_SNAPSHOT else None
+        )
+        if snapshot is not None:
+            self._apply_snapshot(snapshot)
+        else:
+            self.events.publish(SessionRestored({}))
+        self.show_chat_lobby()
+        if snapshot is not None:
+            self._paint_snapshot(snapshot)
+        # with the index, its listener's first snapshot loads the DM rooms
+        if firestore_db is not None and not config.CONVERSATION_INDEX:
+            threading.Thread(target=self._load_my_rooms, daemon=True).start()
+
+    def _apply_snapshot(self, snapshot):
+        """Възстановява DM стаите, непрочетените и последните съобщения от snapshot."""
+        for channel, (room_id, participants) in snapshot.dms.items():
+            self.rooms.register(channel, room_id, participants)
+        self.chat_state.dispatch(add_dms, list(snapshot.dms))
+        for channel, count in snapshot.unread.items():
+            self.chat_state.dispatch(mark_unread, channel, count)
+        for channel, messages in snapshot.messages.items():
+            self._remember_messages(channel, messages)
+        # the controller shows these when a DM is opened, then reloads it
+        self.events.publish(
+            SessionRestored(
+                {c: m for c, m in snapshot.messages.items() if c in snapshot.dms}
+            )
+        )
+        print(f"[LOG] Възстановен snapshot на сесията ({len(snapshot.dms)} DM).")
+
+    def _paint_snapshot(self, snapshot):
+        """Рисува лобито и онлайн списъка от snapshot, докато сървърът отговори."""
+        lobby = snapshot.messages.get("lobby")
+        if lobby and self.current_channel == "lobby":
+            self._update_ui_with_new_messages(lobby)
+            self._note_unconfirmed(lobby)
+        # only if no fresh roster was shown already
+        if snapshot.online and self._online_users is None:
+            self._update_user_list_ui(list(snapshot.online))
+
+    def _note_unconfirmed(self, messages):
+        """Показани от snapshot: първата страница от сървъра ги проверява."""
+        for data in messages:
+            msg_id = data.get("_id")
+            if msg_id:
+                self._unconfirmed[msg_id] = data
+
+    def _reconcile_unconfirmed(self, history, complete):
+        """Поправя показаните от snapshot съобщения спрямо първата страница.
+
+        Edited ones are re-rendered; ones missing from the page are removed
+        when the page reaches back to their time (deleted while offline).
+        The listener only reports changes made after it subscribed.
+        """
+        unconfirmed, self._unconfirmed = self._unconfirmed, {}
+        if not unconfirmed:
+            return
+        fresh = {m.get("_id"): m for m in history}
+        oldest = history[0].get("timestamp") if history else None
+        recent = self._recent_messages.get(self.current_channel, {})
+        for msg_id, old in unconfirmed.items():
+            if msg_id not in self._message_window:
+                continue
+            new = fresh.get(msg_id)
+            if new is not None:
+                if (new.get("username"), new.get("text")) != (
+                    old.get("username"),
+                    old.get("text"),
+                ):
+                    self._replace_rendered_message(new)
+                    if msg_id in recent:
+                        recent[msg_id] = new
+            elif complete or _not_older(old.get("timestamp"), oldest):
+                self._remove_rendered_message(msg_id)
+                recent.pop(msg_id, None)
+
+    def _remember_messages(self, channel, messages):
+        """Пази последните SNAPSHOT_MESSAGES_PER_ROOM показани съобщения на канала."""
+        recent = self._recent_messages.setdefault(channel, OrderedDict())
+        for data in messages:
+            msg_id = data.get("_id") or data.get("id")
+            if msg_id and msg_id not in recent:
+                recent[msg_id] = data
+        while len(recent) > config.SNAPSHOT_MESSAGES_PER_ROOM:
+            recent.popitem(last=False)
+
+    def _capture_snapshot(self):
+        """Компактен snapshot на сесията; чете състоянието на Tk нишката."""
+        state = self.chat_state.snapshot
+        dms = {}
+        for channel in state.dm_channels:
+            room_id = self.rooms.room_for_channel(channel)
+            if room_id is not None:
+                dms[channel] = (room_id, self.rooms.participants(room_id))
+        # messages are only remembered while their channel is active, so the
+        # newest one is the last the user saw there
+        recent = {
+            channel: messages
+            for channel, messages in self._recent_messages.items()
+            if messages and (channel == "lobby" or channel in dms)
+        }
+        return SessionSnapshot(
+            dms=dms,
+            unread=dict(state.unread_counts),
+            messages={c: list(m.values()) for c, m in recent.items()},
+            online=tuple(self._online_users or ()),
+        )
+
+    def _save_snapshot(self, background=True):
+        """Записва snapshot на сесията (по подразбиране от фонова нишка)."""
+        if not config.SESSION_SNAPSHOT or not self.username:
+            return
+        username = self.username
         try:
-            auth.sign_in_with_email_and_password(email, password)
-            self.username = email.split("@")[0]
-            print(f"[LOG] Успешен вход като {self.username}.")
-            self.show_chat_lobby()
+            snapshot = self._capture_snapshot()
         except Exception as e:
-            # Print full traceback to help locate the source of font/scaling errors
-            print(f"[ERROR] Грешка при вход от Pyrebase: {e}")
-            traceback.print_exc()
-            messagebox.showerror(
-                "Грешка при вход",
-                "Невалиден имейл/парола или вътрешна грешка. Проверете конзолата за подробности.",
+            print(f"[WARN] Неуспешно създаване на snapshot: {e}")
+            return
+
+        def write():
+            try:
+                self._snapshots.save(username, snapshot)
+            except Exception as e:
+                print(f"[WARN] Неуспешен запис на snapshot: {e}")
+
+        if background:
+            threading.Thread(target=write, daemon=True).start()
+        else:
+            write()
+
+    def _periodic_snapshot(self):
+        self._save_snapshot()
+        self._snapshot_job = self.after(
+            config.SNAPSHOT_INTERVAL_MS, self._periodic_snapshot
+        )
+
+    @tagged("rooms")
+    def _load_my_rooms(self, seed_index=False):
+        """Зарежда DM стаите на потребителя от метаданните в 'rooms'.
+
+        With `seed_index` DM rooms that only exist in `messages` (older than
+        the metadata) are added too, and all of them are merged into the
+        user's conversation index, which is then marked seeded.
+        """
+        username = self.username
+        try:
+            rooms = load_rooms_for_user(username)
+            if seed_index:
+                known = {room_id for room_id, _ in rooms}
+                rooms += [r for r in scan_dm_rooms(username) if r[0] not in known]
+        except Exception as e:
+            print(f"[WARN] Неуспешно зареждане на стаите: {e}")
+            # not seeded: the next index snapshot tries again
+            self._seeding_index = False
+            return
+        added = [
+            self.rooms.channel_for_room(room_id)
+            for room_id, participants in rooms
+            if self.rooms.register_room_doc(room_id, participants)
+        ]
+        self.chat_state.dispatch(add_dms, added)
+        self._rooms_loaded = True
+        self.events.publish(RoomsLoaded(sorted(self.rooms.dm_channels())))
+        if seed_index:
+            try:
+                conversations.seed(username, rooms)
+            except Exception as e:
+                print(f"[WARN] Неуспешно създаване на индекса на разговорите: {e}")
+
+    @tagged("conversations")
+    def start_conversations_listener(self):
+        """Един малък слушател върху индекса на разговорите на потребителя."""
+        if firestore_db is None or not config.CONVERSATION_INDEX:
+            return
+        username = self.username
+
+        def on_snapshot(docs, changes, read_time):
+            doc = docs[0] if docs else None
+            entries = conversations.entries_from_doc(doc)
+            seeded = conversations.is_seeded(doc)
+            self.after(0, lambda: self._apply_conversations(entries, seeded))
+
+        try:
+            self._conversations_watch = self.hub.subscribe(
+                f"conversations:{username}",
+                lambda resume_from=None: conversations.conversations_ref(username),
+                on_snapshot,
             )
+        except Exception as e:
+            print(f"[ERROR] Неуспешно стартиране на слушателя за разговори: {e}")
+
+    def _apply_conversations(self, entries, seeded=True):
+        """Индексът на разговорите се промени: DM стаи, непрочетени и известия."""
+        if not seeded and not self._seeding_index:
+            # missing index, or one created by a DM received before this
+            # user's first login: load the rooms the old way and merge them in
+            self._seeding_index = True
+            threading.Thread(
+                target=lambda: self._load_my_rooms(seed_index=True), daemon=True
+            ).start()
+        if entries is None:
+            return
+        initial = self._conversation_unread is None
+        previous = self._conversation_unread or {}
+        self._conversation_unread = {}
+        added = []
+        for room_id, entry in entries.items():
+            if not self.rooms.register_room_doc(room_id, entry.get("participants")):
+                continue
+            channel = self.rooms.channel_for_room(room_id)
+            added.append(channel)
+            unread = conversations.unread_count(entry)
+            self._conversation_unread[room_id] = unread
+            if channel == self.current_channel:
+                if unread:
+                    self._mark_conversation_read(room_id)
+                continue
+            # the server count wins, also when it dropped (read on another
+            # device) - nothing is counted from history
+            self.chat_state.dispatch(set_unread, channel, unread)
+            sender = entry.get("last_sender")
+            # the sync process alerts from its own DM listener
+            if (
+                not initial
+                and unread > previous.get(room_id, 0)
+                and sender != self.username
+                and self._sync is None
+            ):
+                get_notification_worker().submit(sender or channel)
+        self.chat_state.dispatch(add_dms, added)
+        # while seeding, _load_my_rooms announces the complete list
+        if seeded and not self._rooms_loaded:
+            self._rooms_loaded = True
+            self.events.publish(RoomsLoaded(sorted(self.rooms.dm_channels())))
+
+    def _mark_conversation_read(self, room_id):
+        """Нулира непрочетените в индекса (само ако има такива)."""
+        if not self._conversation_unread or not self._conversation_unread.get(room_id):
+            return
+        self._conversation_unread[room_id] = 0
+        username = self.username
+        threading.Thread(
+            target=lambda: self._mark_read_quietly(username, room_id), daemon=True
+        ).start()
+
+    @tagged("conversations")
+    def _mark_read_quietly(self, username, room_id):
+        try:
+            conversations.mark_read(username, room_id)
+        except Exception as e:
+            print(f"[WARN] Неуспешно нулиране на непрочетените за {room_id}: {e}")
+
+    def _open_dm(self, other):
+        """Регистрира DM локално и записва метаданните на стаята във Firestore.
+
+        Names with "_" had another room id before; while the new room is
+        empty, history kept under the legacy id is taken over (`_use_legacy_dm`).
+        """
+        room_id = self.rooms.register_dm(other)
+        self.chat_state.dispatch(add_dms, [other])
+        if firestore_db is not None:
+            participants = self.rooms.participants(room_id)
+            threading.Thread(
+                target=lambda: self._save_dm_room(other, room_id, participants),
+                daemon=True,
+            ).start()
+        return room_id
+
+    @tagged("rooms")
+    def _save_dm_room(self, other, room_id, participants):
+        """Фонова нишка: legacy стая с история или метаданни за новата."""
+        try:
+            # relay/memory stores started with the new ids
+            legacy = (
+                find_legacy_dm_room(self.username, other)
+                if self._firestore_messages()
+                else None
+            )
+        except Exception as e:
+            print(f"[WARN] Неуспешна проверка за стара DM стая с {other}: {e}")
+            legacy = None
+        if legacy is not None:
+            room_id = legacy
+            self.after(0, lambda: self._use_legacy_dm(other, legacy, participants))
+        # later logins find the room through its metadata
+        self._save_room_quietly(room_id, participants)
+
+    def _use_legacy_dm(self, other, legacy, participants):
+        """UI нишка: DM-ът с `other` продължава в стаята с историята."""
+        if self.rooms.room_for_channel(other) == legacy:
+            return
+        self.rooms.register(other, legacy, participants)
+        print(f"[LOG] DM с {other} продължава в стара стая {legacy}.")
+        if self.current_channel == other:
+            self._stop_message_watcher()
+            self._clear_chat_history()
+            if self._messages_available():
+                self.start_chat_listeners()
+            self.events.publish(ChannelSwitched(other, legacy))
+
+    @tagged("rooms")
+    def _save_room_quietly(self, room_id, participants):
+        try:
+            save_room(room_id, participants)
+        except Exception as e:
+            print(f"[WARN] Неуспешен запис на метаданни за {room_id}: {e}")
 
     def attempt_register(self):
         """Опитва да регистрира нов потребител."""
         email = self.email_entry.get().strip()
         password = self.pass_entry.get().strip()
         try:
-            auth.create_user_with_email_and_password(email, password)
+            auth_service.create_user(email, password)
             messagebox.showinfo("Успех", "Регистрацията е успешна!")
         except Exception as e:
             print(f"[ERROR] Грешка при регистрация от Pyrebase: {e}")
@@ -537,27 +985,44 @@ class AuthApp(ctk.CTk):
     def show_chat_lobby(self):
         """Превключва към основния чат екран и стартира слушателите."""
         self.login_frame.pack_forget()
+        self._listeners.start()
+        if self._sync is not None and firestore_db is not None:
+            self._start_sync()
         self.setup_chat_ui()
         self.chat_frame.pack(fill="both", expand=True)
         # switch_channel извиква update_channel_list_ui отново, което е ОК
-        self.switch_channel("lobby")
-
-        # If we returned early because the channel was already 'lobby', ensure listeners/history are started
-        if firestore_db is not None and not self._message_stop_watcher:
-            try:
-                self.start_chat_listeners()
-            except Exception as e:
-                print(f"[WARN] Неуспешно стартиране на слушател за чат при show: {e}")
+        if self.current_channel != "lobby":
+            self.switch_channel("lobby")
+        else:
+            # Already on 'lobby' (switch_channel would return early): start
+            # listeners/history and announce the channel ourselves
+            if firestore_db is not None:
+                try:
+                    self.start_chat_listeners()
+                except Exception as e:
+                    print(
+                        f"[WARN] Неуспешно стартиране на слушател за чат при show: {e}"
+                    )
+            self.events.publish(ChannelSwitched("lobby", "lobby"))
 
         if firestore_db is not None:
-            self.set_online_status(True)
+            # The heartbeat writes the initial presence doc from its own thread
             self.start_presence_heartbeat()
             self.start_presence_listener()
-            # Fetch current presence and history once to populate UI immediately
-            try:
-                self._fetch_presence_once()
-            except Exception as e:
-                print(f"[WARN] Неуспешно еднократно извличане на присъствие: {e}")
+            self.start_conversations_listener()
+            # Fetch current presence once to populate UI immediately (the scoped
+            # watcher's first snapshot already does that)
+            if not is_scoped() and self._sync is None:
+                try:
+                    self._fetch_presence_once()
+                except Exception as e:
+                    print(f"[WARN] Неуспешно еднократно извличане на присъствие: {e}")
+            self._schedule_presence_expiry()
+            threading.Thread(target=self._cleanup_stale_presence, daemon=True).start()
+        if config.SESSION_SNAPSHOT and self._snapshot_job is None:
+            self._snapshot_job = self.after(
+                config.SNAPSHOT_INTERVAL_MS, self._periodic_snapshot
+            )
 
     # --- 6. CLEANUP И LOGOUT (АГРЕСИВНО СПИРАНЕ НА НИШКИ) ---
     def _stop_listeners(self, clean_exit=False):
@@ -568,6 +1033,9 @@ class AuthApp(ctk.CTk):
         print(f"[LOG] Stopping listeners (clean_exit={clean_exit})")
         # Stop heartbeat first so set_online_status knows we're stopping
         self._heartbeat_running = False
+        if self._presence_heartbeat is not None:
+            self._presence_heartbeat.stop()
+            self._presence_heartbeat = None
 
         # Unsubscribe message watcher
         if self._message_stop_watcher:
@@ -599,25 +1067,75 @@ class AuthApp(ctk.CTk):
                 print(f"[ERROR] Грешка при unsubscribe на присъствие: {e}")
             self._presence_stop_watcher = None
 
+        # Drop in-flight loads so nothing renders after logout
+        self.tasks.cancel_all()
+        # Stops health checks and unsubscribes whatever is still supervised
+        # (including the global message listener)
+        self.hub.stop()
+        self._listeners.stop()
+        self._global_message_stop_watcher = None
+        self._conversations_watch = None
+        if self._direct_watch is not None:
+            try:
+                self._direct_watch.unsubscribe()
+            except Exception as e:
+                print(f"[WARN] Грешка при unsubscribe на DM потока: {e}")
+            self._direct_watch = None
+        with self._store_lock:
+            store, self._store = self._store, None
+        if store is not None:
+            try:
+                store.close()
+            except Exception as e:
+                print(f"[WARN] Грешка при затваряне на хранилището: {e}")
+
+        if self._scoped_presence is not None:
+            self._scoped_presence.stop()
+            self._scoped_presence = None
+        self._lobby_senders.clear()
+
+        if self._sync is not None:
+            self._stop_sync(shutdown=clean_exit)
+
+        if self._presence_expire_job is not None:
+            try:
+                self.after_cancel(self._presence_expire_job)
+            except Exception:
+                pass
+            self._presence_expire_job = None
+
+        if self._snapshot_job is not None:
+            try:
+                self.after_cancel(self._snapshot_job)
+            except Exception:
+                pass
+            self._snapshot_job = None
+
         # Remove presence document on clean exit
         if clean_exit and self.username and firestore_db is not None:
             try:
-                firestore_db.collection("presence").document(self.username).delete()
+                clear_presence(self.username)
             except Exception as e:
                 print(f"[ERROR] Грешка при изтриване на presence при clean exit: {e}")
 
     def on_closing(self):
         """Изпълнява се при затваряне на прозореца. Осигурява чисто прекратяване."""
         print("[LOG] Започва процес на затваряне...")
+        self._save_snapshot(background=False)
         # Stop listeners and remove presence (clean exit)
         self._stop_listeners(clean_exit=True)
+        stop_notification_worker()
+        self.tasks.shutdown()
+        auth_service.close()
         print("[LOG] Heartbeat и онлайн статус изключени.")
+        print(f"[LOG] Firestore разход за сесията:\n{get_cost_meter().summary()}")
         print("[LOG] Унищожаване на прозореца.")
         self.destroy()
 
     def logout(self):
         """Излиза от системата, обновява статуса и връща към екрана за вход."""
         # Stop listeners (but do not destroy window) and return to login UI
+        self._save_snapshot(background=False)
         self._stop_listeners(clean_exit=False)
         # Remove presence doc for this user when logging out
         try:
@@ -626,7 +1144,7 @@ class AuthApp(ctk.CTk):
             print(f"[WARN] Неуспешно изтриване на presence при logout: {e}")
         # Clear any displayed message ids cache
         try:
-            self._displayed_message_ids.clear()
+            self._clear_chat_history()
         except Exception:
             pass
         try:
@@ -635,83 +1153,232 @@ class AuthApp(ctk.CTk):
             pass
         self.login_frame.pack(fill="both", expand=True)
         self.username = None
+        auth_service.sign_out()
         messagebox.showinfo("Изход", "Излязохте успешно.")
 
     # --- 7. CHAT LOGIC (THREADS И LISTENERS) ---
 
-    def get_dm_room_id(self, user1, user2):
-        """Генерира уникален, сортиран идентификатор за DM стая."""
-        return f"dm_{'_'.join(sorted([user1, user2]))}"
+    @property
+    def current_channel(self):
+        """Активният канал ('lobby' или потребител) от текущия snapshot."""
+        return self.chat_state.snapshot.current_channel
 
-    def set_online_status(self, is_online=True):
-        """Обновява статуса на присъствие във Firestore."""
-        if not self.username or firestore_db is None:
+    @tagged("presence_heartbeat")
+    def _write_heartbeat(self, state):
+        """Heartbeat запис от нишката на heartbeat-а.
+
+        Errors propagate so PresenceHeartbeat retries on its next tick.
+        """
+        username = self.username
+        if username:
+            set_presence(username, state)
+
+    @tagged("presence_heartbeat")
+    def set_online_status(self, is_online=True, state=STATE_ACTIVE):
+        """Обновява статуса на присъствие във Firestore (грешките се логват)."""
+        username = self.username
+        if not username or firestore_db is None:
             return
 
-        doc_ref = firestore_db.collection("presence").document(self.username)
         try:
             if is_online:
-                doc_ref.set(
-                    {"username": self.username, "last_seen": firestore.SERVER_TIMESTAMP}
-                )
+                set_presence(username, state)
             elif not self._heartbeat_running:  # Изтрива само при clean exit
-                doc_ref.delete()
+                clear_presence(username)
         except Exception as e:
             print(f"[ERROR] Грешка при обновяване на присъствието: {e}")
 
     def start_presence_heartbeat(self):
-        """Стартира таймер за периодично обновяване на 'last_seen'."""
+        """Стартира адаптивния heartbeat за 'last_seen' в отделна нишка."""
         if firestore_db is None:
             return
+        if self._presence_heartbeat is not None:
+            self._presence_heartbeat.stop()
         self._heartbeat_running = True
-        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
-
-    def _heartbeat_loop(self):
-        """Цикъл, който изпраща 'heartbeat' към сървъра."""
-        while self._heartbeat_running:
-            time.sleep(15)
-            if self._heartbeat_running:
-                # Използва after за безопасно изпълнение в главната нишка
-                self.after(0, lambda: self.set_online_status(True))
+        self._presence_heartbeat = PresenceHeartbeat(self._write_heartbeat)
+        self._presence_heartbeat.start()
+
+    def _on_user_activity(self, event=None):
+        """Keyboard/mouse input: keeps the presence heartbeat in 'active' state."""
+        heartbeat = self._presence_heartbeat
+        if heartbeat is not None:
+            heartbeat.mark_activity()
+
+    def _on_window_visibility(self, event=None):
+        """Map/Unmap of the main window: minimised clients back off presence writes."""
+        if event is not None and event.widget is not self:
+            return
+        heartbeat = self._presence_heartbeat
+        if heartbeat is not None:
+            heartbeat.set_minimised(self.state() == "iconic")
 
     def start_presence_listener(self):
-        """Стартира Realtime слушател за присъствие."""
+        """Стартира Realtime слушател за присъствие (пресни docs или shard docs)."""
         if firestore_db is None:
             return
-        query = firestore_db.collection("presence")
+        if self._sync is not None:
+            # the sync process watches presence; only the scope comes from here
+            self._refresh_presence_scope()
+            return
+        if is_scoped():
+            self._scoped_presence = ScopedPresenceWatcher(
+                self._presence_roster, self._on_scoped_presence_change
+            )
+            self._refresh_presence_scope()
+            return
         # Стартира в отделна нишка, за да не блокира главната
-        threading.Thread(
-            target=lambda: self._presence_listener_loop(query), daemon=True
-        ).start()
+        threading.Thread(target=self._presence_listener_loop, daemon=True).start()
 
-    def _presence_listener_loop(self, query):
-        """Слуша за промени в колекцията 'presence'."""
+    @tagged("presence")
+    def _presence_listener_loop(self):
+        """Слуша за промени в presence документите."""
         try:
-            # .on_snapshot връща Watch обекта, който запазваме
-            self._presence_stop_watcher = query.on_snapshot(
-                self._handle_presence_change
+            # The roster snapshot is always complete, so a resubscribe just
+            # rebuilds the (TTL-bounded) query and ignores the resume point
+            self._presence_stop_watcher = self.hub.subscribe(
+                "presence",
+                lambda resume_from=None: presence_query(),
+                self._handle_presence_change,
             )
         except Exception as e:
             print(f"[ERROR] Грешка при стартиране на слушателя за присъствие: {e}")
 
     def _handle_presence_change(self, col_snapshot, changes, read_time):
         """Обновява списъка с потребители онлайн."""
-
         # Събира всички потребители онлайн (включително текущия)
-        online_users = sorted(
-            [
-                doc.to_dict().get("username")
-                for doc in col_snapshot
-                if doc.to_dict().get("username")
-            ],
-            key=str.lower,
+        self._presence_roster.replace(col_snapshot)
+        # the bus hands the UI update to the Tk thread
+        self.events.publish(PresenceChanged(self._presence_roster.online_users()))
+
+    def _on_scoped_presence_change(self):
+        self.events.publish(PresenceChanged(self._presence_roster.online_users()))
+
+    def _presence_scope(self):
+        """Users whose presence the UI shows: DM partners, recent lobby senders, me."""
+        scope = set(self.chat_state.snapshot.dm_channels) | set(self._lobby_senders)
+        if self.username:
+            scope.add(self.username)
+        return scope
+
+    @tagged("presence")
+    def _refresh_presence_scope(self):
+        """Re-targets the scoped watcher; only chunks whose members changed resubscribe."""
+        if self._sync is not None:
+            scope = self._presence_scope()
+            if scope != self._sync_scope and self._sync.running:
+                self._sync_scope = scope
+                self._sync.set_presence_scope(scope)
+            return
+        watcher = self._scoped_presence
+        if watcher is None:
+            return
+        scope = self._presence_scope()
+        if scope == watcher.scope():
+            return
+        try:
+            watcher.set_scope(scope)
+        except Exception as e:
+            print(f"[WARN] Неуспешна промяна на обхвата на присъствие: {e}")
+
+    def _note_lobby_senders(self, messages):
+        """Tracks the most recent distinct lobby senders (bounded) for presence scope."""
+        # Over the Firestore budget: don't grow the watched presence scope
+        if not get_cost_meter().allow_background():
+            return
+        for data in messages:
+            sender = data.get("username")
+            if not sender:
+                continue
+            self._lobby_senders.pop(sender, None)
+            self._lobby_senders[sender] = True
+        while len(self._lobby_senders) > config.PRESENCE_SCOPE_LOBBY_SENDERS:
+            self._lobby_senders.pop(next(iter(self._lobby_senders)))
+        self._refresh_presence_scope()
+
+    def _open_online_browser(self):
+        """Отваря прозорец, който страницира всички онлайн потребители при поискване."""
+        win = ctk.CTkToplevel(self)
+        win.title("Всички онлайн")
+        win.geometry("280x420")
+        win.transient(self)
+        listing = ctk.CTkScrollableFrame(win, fg_color="transparent")
+        listing.pack(fill="both", expand=True, padx=5, pady=5)
+        page = {"cursor": None, "offset": 0, "row": 0}
+
+        def render(users, more):
+            if not win.winfo_exists():
+                return
+            for user in users:
+                ctk.CTkButton(
+                    listing,
+                    text=f"@{user}",
+                    anchor="w",
+                    fg_color="transparent",
+                    hover_color=COLOR_PRIMARY_DARK,
+                    state="disabled" if user == self.username else "normal",
+                    command=lambda u=user: (win.destroy(), self.switch_channel(u)),
+                ).grid(row=page["row"], column=0, sticky="ew", pady=1)
+                page["row"] += 1
+            more_btn.configure(state="normal" if more else "disabled")
+
+        def load_page():
+            more_btn.configure(state="disabled")
+            if is_aggregated():
+                # the shard listener already holds the full roster locally
+                users = (
+                    self._sync_online
+                    if self._sync is not None
+                    else self._presence_roster.online_users()
+                )
+                start = page["offset"]
+                page["offset"] = start + config.PRESENCE_BROWSE_PAGE
+                render(users[start : page["offset"]], page["offset"] < len(users))
+                return
+
+            def job():
+                try:
+                    users, cursor = browse_online_page(start_after=page["cursor"])
+                except Exception as e:
+                    print(f"[WARN] Неуспешно зареждане на онлайн потребители: {e}")
+                    users, cursor = [], None
+                page["cursor"] = cursor
+                self.after(0, lambda: render(users, cursor is not None))
+
+            threading.Thread(target=job, daemon=True).start()
+
+        more_btn = ctk.CTkButton(win, text="Още", command=load_page)
+        more_btn.pack(fill="x", padx=5, pady=(0, 5))
+        load_page()
+
+    def _schedule_presence_expiry(self):
+        """Periodically drops users whose 'last_seen' fell out of the TTL window."""
+        self._presence_expire_job = self.after(
+            int(config.PRESENCE_EXPIRE_TICK * 1000), self._expire_presence
         )
 
-        # Обновяване на UI чрез self.after за безопасност
-        self.after(0, lambda: self._update_user_list_ui(online_users))
+    def _expire_presence(self):
+        self._presence_expire_job = None
+        if not self.username:
+            return
+        if self._presence_roster.expire():
+            self.events.publish(PresenceChanged(self._presence_roster.online_users()))
+        self._schedule_presence_expiry()
+
+    @tagged("presence_cleanup")
+    def _cleanup_stale_presence(self):
+        """Deletes presence docs left behind by crashed clients (rate-limited)."""
+        if not get_cost_meter().allow_background():
+            return
+        try:
+            deleted = cleanup_stale_presence()
+            if deleted:
+                print(f"[LOG] Изтрити остарели presence документи: {deleted}")
+        except Exception as e:
+            print(f"[WARN] Неуспешно почистване на presence: {e}")
 
     def _update_user_list_ui(self, online_users):
         """Финално обновяване на UI елементите за присъствие."""
+        self._online_users = list(online_users)
         for widget in self.user_list_container.winfo_children():
             widget.destroy()
 
@@ -742,102 +1409,66 @@ class AuthApp(ctk.CTk):
 
     def _channel_name_for_room(self, room_id):
         """Return channel username (or 'lobby') for given room_id, or None."""
-        if not room_id:
-            return None
-        if room_id == "lobby":
-            return "lobby"
-        # Look in dm_list first
-        try:
-            for user, rid in self.dm_list.items():
-                if rid == room_id:
-                    return user
-        except Exception:
-            pass
-        # Fallback: parse dm_ format
-        if room_id.startswith("dm_"):
-            parts = room_id.split("_")[1:]
-            try:
-                for p in parts:
-                    if p != self.username:
-                        return p
-            except Exception:
-                return None
-        return None
+        return self.rooms.channel_for_room(room_id)
 
     def send_message(self):
-        """Изпраща съобщение към Firestore."""
+        """Изпраща съобщение през хранилището на съобщенията (config.MESSAGE_STORE)."""
         message = self.message_entry.get().strip()
-        if not message or firestore_db is None:
+        if not message or not self._messages_available():
             return
 
         # Определя room_id
         room_id = "lobby"
+        participants = None
         if self.current_channel != "lobby":
-            # Ако не е лоби, използва DM room_id, който вече е в dm_list след switch_channel
-            room_id = self.dm_list.get(self.current_channel)
-            if room_id is None:
-                # В малко вероятния случай, че dm_list е празен при switch, пресмятаме го сега
-                room_id = self.get_dm_room_id(self.username, self.current_channel)
-                self.dm_list[self.current_channel] = room_id
+            # Ако не е лоби, използва DM room_id, който вече е в регистъра след switch_channel
+            if self.current_channel not in self.rooms:
+                # В малко вероятния случай, че стаята липсва при switch, регистрираме я сега
+                self._open_dm(self.current_channel)
+            room_id = self.rooms.room_for_channel(self.current_channel)
+            # explicit membership so listeners never parse it out of room_id
+            participants = list(self.rooms.participants(room_id))
+
+        # the write (and, for DMs, the conversation index update) happens off
+        # the Tk thread; the entry is restored if it fails
+        self.message_entry.delete(0, tk.END)
+        threading.Thread(
+            target=lambda: self._send_in_background(room_id, message, participants),
+            daemon=True,
+        ).start()
 
+    @tagged("send")
+    def _send_in_background(self, room_id, message, participants):
         try:
-            # Firestore .add() can return different shapes depending on SDK/version.
-            add_result = firestore_db.collection("messages").add(
-                {
-                    "room_id": room_id,
-                    "username": self.username,
-                    "text": message,
-                    "timestamp": firestore.SERVER_TIMESTAMP,
-                }
+            msg_id = self.message_store().add(
+                room_id, self.username, message, participants
             )
-
-            # Determine DocumentReference from the returned value(s)
-            doc_ref = None
-            if hasattr(add_result, "id"):
-                # direct DocumentReference
-                doc_ref = add_result
-            else:
-                try:
-                    # iterable return (tuple/list) - find first item with .id
-                    for item in add_result:
-                        if hasattr(item, "id"):
-                            doc_ref = item
-                            break
-                except Exception:
-                    doc_ref = None
-
-            if doc_ref is not None:
-                print(
-                    f"[LOG] Съобщение ИЗПРАТЕНО успешно към Room ID: {room_id}, Doc ID: {doc_ref.id}"
-                )
-            else:
-                print(
-                    f"[LOG] Съобщение ИЗПРАТЕНО успешно към Room ID: {room_id} (Doc ID неизвестен)"
-                )
-            # Optimistic UI update: insert the sent message locally so user sees it immediately
-            try:
-                # Only optimistic-insert if we have the server doc id to avoid duplicates
-                if doc_ref is not None and getattr(doc_ref, "id", None):
-                    local_msg = {
-                        "room_id": room_id,
-                        "username": self.username,
-                        "text": message,
-                        "timestamp": datetime.now(),
-                        "_id": doc_ref.id,
-                    }
-                    # Schedule UI insert on main thread
-                    self.after(
-                        0, lambda: self._update_ui_with_new_messages([local_msg])
-                    )
-            except Exception as e:
-                print(f"[WARN] Неуспешно локално вмъкване на съобщението: {e}")
-            self.message_entry.delete(0, tk.END)
         except Exception as e:
-            # По-добро прихващане на грешки
-            print(f"[ERROR] Неуспешно изпращане на съобщение към Firestore: {e}")
-            messagebox.showerror(
-                "Грешка", f"Неуспешно изпращане: {e}. Проверете правата за запис."
-            )
+            print(f"[ERROR] Неуспешно изпращане на съобщение: {e}")
+            self.after(0, lambda: self._on_send_failed(message, e))
+            return
+        print(
+            f"[LOG] Съобщение ИЗПРАТЕНО успешно към Room ID: {room_id}, Doc ID: {msg_id}"
+        )
+        # Optimistic UI update: the SendAcked subscriber inserts the sent
+        # message locally so the user sees it immediately. Only with the
+        # server doc id, so the listener echo is deduplicated.
+        if msg_id:
+            local_msg = {
+                "room_id": room_id,
+                "username": self.username,
+                "text": message,
+                "timestamp": datetime.now(),
+                "_id": msg_id,
+            }
+            self.events.publish(SendAcked(room_id, local_msg))
+
+    def _on_send_failed(self, message, error):
+        if not self.message_entry.get():
+            self.message_entry.insert(0, message)
+        messagebox.showerror(
+            "Грешка", f"Неуспешно изпращане: {error}. Проверете правата за запис."
+        )
 
     def switch_channel(self, new_channel):
         """Превключва активния канал/DM стая и рестартира слушателя."""
@@ -851,32 +1482,40 @@ class AuthApp(ctk.CTk):
         if self.current_channel == new_channel:
             return
 
-        # Ако превключваме към потребител (DM), добавяме го към dm_list (но не към себе си)
+        # Ако превключваме към потребител (DM), регистрираме стаята (но не към себе си)
         if (
             new_channel != "lobby"
-            and new_channel not in self.dm_list
+            and new_channel not in self.rooms
             and new_channel != self.username
         ):
-            self.dm_list[new_channel] = self.get_dm_room_id(self.username, new_channel)
+            self._open_dm(new_channel)
 
-        self.current_channel = new_channel
-        # Clear displayed message ids when switching channels to avoid cross-room dedupe
-        try:
-            self._displayed_message_ids.clear()
-        except Exception:
-            pass
-        # Clear unread marker for the channel we switched to
-        try:
-            if new_channel in self._unread_channels:
-                self._unread_channels.discard(new_channel)
-        except Exception:
-            pass
-        self.chat_history.configure(state="normal")
-        self.chat_history.delete("1.0", tk.END)
-        self.chat_history.configure(state="disabled")
+        # Active + read; the store subscription redraws the channel list
+        self.chat_state.dispatch(select_channel, new_channel)
+        self._mark_conversation_read(self.rooms.room_for_channel(new_channel))
+        # Clears text, message marks and displayed ids (avoids cross-room dedupe)
+        self._clear_chat_history()
         print(f"[LOG] Превключване към канал/потребител: {self.current_channel}")
 
         # Първо отписваме стария слушател, ако съществува
+        self._stop_message_watcher()
+
+        if self._messages_available():
+            self.start_chat_listeners()
+
+        title = (
+            f"Чат Лоби: #{self.current_channel}"
+            if self.current_channel == "lobby"
+            else f"Лично с: @{self.current_channel}"
+        )
+        self.chat_title_label.configure(text=title)
+
+        self.events.publish(
+            ChannelSwitched(new_channel, self.rooms.room_for_channel(new_channel))
+        )
+
+    def _stop_message_watcher(self):
+        """Спира слушателя за съобщения на активния канал, ако има такъв."""
         if self._message_stop_watcher:
             try:
                 if hasattr(self._message_stop_watcher, "unsubscribe"):
@@ -892,89 +1531,141 @@ class AuthApp(ctk.CTk):
                 print(f"[ERROR] Грешка при unsubscribe на предишни съобщения: {e}")
             self._message_stop_watcher = None
 
-        if firestore_db is not None:
-            self.start_chat_listeners()
+    def message_store(self):
+        """MessageStore на сесията; създава се при първа употреба.
 
-        title = (
-            f"Чат Лоби: #{self.current_channel}"
-            if self.current_channel == "lobby"
-            else f"Лично с: @{self.current_channel}"
-        )
-        self.chat_title_label.configure(text=title)
+        Blocking (a relay store connects here), so call it off the Tk thread.
+        """
+        with self._store_lock:
+            if self._store is None:
+                self._store = get_store(username=self.username)
+            return self._store
+
+    @staticmethod
+    def _firestore_messages():
+        return config.MESSAGE_STORE == "firestore"
+
+    def _messages_available(self):
+        return firestore_db is not None or not self._firestore_messages()
+
+    def _start_direct_stream(self):
+        """DM поток от хранилището (relay/memory): непрочетени и известия."""
+        username = self.username
+
+        def on_messages(messages):
+            for data in messages:
+                self._on_incoming_dm(
+                    data.get("room_id"), data.get("username"), data.get("participants")
+                )
 
-        # Обновява списъка с канали за да маркира активния
-        self.update_channel_list_ui()
+        try:
+            watch = self.message_store().stream_direct(on_messages)
+        except Exception as e:
+            print(f"[ERROR] Неуспешно стартиране на DM потока: {e}")
+            return
+        if self.username != username or self._direct_watch is not None:
+            watch.unsubscribe()  # logged out (or started twice) meanwhile
+            return
+        self._direct_watch = watch
 
     def start_chat_listeners(self):
         """Стартира Realtime слушател за съобщения за активния канал/DM."""
-        if firestore_db is None:
+        if not self._messages_available():
             return
-        room_id = (
-            "lobby"
-            if self.current_channel == "lobby"
-            else self.dm_list.get(self.current_channel)
-        )
+        room_id = self.rooms.room_for_channel(self.current_channel)
         if room_id is None:
             print("[ERROR] Не може да се намери Room ID за слушане.")
             return
 
         print(f"[LOG] Стартиране на слушател за Room ID: {room_id}")
-        # Avoid server-side ordering that may require a composite index.
-        # We'll fetch documents by room_id and sort client-side by timestamp.
-        query = (
-            firestore_db.collection("messages")
-            .where("room_id", "==", room_id)
-            .limit(100)
+
+        if self._sync is not None and self._firestore_messages():
+            # history + listener live in the sync process; events carry this
+            # generation, so a later switch drops anything still in flight
+            self._sync.watch_room(room_id)
+            return
+
+        # History loads off the UI thread; a newer switch_channel supersedes
+        # this task, so room A's history never renders into room B
+        def load(token):
+            try:
+                return self._load_history_once(room_id)
+            except Exception as e:
+                print(f"[WARN] Неуспешно еднократно зареждане на история: {e}")
+                return []
+
+        self.tasks.submit(
+            "chat",
+            load,
+            on_done=lambda history: self._on_history_loaded(room_id, history),
         )
 
-        # Load history once (synchronous read) to ensure UI has messages immediately
-        try:
-            self._load_history_once(query)
-            # suppress the immediate initial snapshot's duplicate load (we already loaded once)
-            self._suppress_next_initial_snapshot = True
-        except Exception as e:
-            print(f"[WARN] Неуспешно еднократно зареждане на история: {e}")
+    def _on_history_loaded(self, room_id, history):
+        """UI thread, still current: render history, then start the room listener."""
+        # a short page is the whole room
+        self._reconcile_unconfirmed(history, len(history) < INITIAL_HISTORY_LIMIT)
+        self._merge_history(history)
+        if not self._firestore_messages():
+            # store stream: only messages added from now on
+            try:
+                self._message_stop_watcher = self.message_store().stream(
+                    room_id,
+                    lambda messages: self._publish_message_changes(
+                        room_id, messages, [], []
+                    ),
+                )
+            except Exception as e:
+                print(f"[ERROR] Неуспешно стартиране на потока за {room_id}: {e}")
+            return
+        # suppress the immediate initial snapshot's duplicate load (we already loaded once)
+        self._suppress_next_initial_snapshot = True
+
+        # Listen from the oldest loaded message onwards, without a limit: a
+        # limited query also reports REMOVED when a doc merely falls out of the
+        # window, so REMOVED would no longer mean "deleted on the server".
+        # Uses the same (room_id, timestamp) index as get_history_paginated.
+        # After a reconnect the supervisor passes the newest delivered
+        # timestamp, so only missed messages are downloaded again.
+        oldest = history[0].get("timestamp") if history else None
+
+        def make_query(resume_from=None):
+            query = firestore_db.collection("messages").where("room_id", "==", room_id)
+            since = resume_from or oldest
+            if since is not None:
+                query = query.where("timestamp", ">=", since)
+            return query
 
-        threading.Thread(
-            target=lambda: self._message_listener_loop(query), daemon=True
-        ).start()
+        # Subscribed right here on the UI thread (on_snapshot only starts the
+        # watch thread), so it can't race a later switch_channel's unsubscribe
+        self._message_listener_loop(room_id, make_query)
 
-    def _load_history_once(self, query):
-        """Извлича историята за даден query веднъж и обновява UI.
+    @tagged("history")
+    def _load_history_once(self, room_id, limit=INITIAL_HISTORY_LIMIT):
+        """Извлича най-новите `limit` съобщения за room_id веднъж.
 
-        Expects a Query object.
+        Returns the loaded messages as dicts, oldest first; rendering is left
+        to the caller.
         """
-        docs = None
-        # Try common ways to fetch documents from a Query across SDKs
-        try:
-            docs = list(query.get())
-        except Exception:
+        if not self._firestore_messages():
+            return self.message_store().history(room_id, limit=limit)
+        # Newest page, ordered server-side
+        docs, _ = get_history_paginated(room_id, limit=limit, direction="desc")
+        if not docs:
+            # Fallback: unordered read (e.g. while the composite index is missing)
             try:
-                docs = list(query.stream())
+                docs = list(
+                    firestore_db.collection("messages")
+                    .where("room_id", "==", room_id)
+                    .limit(limit)
+                    .get()
+                )
             except Exception as e:
-                print(f"[DEBUG] Неуспех при извличане на история (get/stream): {e}")
-                # As a last resort, try re-constructing a query by collection and filtering by room_id
-                try:
-                    # attempt to extract room_id from the original query by re-querying by current channel
-                    room_id = (
-                        "lobby"
-                        if self.current_channel == "lobby"
-                        else self.dm_list.get(self.current_channel)
-                    )
-                    docs = list(
-                        firestore_db.collection("messages")
-                        .where("room_id", "==", room_id)
-                        .order_by("timestamp", direction=firestore.Query.ASCENDING)
-                        .limit(100)
-                        .get()
-                    )
-                except Exception as e2:
-                    print(f"[ERROR] Неуспешно извличане на история чрез fallback: {e2}")
-                    docs = []
+                print(f"[ERROR] Неуспешно извличане на история чрез fallback: {e}")
+                docs = []
 
         if not docs:
             print("[DEBUG] _load_history_once: няма намерени документи за query.")
-            return
+            return []
 
         # Debug print: show doc ids and small preview
         try:
@@ -1028,42 +1719,53 @@ class AuthApp(ctk.CTk):
                 pass
             history_data.append(d)
 
-        # Ensure UI update runs on main thread
-        self.after(0, lambda: self._update_ui_with_new_messages(history_data))
+        return history_data
 
     def _fetch_presence_once(self):
-        """One-time fetch of presence documents to populate the online users list."""
+        """One-time fetch of fresh presence documents to populate the online users list."""
         try:
-            col = firestore_db.collection("presence")
-            docs = list(col.get())
+            docs = list(presence_query().get())
             # Include current user as well
-            online_users = sorted(
-                [
-                    d.to_dict().get("username")
-                    for d in docs
-                    if d.to_dict().get("username")
-                ],
-                key=str.lower,
-            )
-            self.after(0, lambda: self._update_user_list_ui(online_users))
+            self._presence_roster.replace(docs)
+            self.events.publish(PresenceChanged(self._presence_roster.online_users()))
         except Exception as e:
             print(f"[WARN] Грешка при еднократно извличане на присъствие: {e}")
 
-    def _message_listener_loop(self, query):
-        """Слуша за нови съобщения за активния room_id."""
+    @tagged("room_listener")
+    def _message_listener_loop(self, room_id, make_query):
+        """Слуша за нови съобщения за активния room_id (споделен слушател)."""
         try:
-            self._message_stop_watcher = query.on_snapshot(self._handle_message_change)
+            self._message_stop_watcher = self.hub.subscribe(
+                f"room:{room_id}",
+                make_query,
+                lambda snapshot, changes, read_time: self._handle_message_change(
+                    snapshot, changes, read_time, room_id=room_id
+                ),
+            )
         except Exception as e:
             print(
                 f"[ERROR] Критична грешка при стартиране на слушателя за съобщения (on_snapshot): {e}"
             )
 
+    @tagged("global_listener")
     def _global_message_listener_loop(self):
-        """Global listener for new messages so we can detect incoming DMs when not focused on them."""
+        """Global listener for new messages so we can detect incoming DMs when not focused on them.
+
+        Bounded to messages newer than the session start (or, after a
+        reconnect, than the newest one already seen) instead of replaying
+        the whole collection.
+        """
+        session_start = datetime.now(timezone.utc)
+
+        def make_query(resume_from=None):
+            return firestore_db.collection("messages").where(
+                "timestamp", ">=", resume_from or session_start
+            )
+
         try:
-            self._global_message_stop_watcher = firestore_db.collection(
-                "messages"
-            ).on_snapshot(self._handle_global_message_change)
+            self._global_message_stop_watcher = self.hub.subscribe(
+                "global", make_query, self._handle_global_message_change
+            )
         except Exception as e:
             print(
                 f"[ERROR] Неуспешно стартиране на глобален слушател за съобщения: {e}"
@@ -1077,63 +1779,113 @@ class AuthApp(ctk.CTk):
             try:
                 if change.type.name == "ADDED":
                     d = change.document.to_dict()
-                    room_id = d.get("room_id")
-                    sender = d.get("username")
-                    if not room_id or not sender:
-                        continue
-                    # Only care about DM rooms (format 'dm_user1_user2')
-                    if not room_id.startswith("dm_"):
-                        continue
-                    # If this message is from me, ignore
-                    if sender == self.username:
-                        continue
-                    # If my username is part of the room_id, it's a DM for me
-                    if self.username and self.username in room_id:
-                        # derive other username
-                        parts = room_id.split("_")[1:]
-                        other = None
-                        try:
-                            for p in parts:
-                                if p != self.username:
-                                    other = p
-                                    break
-                        except Exception:
-                            other = None
-
-                        if other is None:
-                            continue
-
-                        # ensure DM exists in left list
-                        try:
-                            if other not in self.dm_list:
-                                self.dm_list[other] = room_id
-                                # update channel UI on main thread
-                                self.after(0, self.update_channel_list_ui)
-                        except Exception:
-                            pass
-
-                        # If not currently viewing that channel, mark unread and play sound
-                        try:
-                            if other != self.current_channel:
-                                self._unread_channels.add(other)
-                                # cross-platform notification + sound
-                                try:
-                                    self.after(
-                                        0,
-                                        lambda: notify_dm(
-                                            "Новo лично съобщение", f"От: {sender}"
-                                        ),
-                                    )
-                                except Exception:
-                                    pass
-                                # refresh channel list UI to show unread marker
-                                self.after(0, self.update_channel_list_ui)
-                        except Exception:
-                            pass
+                    self._on_incoming_dm(
+                        d.get("room_id"), d.get("username"), d.get("participants")
+                    )
             except Exception:
                 continue
 
-    def _handle_message_change(self, col_snapshot, changes, read_time):
+    def _on_incoming_dm(self, room_id, sender, participants=None):
+        """New message in a DM room: register the DM, mark it unread and alert."""
+        if not room_id or not sender:
+            return
+        # Only care about DM rooms (format 'dm_user1_user2')
+        if not room_id.startswith("dm_"):
+            return
+        # If this message is from me, ignore
+        if sender == self.username:
+            return
+        # Membership: explicit participants on the message, then the
+        # registry, then an exact parse of the legacy room_id
+        if participants:
+            self.rooms.register_room_doc(room_id, participants)
+        if not self.rooms.is_member(room_id):
+            return
+        other = self.rooms.channel_for_room(room_id)
+        if other is None:
+            return
+
+        # ensure DM exists in left list
+        if other not in self.rooms:
+            self.rooms.register(other, room_id, (self.username, other))
+        self.chat_state.dispatch(add_dms, [other])
+
+        # If not currently viewing that channel, mark unread and play sound.
+        # mark_unread re-checks the active channel on the Tk thread.
+        if other != self.current_channel:
+            self.chat_state.dispatch(mark_unread, other)
+            # queued on the shared worker, which coalesces
+            # bursts and rate-limits the sound
+            get_notification_worker().submit(sender)
+
+    # --- SYNC PROCESS (config.SYNC_PROCESS) ---
+
+    def _start_sync(self):
+        """Стартира sync процеса (ако не работи) и започва да чете събитията му."""
+        try:
+            self._sync.start()
+        except Exception as e:
+            print(f"[ERROR] Неуспешно стартиране на sync процеса: {e}")
+            return
+        self._sync_scope = None
+        self._sync.login(self.username)
+        if self._sync_poll_job is None:
+            self._sync_poll_job = self.after(config.SYNC_POLL_MS, self._poll_sync)
+
+    def _stop_sync(self, shutdown=False):
+        if self._sync_poll_job is not None:
+            try:
+                self.after_cancel(self._sync_poll_job)
+            except Exception:
+                pass
+            self._sync_poll_job = None
+        self._sync_online = []
+        try:
+            if shutdown:
+                self._sync.stop()
+            elif self._sync.running:
+                self._sync.logout()
+        except Exception as e:
+            print(f"[WARN] Грешка при спиране на sync процеса: {e}")
+
+    def _poll_sync(self):
+        """Изпълнява чакащите събития от sync процеса на UI нишката."""
+        self._sync_poll_job = None
+        events = self._sync.poll()
+        for event in events:
+            try:
+                self._on_sync_event(event)
+            except Exception as e:
+                print(f"[WARN] Грешка при обработка на sync събитие {event[0]}: {e}")
+        # a full batch means more are waiting: come back right after Tk idles
+        delay = 1 if len(events) >= config.SYNC_POLL_BATCH else config.SYNC_POLL_MS
+        self._sync_poll_job = self.after(delay, self._poll_sync)
+
+    def _on_sync_event(self, event):
+        kind = event[0]
+        if kind in ("history", "changes"):
+            room_id, generation = event[1], event[2]
+            if not self._sync.is_current(generation):
+                return  # room switched since this was sent
+            if kind == "history":
+                self._update_ui_with_new_messages([expand_message(m) for m in event[3]])
+            else:
+                added, modified, removed = event[3:]
+                self._publish_message_changes(
+                    room_id,
+                    [expand_message(m) for m in added],
+                    [expand_message(m) for m in modified],
+                    removed,
+                )
+        elif kind == "presence":
+            self._sync_online = event[1]
+            self.events.publish(PresenceChanged(event[1]))
+        elif kind == "dm":
+            self._on_incoming_dm(*event[1:])
+        elif kind == "ready" and not event[1]:
+            print("[ERROR] Sync процесът не успя да инициализира Firestore.")
+
+    def _handle_message_change(self, col_snapshot, changes, read_time, room_id=None):
         """Обработва промените в съобщенията и ги добавя в чат историята."""
         try:
             docs_len = len(col_snapshot)
@@ -1167,53 +1919,234 @@ class AuthApp(ctk.CTk):
         # Обработка на промените
         print(f"[LOG] Listener: Получени нови промени: {len(changes)}")
 
-        # Филтрираме само НОВИ ДОБАВЕНИ съобщения и прикачваме doc id за дедупликация
-        new_messages = []
+        # Разделяме промените по тип и прикачваме doc id за дедупликация
+        new_messages, modified, removed = [], [], []
         for change in changes:
             try:
-                if change.type.name == "ADDED":
-                    d = change.document.to_dict()
-                    # attach document id if available
-                    try:
-                        d["_id"] = change.document.id
-                    except Exception:
-                        pass
+                kind = change.type.name
+                if kind == "REMOVED":
+                    # archived by compaction, not deleted: keep it shown
+                    timestamp = (change.document.to_dict() or {}).get("timestamp")
+                    if not compacted(timestamp):
+                        removed.append(change.document.id)
+                    continue
+                d = change.document.to_dict()
+                # attach document id if available
+                try:
+                    d["_id"] = change.document.id
+                except Exception:
+                    pass
+                if kind == "ADDED":
                     new_messages.append(d)
+                elif kind == "MODIFIED":
+                    modified.append(d)
             except Exception:
                 continue
 
+        # the bus runs the UI updates on the main thread
+        self._publish_message_changes(room_id, new_messages, modified, removed)
+
+    def _publish_message_changes(self, room_id, new_messages, modified, removed):
+        """Публикува REMOVED/MODIFIED/ADDED промените (в този ред) към шината."""
+        if removed:
+            self.events.publish(MessagesRemoved(room_id, removed))
+        if modified:
+            self.events.publish(MessagesModified(room_id, modified))
         if new_messages:
-            # Изпълняваме UI обновяването в главната нишка
-            self.after(0, lambda: self._update_ui_with_new_messages(new_messages))
+            self.events.publish(MessagesAdded(room_id, new_messages))
 
-    def _update_ui_with_new_messages(self, messages):
-        """Безопасно вмъква нови съобщения в UI и принудително обновява."""
+    def _is_current_room(self, room_id):
+        """Дали room_id е стаята на активния канал.
 
+        Deliveries are queued with after(0), so one from the previous room's
+        listener can still arrive after switch_channel cleared the view.
+        """
+        return room_id == self.rooms.room_for_channel(self.current_channel)
+
+    def _on_messages_removed(self, event):
+        if not self._is_current_room(event.room_id):
+            return
+        recent = self._recent_messages.get(self.current_channel, {})
+        for msg_id in event.ids:
+            self._remove_rendered_message(msg_id)
+            recent.pop(msg_id, None)
+
+    def _on_messages_modified(self, event):
+        """Прилага MODIFIED промени на място, без презареждане."""
+        if not self._is_current_room(event.room_id):
+            return
+        for data in event.messages:
+            self._replace_rendered_message(data)
+
+    def _on_messages_added(self, event):
+        if self._is_current_room(event.room_id):
+            self._update_ui_with_new_messages(event.messages, trim_scrollback=True)
+
+    def _on_send_acked(self, event):
+        # the user may have switched rooms while the write was in flight
+        if self._is_current_room(event.room_id):
+            self._update_ui_with_new_messages([event.message], trim_scrollback=True)
+
+    def _clear_chat_history(self):
+        """Изчиства чат полето заедно с позиционните маркери и показаните id-та."""
         self.chat_history.configure(state="normal")
+        self.chat_history.delete("1.0", tk.END)
+        for _, (start_mark, end_mark) in self._message_window.items():
+            self.chat_history.mark_unset(start_mark, end_mark)
+        self.chat_history.configure(state="disabled")
+        self._message_window.clear()
+        self._unconfirmed.clear()
 
-        for data in messages:
-            # Deduplicate by document id when available
-            msg_id = data.get("_id") or data.get("id")
-            if msg_id and msg_id in self._displayed_message_ids:
-                # already displayed (optimistic insert or previous load)
-                continue
+    def _track_message(self, msg_id, start_index, end_index="end-1c", above=False):
+        """Слага маркери около вмъкнато съобщение (start_index .. end_index).
 
-            # Използваме skip_scroll=True за бързо вмъкване
-            self._insert_message_to_history(data, skip_scroll=True)
+        Start marks have right gravity and end marks left gravity, so text
+        inserted at a boundary never widens a neighbouring message's range.
+        `above=True` records a message of an older page inserted at the top.
+        """
+        start_mark, end_mark = f"msg_s_{msg_id}", f"msg_e_{msg_id}"
+        self.chat_history.mark_set(start_mark, start_index)
+        self.chat_history.mark_gravity(start_mark, "right")
+        self.chat_history.mark_set(end_mark, end_index)
+        self.chat_history.mark_gravity(end_mark, "left")
+        if above:
+            self._message_window.add_above(msg_id, (start_mark, end_mark))
+        else:
+            self._message_window.add(msg_id, (start_mark, end_mark))
+
+    def _replace_rendered_message(self, data):
+        """Пренаписва на място вече показано съобщение (MODIFIED). O(1) по doc id."""
+        msg_id = data.get("_id")
+        marks = self._message_window.marks(msg_id)
+        if marks is None:
+            return False
+        start_mark, end_mark = marks
+        self.chat_history.configure(state="normal")
+        start_index = self.chat_history.index(start_mark)
+        self.chat_history.delete(start_mark, end_mark)
+        self.chat_history.mark_set("msg_edit", start_index)
+        self.chat_history.mark_gravity("msg_edit", "right")
+        self._insert_message_to_history(data, skip_scroll=True, index=start_index)
+        # text before start_index is unchanged, so the absolute index still holds
+        self.chat_history.mark_set(start_mark, start_index)
+        self.chat_history.mark_set(end_mark, "msg_edit")
+        self.chat_history.mark_unset("msg_edit")
+        self.chat_history.configure(state="disabled")
+        return True
+
+    def _remove_rendered_message(self, msg_id):
+        """Премахва показано съобщение (REMOVED) по doc id."""
+        marks = self._message_window.remove(msg_id)
+        if marks is None:
+            return False
+        start_mark, end_mark = marks
+        self.chat_history.configure(state="normal")
+        self.chat_history.delete(start_mark, end_mark)
+        self.chat_history.mark_unset(start_mark, end_mark)
+        self.chat_history.configure(state="disabled")
+        return True
 
-            # Mark as displayed if id available
-            if msg_id:
-                try:
-                    self._displayed_message_ids.add(msg_id)
-                except Exception:
-                    pass
+    def _trim_scrollback(self):
+        """Маха най-старите съобщения над лимита на scrollback-а (текст + индекс)."""
+        evicted = self._message_window.overflow()
+        if not evicted:
+            return
+        # Everything above the newest evicted message goes in one delete
+        self.chat_history.delete("1.0", evicted[-1][1][1])
+        for _, (start_mark, end_mark) in evicted:
+            self.chat_history.mark_unset(start_mark, end_mark)
+        # the pager's cursor is older than the new top row
+        self.events.publish(
+            ScrollbackTrimmed(self.current_channel, [msg_id for msg_id, _ in evicted])
+        )
+
+    def _view_at_bottom(self):
+        """Дали чатът е превъртян до най-новите съобщения."""
+        try:
+            return self.chat_history.yview()[1] >= 1.0
+        except Exception:
+            return True
+
+    def _update_ui_with_new_messages(self, messages, trim_scrollback=False):
+        """Безопасно вмъква нови съобщения в UI и принудително обновява.
+
+        Live appends pass `trim_scrollback=True`; history loads don't, so
+        pages the user scrolled back to stay visible. A live append neither
+        trims nor scrolls while the user reads further up.
+        """
+        follow = not trim_scrollback or self._view_at_bottom()
+
+        # Text and tag runs for the whole batch are built in Python (deduped by
+        # doc id against the rendered window) and pushed in one Tk call
+        batch = build_batch(messages, self.username, self._message_window)
+        rendered = {msg_id for msg_id, _, _ in batch.entries if msg_id}
+        self._remember_messages(
+            self.current_channel,
+            [m for m in messages if (m.get("_id") or m.get("id")) in rendered],
+        )
 
+        self.chat_history.configure(state="normal")
+        if batch:
+            # the widget always ends right after a message's newline, so
+            # "end-1c" is the start of a line and messages land line by line
+            base_line = int(self.chat_history.index("end-1c").split(".")[0])
+            # CTkTextbox.insert only forwards one text/tags pair, so the
+            # multi-segment insert goes to the underlying tk.Text
+            self.chat_history._textbox.insert(tk.END, *batch.segments)
+            for msg_id, offset, line_count in batch.entries:
+                if msg_id:
+                    start = base_line + offset
+                    self._track_message(msg_id, f"{start}.0", f"{start + line_count}.0")
+
+        if trim_scrollback and follow:
+            self._trim_scrollback()
         self.chat_history.configure(state="disabled")
 
         # Принудително обновяване, за да се гарантира, че съобщенията се показват
         self.chat_history.update_idletasks()
-        self.chat_history.see(tk.END)
-        print(f"[LOG] UI Update: Успешно вмъкнати {len(messages)} нови съобщения.")
+        if follow:
+            self.chat_history.see(tk.END)
+        print(f"[LOG] UI Update: Успешно вмъкнати {len(batch.entries)} нови съобщения.")
+
+        if self.current_channel == "lobby":
+            self._note_lobby_senders(messages)
+
+    def _merge_history(self, history):
+        """Рендерира история около вече показаните съобщения (напр. кеширана страница).
+
+        Messages older than the first one already on screen go above it, the
+        rest are appended (already shown ones are skipped), so a prefetched
+        page rendered first does not push older history below it.
+        """
+        split = next(
+            (i for i, m in enumerate(history) if m.get("_id") in self._message_window),
+            len(history),
+        )
+        if 0 < split < len(history):
+            self._prepend_history(history[:split])
+            history = history[split:]
+        self._update_ui_with_new_messages(history)
+
+    def _prepend_history(self, messages):
+        """Вмъква по-стара страница най-отгоре, без да мести видимата част."""
+        batch = build_batch(messages, self.username, self._message_window)
+        if not batch:
+            return
+        text = self.chat_history._textbox
+        # keep the line at the top of the viewport where the user sees it
+        top_line = int(text.index("@0,0").split(".")[0])
+        self.chat_history.configure(state="normal")
+        text.insert("1.0", *batch.segments)
+        # newest first, so the window stays in render order
+        for msg_id, offset, line_count in reversed(batch.entries):
+            if msg_id:
+                start = 1 + offset
+                self._track_message(
+                    msg_id, f"{start}.0", f"{start + line_count}.0", above=True
+                )
+        self.chat_history.configure(state="disabled")
+        text.yview(f"{top_line + batch.lines}.0")
+        print(f"[LOG] UI Update: Добавени {len(batch.entries)} по-стари съобщения.")
 
     def _load_initial_history(self, col_snapshot):
         """Зарежда цялата история еднократно."""
@@ -1223,8 +2156,8 @@ class AuthApp(ctk.CTk):
             total = sum(1 for _ in col_snapshot)
 
         print(f"[LOG] UI Update: Започва зареждане на {total} съобщения в историята.")
+        self._clear_chat_history()
         self.chat_history.configure(state="normal")
-        self.chat_history.delete("1.0", tk.END)
         count = 0
 
         # Normalize snapshot items to dicts and sort by timestamp when possible
@@ -1274,37 +2207,15 @@ class AuthApp(ctk.CTk):
             f"[LOG] UI Update: Успешно заредени {count} съобщения. Скролиране до края."
         )
 
-    def _insert_message_to_history(self, data, skip_scroll=False):
-        """Вмъква съобщение в текстовото поле на чата."""
+    def _insert_message_to_history(self, data, skip_scroll=False, index=tk.END):
+        """Вмъква съобщение в текстовото поле на чата (по подразбиране в края)."""
         username = data.get("username", "???")
         message_text = data.get("text", "")
 
         # Определяме тага за форматиране
-        tag = "user_msg" if username == self.username else "other_msg"
-
-        timestamp = data.get("timestamp")
-        time_str = "[--:--]"
-
-        # Handle various timestamp representations from Firestore
-        if timestamp:
-            try:
-                # native python datetime
-                if hasattr(timestamp, "strftime"):
-                    dt = timestamp
-                # protobuf Timestamp (google.protobuf.Timestamp)
-                elif hasattr(timestamp, "ToDatetime"):
-                    dt = timestamp.ToDatetime()
-                # some SDKs return an object with .seconds
-                elif hasattr(timestamp, "seconds"):
-                    dt = datetime.fromtimestamp(timestamp.seconds, tz=timezone.utc)
-                else:
-                    dt = None
-
-                if dt:
-                    # display local time if possible (UTC fallback)
-                    time_str = f"[{dt.strftime('%H:%M')}]"
-            except Exception:
-                time_str = "[--:--]"
+        tag = USER_TAG if username == self.username else OTHER_TAG
+        # cached "[HH:MM]" (handles the various Firestore timestamp shapes)
+        time_str = time_label(data.get("timestamp"))
 
         # --- ДОБАВЕН ЛОГ ---
         print(
@@ -1312,10 +2223,16 @@ class AuthApp(ctk.CTk):
         )
         # --- КРАЙ НА ДОБАВЕН ЛОГ ---
 
-        # Вмъкваме частта с времето и името с тага
-        self.chat_history.insert(tk.END, f"{time_str} {username}: ", tag)
-        # Вмъкваме текста на съобщението без таг (за да остане в основния цвят)
-        self.chat_history.insert(tk.END, f"{message_text}\n")
+        prefix = f"{time_str} {username}: "
+        if index == tk.END:
+            # Вмъкваме частта с времето и името с тага
+            self.chat_history.insert(tk.END, prefix, tag)
+            # Вмъкваме текста на съобщението без таг (за да остане в основния цвят)
+            self.chat_history.insert(tk.END, f"{message_text}\n")
+        else:
+            # При вмъкване по средата: първо текста, после префикса пред него
+            self.chat_history.insert(index, f"{message_text}\n")
+            self.chat_history.insert(index, prefix, tag)
 
         if not skip_scroll:
             self.chat_history.update_idletasks()
@@ -1323,6 +2240,10 @@ class AuthApp(ctk.CTk):
 
 
 if __name__ == "__main__":
+    # frozen (PyInstaller) builds: a spawned sync worker runs here and exits
+    # instead of starting another GUI
+    multiprocessing.freeze_support()
+    init_app()
     app = AuthApp()
     try:
         app.mainloop()
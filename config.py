@@ -25,6 +25,148 @@ KEY_JSON_PATH = os.getenv(
     "GOOGLE_APPLICATION_CREDENTIALS",
     os.path.join(os.path.dirname(__file__), "key.json"),
 )
+# Per-user application data (persisted auth session, caches)
+APP_DATA_DIR = os.getenv(
+    "MIRCTEST_DATA_DIR", os.path.join(os.path.expanduser("~"), ".mirctest")
+)
+
+# --- AUTH ---
+# Refresh the ID token this many seconds before it expires
+AUTH_REFRESH_MARGIN = float(os.getenv("AUTH_REFRESH_MARGIN", "300"))
+AUTH_HTTP_TIMEOUT = float(os.getenv("AUTH_HTTP_TIMEOUT", "15"))
+
+# --- PRESENCE ---
+# Heartbeat keep-alive intervals (seconds) per user state; each wait is spread
+# by +/- PRESENCE_JITTER so clients don't write in lockstep.
+PRESENCE_INTERVAL_ACTIVE = float(os.getenv("PRESENCE_INTERVAL_ACTIVE", "30"))
+PRESENCE_INTERVAL_IDLE = float(os.getenv("PRESENCE_INTERVAL_IDLE", "90"))
+PRESENCE_INTERVAL_HIDDEN = float(os.getenv("PRESENCE_INTERVAL_HIDDEN", "120"))
+# Seconds without keyboard/mouse input before the user counts as idle
+PRESENCE_IDLE_AFTER = float(os.getenv("PRESENCE_IDLE_AFTER", "300"))
+PRESENCE_JITTER = float(os.getenv("PRESENCE_JITTER", "0.2"))
+# Freshness window (seconds): presence docs with an older `last_seen` count as
+# offline. Must exceed the longest heartbeat interval plus jitter.
+PRESENCE_TTL = float(os.getenv("PRESENCE_TTL", "180"))
+# How often the client re-checks the roster for expired entries (seconds)
+PRESENCE_EXPIRE_TICK = float(os.getenv("PRESENCE_EXPIRE_TICK", "15"))
+# Minimum seconds between stale presence cleanups (shared across clients)
+PRESENCE_CLEANUP_INTERVAL = float(os.getenv("PRESENCE_CLEANUP_INTERVAL", "3600"))
+# "scoped": watch only DM partners and recent room members (default)
+# "collection": watch every fresh presence doc
+# "aggregated": users share PRESENCE_SHARD_COUNT summary docs; size the shard
+# count so each shard sees well under one write per second
+PRESENCE_MODE = os.getenv("PRESENCE_MODE", "scoped")
+PRESENCE_SHARD_COUNT = int(os.getenv("PRESENCE_SHARD_COUNT", "8"))
+# Scoped mode: how many recent lobby senders to keep watching
+PRESENCE_SCOPE_LOBBY_SENDERS = int(os.getenv("PRESENCE_SCOPE_LOBBY_SENDERS", "50"))
+# Page size of the on-demand "all online" browser
+PRESENCE_BROWSE_PAGE = int(os.getenv("PRESENCE_BROWSE_PAGE", "50"))
+
+# --- NOTIFICATIONS ---
+# DM alerts arriving within this many seconds are collapsed into one toast
+NOTIFY_COALESCE_WINDOW = float(os.getenv("NOTIFY_COALESCE_WINDOW", "1.5"))
+# Minimum seconds between alert sounds
+NOTIFY_SOUND_INTERVAL = float(os.getenv("NOTIFY_SOUND_INTERVAL", "5"))
+NOTIFY_SOUND_FILE = os.getenv("NOTIFY_SOUND_FILE") or None
+
+# --- ROOM EXPORT / IMPORT ---
+# Messages read per page while exporting a room
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "500"))
+# Writes per Firestore batch on import (Firestore allows at most 500)
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "400"))
+# Batches committed in parallel on import
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", "4"))
+
+# --- MESSAGE ARCHIVE ---
+# Messages older than this many days are rolled into chunk documents
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+# Messages per chunk doc (chunk write + source deletes must fit one 500-write batch)
+ARCHIVE_CHUNK_SIZE = int(os.getenv("ARCHIVE_CHUNK_SIZE", "300"))
+# Stay well under Firestore's 1 MiB document limit
+ARCHIVE_CHUNK_MAX_BYTES = int(os.getenv("ARCHIVE_CHUNK_MAX_BYTES", "800000"))
+
+# --- FIRESTORE COST BUDGET ---
+# Per-session budgets for document reads / writes (0 = unlimited). Once
+# exceeded, optional background work (prefetch, cleanup, scope growth) pauses.
+COST_READ_BUDGET = int(os.getenv("COST_READ_BUDGET", "0"))
+COST_WRITE_BUDGET = int(os.getenv("COST_WRITE_BUDGET", "0"))
+
+# --- LISTENER SUPERVISION ---
+# Seconds between listener health checks
+LISTENER_CHECK_INTERVAL = float(os.getenv("LISTENER_CHECK_INTERVAL", "10"))
+# A (re)subscribed listener with no first snapshot after this long is stalled
+LISTENER_STALL_TIMEOUT = float(os.getenv("LISTENER_STALL_TIMEOUT", "30"))
+# Exponential resubscribe backoff: base * 2^(failures-1), capped
+LISTENER_BACKOFF_BASE = float(os.getenv("LISTENER_BACKOFF_BASE", "1"))
+LISTENER_BACKOFF_MAX = float(os.getenv("LISTENER_BACKOFF_MAX", "60"))
+
+# --- BACKGROUND TASKS ---
+# Concurrent background loads (history pages, prefetch); the rest queue
+TASK_MAX_WORKERS = int(os.getenv("TASK_MAX_WORKERS", "4"))
+# After login the newest history page of up to DM_PREFETCH_COUNT recently
+# active DM rooms (from the newest DM_PREFETCH_SCAN DM messages) is fetched in
+# the background, within DM_PREFETCH_READ_BUDGET document reads (0 = off)
+DM_PREFETCH_COUNT = int(os.getenv("DM_PREFETCH_COUNT", "5"))
+DM_PREFETCH_SCAN = int(os.getenv("DM_PREFETCH_SCAN", "50"))
+DM_PREFETCH_READ_BUDGET = int(os.getenv("DM_PREFETCH_READ_BUDGET", "300"))
+
+# --- SYNC PROCESS ---
+# "1": listeners, decoding and the message cache run in a separate process
+SYNC_PROCESS = os.getenv("SYNC_PROCESS", "0") == "1"
+# Rooms whose recent messages the sync process keeps cached (LRU)
+SYNC_CACHE_ROOMS = int(os.getenv("SYNC_CACHE_ROOMS", "20"))
+# UI drains at most SYNC_POLL_BATCH events every SYNC_POLL_MS milliseconds
+SYNC_POLL_MS = int(os.getenv("SYNC_POLL_MS", "50"))
+SYNC_POLL_BATCH = int(os.getenv("SYNC_POLL_BATCH", "50"))
+
+# --- IRC GATEWAY ---
+# `python -m src.cli irc` serves IRC clients here (#lobby + DMs)
+IRC_HOST = os.getenv("IRC_HOST", "127.0.0.1")
+IRC_PORT = int(os.getenv("IRC_PORT", "6667"))
+IRC_SERVER_NAME = os.getenv("IRC_SERVER_NAME", "mirctest")
+# Clients must sign in with their account before NICK/USER registers them:
+# PASS <email>:<password>, or PASS <password> with the nick's email on
+# IRC_EMAIL_DOMAIN. The nick must be the account's username.
+IRC_AUTH = os.getenv("IRC_AUTH", "1") == "1"
+IRC_EMAIL_DOMAIN = os.getenv("IRC_EMAIL_DOMAIN", "")
+
+# --- MESSAGE STORE / RELAY ---
+# Message backend for the GUI (send, history, room/DM streams, room delete),
+# the IRC gateway and tools: "firestore", "relay" or "memory". Sign-in, presence
+# and the sidebar's room index stay on Firebase.
+MESSAGE_STORE = os.getenv("MESSAGE_STORE", "firestore")
+# `python -m src.cli relay` serves a SQLite-backed store on the LAN
+RELAY_HOST = os.getenv("RELAY_HOST", "127.0.0.1")
+RELAY_PORT = int(os.getenv("RELAY_PORT", "7070"))
+RELAY_DB_PATH = os.getenv("RELAY_DB_PATH", os.path.join(APP_DATA_DIR, "relay.sqlite3"))
+# seconds a relay client waits for a reply
+RELAY_TIMEOUT = float(os.getenv("RELAY_TIMEOUT", "5"))
+# Shared secret. The server and service clients (the IRC gateway) use it
+# as is; a user's client uses the token derived for that user
+# (`python -m src.cli relay --token-for <username>`) and only sees their DMs.
+RELAY_TOKEN = os.getenv("RELAY_TOKEN", "")
+
+# --- CHAT VIEW ---
+# Live messages beyond this many rendered ones trim the oldest from scrollback
+CHAT_SCROLLBACK_LIMIT = int(os.getenv("CHAT_SCROLLBACK_LIMIT", "500"))
+# Warm start: a per-user session snapshot (DMs, unread, recent messages) is
+# saved on exit and every SNAPSHOT_INTERVAL_MS, and painted after login
+SESSION_SNAPSHOT = os.getenv("SESSION_SNAPSHOT", "1") == "1"
+SNAPSHOT_INTERVAL_MS = int(os.getenv("SNAPSHOT_INTERVAL_MS", "60000"))
+SNAPSHOT_MESSAGES_PER_ROOM = int(os.getenv("SNAPSHOT_MESSAGES_PER_ROOM", "30"))
+# Scrolling within this fraction of the top of the loaded history shows the
+# next older page; up to HISTORY_READAHEAD_PAGES are prefetched in background
+HISTORY_PREFETCH_THRESHOLD = float(os.getenv("HISTORY_PREFETCH_THRESHOLD", "0.15"))
+HISTORY_READAHEAD_PAGES = int(os.getenv("HISTORY_READAHEAD_PAGES", "1"))
+
+# --- CONVERSATION INDEX ---
+# Per-user `user_conversations/<username>` doc maintained on send: the sidebar
+# loads with one read and follows one small listener. With it on, the
+# collection-wide DM listener is not started, so DMs written by clients that
+# predate the index are only seen when their room is opened.
+CONVERSATION_INDEX = os.getenv("CONVERSATION_INDEX", "1") == "1"
+CONVERSATION_PREVIEW_CHARS = int(os.getenv("CONVERSATION_PREVIEW_CHARS", "80"))
+
 # --- COLORS ---
 COLOR_PRIMARY = "#3498db"
 COLOR_SECONDARY = "#2ecc71"
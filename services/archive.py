@@ -0,0 +1,285 @@
+"""Message archive: cold messages rolled into chunk documents.
+
+`compact_room` moves messages older than `config.ARCHIVE_AFTER_DAYS` out of
+`messages` into `message_chunks` docs holding a few hundred messages each
+(`{room_id, first_ts, last_ts, count, messages: [...]}`); each chunk is
+written and its source messages deleted in one batch, so a message is never
+lost or duplicated. Compaction always takes the oldest messages first, so
+every chunk is older than every live message of the room. A message too large
+for any chunk stops compaction of its room: it stays live, and so does
+everything newer, so that ordering still holds.
+
+`read_history` pages backwards through a room: live messages first, then
+chunks, newest first. Old history then costs one read per chunk instead of
+one read per message.
+
+Room listeners see compaction's deletes as REMOVED changes; `compacted()`
+tells them apart from real deletions, so archived messages stay on screen.
+"""
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional, Tuple
+
+import config
+import services.firestore_client as fc
+from services.rooms import dm_room_ids
+
+CHUNKS_COLLECTION = "message_chunks"
+# allows for clock skew between a client and the host running compaction
+ARCHIVE_CLOCK_SLACK = timedelta(hours=1)
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _sort_key(ts) -> float:
+    if ts is None:
+        return 0.0
+    if hasattr(ts, "timestamp"):
+        return ts.timestamp()
+    return 0.0
+
+
+def compacted(timestamp, now: Optional[datetime] = None) -> bool:
+    """Whether a removed message this old was moved into a chunk.
+
+    Compaction is the only thing that deletes single messages, and only once
+    they are `config.ARCHIVE_AFTER_DAYS` old; deleting a whole room also
+    removes newer ones.
+    """
+    if not isinstance(timestamp, datetime):
+        return False
+    cutoff = (
+        (now or _utcnow())
+        - timedelta(days=config.ARCHIVE_AFTER_DAYS)
+        + ARCHIVE_CLOCK_SLACK
+    )
+    try:
+        return timestamp < cutoff
+    except TypeError:  # naive timestamp
+        return False
+
+
+def chunk_id(room_id: str, first_ts: datetime, first_id: str) -> str:
+    """Deterministic chunk doc id, so a retried compaction overwrites itself."""
+    return f"{room_id}_{int(first_ts.timestamp() * 1000):013d}_{first_id}"
+
+
+def build_chunk(
+    room_id: str, docs: Iterable, max_bytes: Optional[int] = None
+) -> Tuple[Optional[dict], list]:
+    """Pack message snapshots (oldest first) into one chunk payload.
+
+    Returns (chunk, packed_docs); stops early when the payload would exceed
+    `max_bytes`, and before a message that alone exceeds it (such a message is
+    left live). `chunk` is None if nothing could be packed.
+    """
+    max_bytes = max_bytes or config.ARCHIVE_CHUNK_MAX_BYTES
+    messages, packed, size = [], [], 0
+    for doc in docs:
+        data = dict(doc.to_dict() or {})
+        data.pop("room_id", None)
+        data["_id"] = doc.id
+        entry_size = len(json.dumps(data, default=str, ensure_ascii=False))
+        if entry_size > max_bytes:
+            print(
+                f"[WARN] Archive: message {doc.id} in {room_id} is larger than "
+                f"a chunk ({entry_size} bytes); it and newer messages stay live"
+            )
+            break
+        if size + entry_size > max_bytes:
+            break
+        messages.append(data)
+        packed.append(doc)
+        size += entry_size
+    if not messages:
+        return None, []
+    chunk = {
+        "room_id": room_id,
+        "first_ts": messages[0].get("timestamp"),
+        "last_ts": messages[-1].get("timestamp"),
+        "count": len(messages),
+        "messages": messages,
+    }
+    return chunk, packed
+
+
+def _fetch_cold(db, room_id: str, cutoff: datetime, limit: int) -> list:
+    return list(
+        db.collection("messages")
+        .where("room_id", "==", room_id)
+        .where("timestamp", "<", cutoff)
+        .order_by("timestamp", direction=fc.firestore.Query.ASCENDING)
+        .limit(limit)
+        .get()
+    )
+
+
+def compact_room(
+    room_id: str,
+    older_than_days: Optional[float] = None,
+    chunk_size: Optional[int] = None,
+    now: Optional[datetime] = None,
+) -> int:
+    """Roll messages of `room_id` older than `older_than_days` into chunks.
+
+    Returns the number of messages moved.
+    """
+    db = fc.get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    days = config.ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    chunk_size = min(chunk_size or config.ARCHIVE_CHUNK_SIZE, 499)
+    cutoff = (now or _utcnow()) - timedelta(days=days)
+
+    moved = 0
+    while True:
+        docs = _fetch_cold(db, room_id, cutoff, chunk_size)
+        chunk, packed = build_chunk(room_id, docs)
+        if chunk is None:
+            break
+        batch = db.batch()
+        ref = db.collection(CHUNKS_COLLECTION).document(
+            chunk_id(room_id, chunk["first_ts"], packed[0].id)
+        )
+        batch.set(ref, chunk)
+        for doc in packed:
+            batch.delete(doc.reference)
+        batch.commit()
+        moved += len(packed)
+        if len(docs) < chunk_size and len(packed) == len(docs):
+            break
+    return moved
+
+
+def compact_all(older_than_days: Optional[float] = None) -> dict:
+    """Compact the lobby, every room in `rooms` and every DM room found in
+    `messages` (legacy ones have no `rooms` doc). Returns {room_id: moved}."""
+    db = fc.get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    rooms = {d.id for d in db.collection("rooms").get()} | set(dm_room_ids())
+    room_ids = ["lobby"] + sorted(rooms)
+    return {room_id: compact_room(room_id, older_than_days) for room_id in room_ids}
+
+
+def iter_chunks(room_id: str, page_size: int = 20):
+    """Yield a room's chunk docs oldest first (used by the room export)."""
+    db = fc.get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    base = (
+        db.collection(CHUNKS_COLLECTION)
+        .where("room_id", "==", room_id)
+        .order_by("first_ts", direction=fc.firestore.Query.ASCENDING)
+        .limit(page_size)
+    )
+    last = None
+    while True:
+        q = base.start_after(last) if last is not None else base
+        docs = list(q.get())
+        for doc in docs:
+            yield doc
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
+
+
+def _message_from_chunk(room_id: str, entry: dict) -> dict:
+    data = dict(entry)
+    data["room_id"] = room_id
+    return data
+
+
+class HistoryCursor:
+    """Where `read_history` stopped: in the live messages or in the chunks."""
+
+    def __init__(self):
+        self.live_after = None
+        self.live_done = False
+        self.oldest_live_ts = None
+        self.chunk_after = None
+        self.chunks_done = False
+        # messages of the current chunk not returned yet, newest first
+        self.buffer: List[dict] = []
+
+    @property
+    def exhausted(self) -> bool:
+        return self.live_done and self.chunks_done and not self.buffer
+
+
+def _fetch_live(db, room_id: str, limit: int, start_after) -> list:
+    q = (
+        db.collection("messages")
+        .where("room_id", "==", room_id)
+        .order_by("timestamp", direction=fc.firestore.Query.DESCENDING)
+        .limit(limit)
+    )
+    if start_after is not None:
+        q = q.start_after(start_after)
+    return list(q.get())
+
+
+def _fetch_chunk(db, room_id: str, start_after) -> Optional[object]:
+    q = (
+        db.collection(CHUNKS_COLLECTION)
+        .where("room_id", "==", room_id)
+        .order_by("last_ts", direction=fc.firestore.Query.DESCENDING)
+        .limit(1)
+    )
+    if start_after is not None:
+        q = q.start_after(start_after)
+    docs = list(q.get())
+    return docs[0] if docs else None
+
+
+def read_history(
+    room_id: str, limit: int = 50, cursor: Optional[HistoryCursor] = None
+) -> Tuple[List[dict], Optional[HistoryCursor]]:
+    """Return (messages oldest first, cursor) for the next `limit` older messages.
+
+    Live messages come first, then archived chunks. Pass the returned cursor
+    back to continue; it is None once the room's history is exhausted.
+    Messages carry their doc id in `_id`.
+    """
+    db = fc.get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    cursor = cursor or HistoryCursor()
+    out: List[dict] = []
+
+    if not cursor.live_done:
+        docs = _fetch_live(db, room_id, limit, cursor.live_after)
+        for doc in docs:
+            data = doc.to_dict() or {}
+            data["_id"] = doc.id
+            out.append(data)
+        if docs:
+            cursor.live_after = docs[-1]
+            cursor.oldest_live_ts = out[-1].get("timestamp")
+        if len(docs) < limit:
+            cursor.live_done = True
+
+    while len(out) < limit and not (cursor.chunks_done and not cursor.buffer):
+        if not cursor.buffer:
+            chunk = _fetch_chunk(db, room_id, cursor.chunk_after)
+            if chunk is None:
+                cursor.chunks_done = True
+                break
+            cursor.chunk_after = chunk
+            entries = (chunk.to_dict() or {}).get("messages") or []
+            # a message compacted while we were paging may already be shown
+            oldest = _sort_key(cursor.oldest_live_ts)
+            cursor.buffer = [
+                _message_from_chunk(room_id, e)
+                for e in reversed(entries)
+                if cursor.oldest_live_ts is None
+                or _sort_key(e.get("timestamp")) <= oldest
+            ]
+        take = limit - len(out)
+        out.extend(cursor.buffer[:take])
+        cursor.buffer = cursor.buffer[take:]
+
+    out.reverse()
+    return out, (None if cursor.exhausted else cursor)
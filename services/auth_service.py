@@ -1,13 +1,144 @@
+"""Authentication service: Firebase email/password auth plus session handling.
+
+Auth calls go straight to the Firebase Auth REST API over one pooled
+`requests.Session` (the one pyrebase already creates). A signed-in session's
+refresh token is persisted (OS keyring when available, otherwise a
+user-only readable file under `config.APP_DATA_DIR`) so the next launch can
+restore it with a single token refresh instead of a full sign-in, and ID
+tokens are refreshed in the background shortly before they expire.
+"""
+import json
+import os
+import threading
+import time
 import traceback
 from typing import Optional
 
 import pyrebase
+import requests
 
 import config
 
+try:
+    import keyring
+except Exception:
+    keyring = None
+
+IDENTITY_URL = "https://identitytoolkit.googleapis.com/v1/accounts:{}?key={}"
+TOKEN_URL = "https://securetoken.googleapis.com/v1/token?key={}"
+KEYRING_SERVICE = "mIRCtest"
+# token endpoint errors meaning the stored refresh token can never work again
+REVOKED_TOKEN_ERRORS = {
+    "INVALID_REFRESH_TOKEN",
+    "TOKEN_EXPIRED",
+    "USER_DISABLED",
+    "USER_NOT_FOUND",
+}
+
+
+def _token_revoked(error: Exception) -> bool:
+    """Whether a refresh failure is Firebase rejecting the token (HTTP 400)."""
+    response = getattr(error, "response", None)
+    if not isinstance(error, requests.HTTPError) or response is None:
+        return False
+    if response.status_code != 400:
+        return False
+    try:
+        message = response.json()["error"]["message"]
+    except (ValueError, KeyError, TypeError):
+        return False
+    # e.g. "TOKEN_EXPIRED" or "INVALID_REFRESH_TOKEN : details"
+    return message.split(":")[0].strip() in REVOKED_TOKEN_ERRORS
+
+
+class AuthSession:
+    """A signed-in user: tokens plus the wall-clock time the ID token expires."""
+
+    def __init__(
+        self,
+        email: str,
+        local_id: str,
+        id_token: str,
+        refresh_token: str,
+        expires_in: float,
+    ):
+        self.email = email
+        self.local_id = local_id
+        self.id_token = id_token
+        self.refresh_token = refresh_token
+        self.expires_at = time.time() + float(expires_in)
+
+    @property
+    def username(self) -> str:
+        return self.email.split("@")[0]
+
+
+class SessionStore:
+    """Persists the refresh token between launches."""
+
+    def __init__(self, path: Optional[str] = None, use_keyring: bool = True):
+        self.path = path or os.path.join(config.APP_DATA_DIR, "session.json")
+        self.use_keyring = use_keyring and keyring is not None
+
+    def save(self, email: str, refresh_token: str):
+        record = {"email": email}
+        if self.use_keyring:
+            try:
+                keyring.set_password(KEYRING_SERVICE, email, refresh_token)
+                record["keyring"] = True
+            except Exception as e:
+                print(f"[WARN] Keyring unavailable, using session file: {e}")
+                record["refresh_token"] = refresh_token
+        else:
+            record["refresh_token"] = refresh_token
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        # create the file user-readable only before writing the token into it
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(record, f)
+        os.replace(tmp, self.path)
+
+    def load(self) -> Optional[dict]:
+        """Return {"email", "refresh_token"} or None."""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        email = record.get("email")
+        token = record.get("refresh_token")
+        if record.get("keyring") and keyring is not None and email:
+            try:
+                token = keyring.get_password(KEYRING_SERVICE, email)
+            except Exception as e:
+                print(f"[WARN] Keyring read failed: {e}")
+                token = None
+        if not email or not token:
+            return None
+        return {"email": email, "refresh_token": token}
+
+    def clear(self):
+        record = self.load()
+        if record and keyring is not None:
+            try:
+                keyring.delete_password(KEYRING_SERVICE, record["email"])
+            except Exception:
+                pass
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
 
 class AuthService:
-    def __init__(self, firebase_config: Optional[dict] = None):
+    def __init__(
+        self,
+        firebase_config: Optional[dict] = None,
+        store: Optional[SessionStore] = None,
+        http: Optional[requests.Session] = None,
+    ):
         self._config = firebase_config or config.FIREBASE_CONFIG
         self._firebase = None
         self._auth = None
@@ -17,16 +148,163 @@ class AuthService:
         except Exception as e:
             print(f"[ERROR] AuthService initialization failed: {e}")
             traceback.print_exc()
+        # one pooled HTTP session for every auth call
+        self._http = http or getattr(self._firebase, "requests", None)
+        if self._http is None:
+            self._http = requests.Session()
+        self._store = store or SessionStore()
+        self._session: Optional[AuthSession] = None
+        self._refresh_timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
 
     def get_auth(self):
         return self._auth
 
-    def sign_in(self, email: str, password: str):
-        if not self._auth:
-            raise RuntimeError("Auth not initialized")
-        return self._auth.sign_in_with_email_and_password(email, password)
+    @property
+    def session(self) -> Optional[AuthSession]:
+        return self._session
+
+    def _api_key(self) -> str:
+        return self._config["apiKey"]
+
+    def _identity_call(self, method: str, payload: dict) -> dict:
+        resp = self._http.post(
+            IDENTITY_URL.format(method, self._api_key()),
+            json=dict(payload, returnSecureToken=True),
+            timeout=config.AUTH_HTTP_TIMEOUT,
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    def sign_in(self, email: str, password: str, remember: bool = True):
+        data = self._identity_call(
+            "signInWithPassword", {"email": email, "password": password}
+        )
+        self._start_session(
+            AuthSession(
+                data.get("email", email),
+                data["localId"],
+                data["idToken"],
+                data["refreshToken"],
+                data.get("expiresIn", 3600),
+            ),
+            remember,
+        )
+        return data
+
+    def verify_password(self, email: str, password: str) -> bool:
+        """Check credentials without starting or persisting a session.
+
+        False when Firebase rejects them; network failures propagate.
+        """
+        try:
+            self._identity_call(
+                "signInWithPassword", {"email": email, "password": password}
+            )
+        except requests.HTTPError:
+            return False
+        return True
 
     def create_user(self, email: str, password: str):
-        if not self._auth:
-            raise RuntimeError("Auth not initialized")
-        return self._auth.create_user_with_email_and_password(email, password)
+        return self._identity_call("signUp", {"email": email, "password": password})
+
+    def restore_session(self) -> Optional[AuthSession]:
+        """Restore the persisted session with one token refresh, or return None.
+
+        The stored token is only forgotten when Firebase rejects it; after a
+        network failure (e.g. starting offline) the next launch tries again.
+        """
+        record = self._store.load()
+        if not record:
+            return None
+        try:
+            data = self._refresh_call(record["refresh_token"])
+        except Exception as e:
+            print(f"[WARN] Stored session could not be restored: {e}")
+            if _token_revoked(e):
+                self._store.clear()
+            return None
+        session = AuthSession(
+            record["email"],
+            data["user_id"],
+            data["id_token"],
+            data["refresh_token"],
+            data.get("expires_in", 3600),
+        )
+        self._start_session(session, remember=True)
+        return session
+
+    def _refresh_call(self, refresh_token: str) -> dict:
+        resp = self._http.post(
+            TOKEN_URL.format(self._api_key()),
+            data={"grant_type": "refresh_token", "refresh_token": refresh_token},
+            timeout=config.AUTH_HTTP_TIMEOUT,
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    def refresh(self) -> Optional[AuthSession]:
+        """Exchange the refresh token for a fresh ID token now."""
+        session = self._session
+        if session is None:
+            return None
+        data = self._refresh_call(session.refresh_token)
+        with self._lock:
+            session.id_token = data["id_token"]
+            rotated = data["refresh_token"] != session.refresh_token
+            session.refresh_token = data["refresh_token"]
+            session.expires_at = time.time() + float(data.get("expires_in", 3600))
+        if rotated and self._store.load():
+            self._store.save(session.email, session.refresh_token)
+        self._schedule_refresh()
+        return session
+
+    def id_token(self) -> Optional[str]:
+        session = self._session
+        return session.id_token if session else None
+
+    def _start_session(self, session: AuthSession, remember: bool):
+        with self._lock:
+            self._session = session
+        if remember:
+            try:
+                self._store.save(session.email, session.refresh_token)
+            except Exception as e:
+                print(f"[WARN] Session could not be persisted: {e}")
+        self._schedule_refresh()
+
+    def _schedule_refresh(self, retry_delay: Optional[float] = None):
+        self._cancel_refresh()
+        session = self._session
+        if session is None:
+            return
+        delay = retry_delay
+        if delay is None:
+            delay = session.expires_at - time.time() - config.AUTH_REFRESH_MARGIN
+        timer = threading.Timer(max(delay, 0), self._background_refresh)
+        timer.daemon = True
+        self._refresh_timer = timer
+        timer.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"[WARN] Background token refresh failed: {e}")
+            self._schedule_refresh(retry_delay=60)
+
+    def _cancel_refresh(self):
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+
+    def sign_out(self):
+        """Drop the session, stop background refresh and forget stored tokens."""
+        self._cancel_refresh()
+        with self._lock:
+            self._session = None
+        self._store.clear()
+
+    def close(self):
+        """Stop background refresh but keep the persisted session."""
+        self._cancel_refresh()
@@ -0,0 +1,124 @@
+"""Per-user conversation index: `user_conversations/<username>`.
+
+One small document per user maps each DM room the user is in to a summary:
+
+    rooms.<room_id> = {participants, last_text, last_sender, last_ts,
+                       unread, read_at}
+
+Sending a DM updates every participant's entry in one batch (the sender's
+unread is reset, everyone else's incremented), so the sidebar loads with a
+single document read at login and stays current through one listener on
+that document instead of a collection-wide message listener. Opening a room
+moves the user's read cursor (`read_at`) and resets the unread count; every
+device of the user follows the same document, so reads sync across them.
+
+The first DM a user receives creates their document with just that room, so
+until the document carries `seeded: true` the client merges in the user's
+`rooms/<room_id>` metadata docs and the DM rooms found in `messages` (see
+`services.rooms.load_rooms_for_user` and `scan_dm_rooms`), so conversations
+from before either existed are kept.
+"""
+from typing import Dict, Iterable, Optional, Tuple
+
+import config
+import services.firestore_client as fc
+
+CONVERSATIONS_COLLECTION = "user_conversations"
+
+
+def _db():
+    db = fc.get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    return db
+
+
+def conversations_ref(username: str):
+    return _db().collection(CONVERSATIONS_COLLECTION).document(username)
+
+
+def preview(text: Optional[str], limit: Optional[int] = None) -> str:
+    """First line of `text`, cut to `limit` characters."""
+    limit = config.CONVERSATION_PREVIEW_CHARS if limit is None else limit
+    lines = (text or "").strip().splitlines()
+    line = lines[0] if lines else ""
+    return line if len(line) <= limit else line[: limit - 1] + "…"
+
+
+def record_message(room_id: str, sender: str, text: str, participants: Iterable[str]):
+    """Update every participant's entry for a message sent to `room_id`."""
+    db = _db()
+    participants = sorted(participants)
+    summary = {
+        "participants": participants,
+        "last_text": preview(text),
+        "last_sender": sender,
+        "last_ts": fc.firestore.SERVER_TIMESTAMP,
+    }
+    batch = db.batch()
+    for user in participants:
+        unread = 0 if user == sender else fc.firestore.Increment(1)
+        batch.set(
+            db.collection(CONVERSATIONS_COLLECTION).document(user),
+            {"rooms": {room_id: dict(summary, unread=unread)}},
+            merge=True,
+        )
+    batch.commit()
+
+
+def mark_read(username: str, room_id: str):
+    """Move the user's read cursor in `room_id` to now."""
+    conversations_ref(username).set(
+        {"rooms": {room_id: {"unread": 0, "read_at": fc.firestore.SERVER_TIMESTAMP}}},
+        merge=True,
+    )
+
+
+def unread_count(entry: dict) -> int:
+    """Unread messages of an index entry; none past the read cursor."""
+    read_at, last_ts = entry.get("read_at"), entry.get("last_ts")
+    if read_at is not None and last_ts is not None and read_at >= last_ts:
+        return 0
+    try:
+        return max(int(entry.get("unread") or 0), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def forget(username: str, room_id: str):
+    """Drop `room_id` from the user's index (the chat was deleted)."""
+    conversations_ref(username).update(
+        {f"rooms.`{room_id}`": fc.firestore.DELETE_FIELD}
+    )
+
+
+def seed(username: str, rooms: Iterable[Tuple[str, Iterable[str]]]):
+    """Merge room metadata [(room_id, participants)] into the index and mark it
+    seeded. Entries already in the index keep their summary and unread count."""
+    entries = {
+        room_id: {"participants": sorted(participants)}
+        for room_id, participants in rooms
+    }
+    conversations_ref(username).set({"rooms": entries, "seeded": True}, merge=True)
+
+
+def is_seeded(doc) -> bool:
+    """Whether the user's index was completed from their room metadata."""
+    if doc is None or not getattr(doc, "exists", False):
+        return False
+    return bool((doc.to_dict() or {}).get("seeded"))
+
+
+def entries_from_doc(doc) -> Optional[Dict[str, dict]]:
+    """room_id -> summary for a conversations doc snapshot; None if missing."""
+    if doc is None or not getattr(doc, "exists", False):
+        return None
+    rooms = (doc.to_dict() or {}).get("rooms") or {}
+    return {
+        room_id: entry for room_id, entry in rooms.items() if isinstance(entry, dict)
+    }
+
+
+def load_conversations(username: str) -> Optional[Dict[str, dict]]:
+    """The user's index (one read); None when it was never created."""
+    return entries_from_doc(conversations_ref(username).get())
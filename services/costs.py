@@ -0,0 +1,269 @@
+"""Firestore cost accounting: reads, writes and listener events per feature.
+
+`init_firestore` wraps the Firestore client in `MeteredClient`, so every
+`get`/`stream`, write, batch commit and `on_snapshot` delivery is counted on
+the shared `CostMeter` under the current feature tag. Code paths declare
+their tag with `tagged("history")` (a context manager that also works as a
+decorator); listeners keep the tag that was active when they subscribed,
+because their callbacks run on Firestore's threads.
+
+Counts follow Firestore billing: a query read costs one read per document
+(minimum one), a listener delivery one read per changed document.
+
+The meter enforces the optional per-session budgets from
+`config.COST_READ_BUDGET` / `config.COST_WRITE_BUDGET`. Going over them does
+not block user actions; it makes `allow_background()` return False so
+optional background work backs off.
+"""
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+import config
+
+UNTAGGED = "untagged"
+
+_CHAIN_METHODS = {
+    "collection",
+    "collection_group",
+    "document",
+    "where",
+    "order_by",
+    "limit",
+    "limit_to_last",
+    "offset",
+    "select",
+    "start_at",
+    "start_after",
+    "end_at",
+    "end_before",
+}
+_WRITE_METHODS = {"set", "update", "delete", "create", "add"}
+
+_local = threading.local()
+
+
+def current_tag() -> str:
+    stack = getattr(_local, "tags", None)
+    return stack[-1] if stack else UNTAGGED
+
+
+@contextmanager
+def tagged(tag: str):
+    """Attribute Firestore calls made inside the block (or function) to `tag`."""
+    stack = getattr(_local, "tags", None)
+    if stack is None:
+        stack = _local.tags = []
+    stack.append(tag)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+class CostMeter:
+    """Thread-safe per-tag counters with optional read/write budgets."""
+
+    def __init__(
+        self,
+        read_budget: Optional[int] = None,
+        write_budget: Optional[int] = None,
+        on_exceeded: Optional[Callable[[str, int], None]] = None,
+    ):
+        self.read_budget = (
+            config.COST_READ_BUDGET if read_budget is None else read_budget
+        )
+        self.write_budget = (
+            config.COST_WRITE_BUDGET if write_budget is None else write_budget
+        )
+        self._on_exceeded = on_exceeded or self._warn_exceeded
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._by_tag: Dict[str, Dict[str, int]] = {}
+            self._totals = {"reads": 0, "writes": 0, "events": 0}
+            self._exceeded = set()
+
+    @staticmethod
+    def _warn_exceeded(kind: str, budget: int):
+        print(
+            f"[WARN] Firestore {kind} budget ({budget}) exceeded; "
+            "pausing background work."
+        )
+
+    def add(
+        self,
+        tag: Optional[str] = None,
+        reads: int = 0,
+        writes: int = 0,
+        events: int = 0,
+    ):
+        tag = tag or current_tag()
+        newly_exceeded = []
+        with self._lock:
+            row = self._by_tag.setdefault(tag, {"reads": 0, "writes": 0, "events": 0})
+            for key, n in (("reads", reads), ("writes", writes), ("events", events)):
+                row[key] += n
+                self._totals[key] += n
+            for kind, budget in (
+                ("reads", self.read_budget),
+                ("writes", self.write_budget),
+            ):
+                if (
+                    budget
+                    and self._totals[kind] > budget
+                    and kind not in self._exceeded
+                ):
+                    self._exceeded.add(kind)
+                    newly_exceeded.append((kind, budget))
+        for kind, budget in newly_exceeded:
+            self._on_exceeded(kind, budget)
+
+    def totals(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._totals)
+
+    def by_tag(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {tag: dict(row) for tag, row in self._by_tag.items()}
+
+    def over_budget(self) -> bool:
+        with self._lock:
+            return bool(self._exceeded)
+
+    def allow_background(self) -> bool:
+        """False once a budget is exceeded: skip optional background work."""
+        return not self.over_budget()
+
+    def summary(self) -> str:
+        rows = sorted(
+            self.by_tag().items(), key=lambda kv: kv[1]["reads"], reverse=True
+        )
+        totals = self.totals()
+        lines = [f"{'feature':<20} {'reads':>8} {'writes':>8} {'events':>8}"]
+        for tag, row in rows:
+            lines.append(
+                f"{tag:<20} {row['reads']:>8} {row['writes']:>8} {row['events']:>8}"
+            )
+        lines.append(
+            f"{'total':<20} {totals['reads']:>8} {totals['writes']:>8} "
+            f"{totals['events']:>8}"
+        )
+        return "\n".join(lines)
+
+
+def _unwrap(value):
+    return value._target if isinstance(value, _Metered) else value
+
+
+class _Metered:
+    """Proxy for a Firestore client/collection/query/document reference."""
+
+    def __init__(self, target, meter: CostMeter):
+        self._target = target
+        self._meter = meter
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+        meter = self._meter
+
+        def call(*args, **kwargs):
+            args = [_unwrap(a) for a in args]
+            kwargs = {k: _unwrap(v) for k, v in kwargs.items()}
+            if name == "on_snapshot":
+                return attr(_metered_callback(args[0], meter), *args[1:], **kwargs)
+            result = attr(*args, **kwargs)
+            if name in _CHAIN_METHODS:
+                return _Metered(result, meter)
+            if name == "batch":
+                return MeteredBatch(result, meter)
+            if name == "get":
+                if hasattr(result, "exists"):
+                    meter.add(reads=1)
+                    return result
+                docs = list(result)
+                meter.add(reads=max(len(docs), 1))
+                return docs
+            if name == "stream":
+                return _metered_stream(result, meter)
+            if name in _WRITE_METHODS:
+                meter.add(writes=1)
+            return result
+
+        return call
+
+    def __eq__(self, other):
+        return self._target == _unwrap(other)
+
+    def __hash__(self):
+        return hash(self._target)
+
+
+class MeteredClient(_Metered):
+    """Firestore client whose calls are counted on `meter`."""
+
+
+class MeteredBatch:
+    """WriteBatch proxy: counts its writes when committed."""
+
+    def __init__(self, target, meter: CostMeter):
+        self._target = target
+        self._meter = meter
+        self._pending = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            args = [_unwrap(a) for a in args]
+            kwargs = {k: _unwrap(v) for k, v in kwargs.items()}
+            result = attr(*args, **kwargs)
+            if name in _WRITE_METHODS:
+                self._pending += 1
+                return self
+            if name == "commit":
+                self._meter.add(writes=self._pending)
+                self._pending = 0
+            return result
+
+        return call
+
+
+def _metered_stream(docs, meter: CostMeter):
+    tag = current_tag()
+    count = 0
+    try:
+        for doc in docs:
+            count += 1
+            yield doc
+    finally:
+        meter.add(tag, reads=max(count, 1))
+
+
+def _metered_callback(callback, meter: CostMeter):
+    tag = current_tag()
+
+    def on_snapshot(snapshot, changes, read_time):
+        meter.add(tag, reads=len(changes or ()), events=1)
+        return callback(snapshot, changes, read_time)
+
+    return on_snapshot
+
+
+_meter: Optional[CostMeter] = None
+_meter_lock = threading.Lock()
+
+
+def get_meter() -> CostMeter:
+    """The session-wide meter shared by the Firestore client and the UI."""
+    global _meter
+    with _meter_lock:
+        if _meter is None:
+            _meter = CostMeter()
+        return _meter
@@ -1,8 +1,13 @@
+import gzip
+import json
 import os
 import traceback
-from typing import Optional
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Callable, Iterator, Optional
 
 import config
+from services.costs import MeteredClient, current_tag, get_meter, tagged
 
 try:
     from firebase_admin import credentials, firestore, initialize_app
@@ -17,7 +22,8 @@ _firestore_db = None
 def init_firestore(key_path: Optional[str] = None):
     """Initialize firebase-admin Firestore client using service account JSON.
 
-    Returns the firestore client or None on failure.
+    The client is wrapped in `services.costs.MeteredClient`, which counts
+    reads/writes per feature tag. Returns the client or None on failure.
     """
     global _firestore_db
     if _firestore_db is not None:
@@ -31,7 +37,7 @@ def init_firestore(key_path: Optional[str] = None):
     try:
         cred = credentials.Certificate(key)
         initialize_app(cred)
-        _firestore_db = firestore.client()
+        _firestore_db = MeteredClient(firestore.client(), get_meter())
         return _firestore_db
     except Exception as e:
         print(f"[ERROR] Firestore init failed: {e}")
@@ -44,11 +50,19 @@ def get_db():
     return _firestore_db
 
 
-def add_message(room_id: str, username: str, text: str, timestamp=None):
+def add_message(
+    room_id: str,
+    username: str,
+    text: str,
+    timestamp=None,
+    participants: Optional[list] = None,
+):
     db = get_db()
     if db is None:
         raise RuntimeError("Firestore is not initialized")
     data = {"room_id": room_id, "username": username, "text": text}
+    if participants:
+        data["participants"] = sorted(participants)
     if timestamp is not None:
         data["timestamp"] = timestamp
     else:
@@ -114,3 +128,230 @@ def stream_room(room_id: str, callback):
     except Exception as e:
         print(f"[ERROR] stream_room failed: {e}")
         return None
+
+
+# --- Room export / import ---
+#
+# Export format: gzip'd JSON lines, one message per line:
+#   {"id": "<doc id>", "data": {...message fields...}}
+# Datetimes (Firestore timestamps) are encoded as {"__datetime__": "<iso>"}.
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, dict):
+        return {k: _encode_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode_value(v) for v in value]
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if set(value) == {"__datetime__"}:
+            return datetime.fromisoformat(value["__datetime__"])
+        return {k: _decode_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode_value(v) for v in value]
+    return value
+
+
+def iter_room_pages(room_id: str, page_size: Optional[int] = None) -> Iterator[list]:
+    """Yield a room's messages oldest first, one page of snapshots at a time.
+
+    Unlike `get_history_paginated` errors are raised, so an export can never
+    silently stop early. Messages without a timestamp are not returned by
+    ordered queries and are therefore not exported.
+    """
+    db = get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    page_size = page_size or config.EXPORT_PAGE_SIZE
+    base = (
+        db.collection("messages")
+        .where("room_id", "==", room_id)
+        .order_by("timestamp", direction=firestore.Query.ASCENDING)
+        .limit(page_size)
+    )
+    last = None
+    while True:
+        q = base.start_after(last) if last is not None else base
+        docs = list(q.get())
+        if not docs:
+            return
+        yield docs
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
+
+
+def export_room(
+    room_id: str,
+    path: str,
+    page_size: Optional[int] = None,
+    on_progress: Optional[Callable[[int], None]] = None,
+    include_archive: bool = True,
+) -> int:
+    """Stream all messages of `room_id` into a gzip'd JSONL file at `path`.
+
+    Archived messages (`services.archive` chunks) are written first, as plain
+    messages, followed by the live ones. Memory use is bounded by one page
+    or chunk. The file is written under a temporary name and moved into place
+    when complete. Returns the number of messages.
+    """
+    tmp = path + ".part"
+    count = 0
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        if include_archive:
+            # imported lazily: services.archive imports this module
+            from services.archive import iter_chunks
+
+            for chunk in iter_chunks(room_id):
+                for entry in (chunk.to_dict() or {}).get("messages") or []:
+                    data = dict(entry, room_id=room_id)
+                    doc_id = data.pop("_id")
+                    record = {"id": doc_id, "data": _encode_value(data)}
+                    f.write(json.dumps(record, ensure_ascii=False))
+                    f.write("\n")
+                    count += 1
+                if on_progress:
+                    on_progress(count)
+        for docs in iter_room_pages(room_id, page_size):
+            for doc in docs:
+                record = {"id": doc.id, "data": _encode_value(doc.to_dict() or {})}
+                f.write(json.dumps(record, ensure_ascii=False))
+                f.write("\n")
+            count += len(docs)
+            if on_progress:
+                on_progress(count)
+    os.replace(tmp, path)
+    return count
+
+
+def _read_checkpoint(checkpoint_path: str) -> int:
+    try:
+        with open(checkpoint_path, encoding="utf-8") as f:
+            return int(json.load(f).get("lines_done", 0))
+    except (OSError, ValueError):
+        return 0
+
+
+def _write_checkpoint(checkpoint_path: str, lines_done: int):
+    tmp = checkpoint_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"lines_done": lines_done}, f)
+    os.replace(tmp, checkpoint_path)
+
+
+def import_room(
+    path: str,
+    room_id: Optional[str] = None,
+    batch_size: Optional[int] = None,
+    workers: Optional[int] = None,
+    checkpoint_path: Optional[str] = None,
+    on_progress: Optional[Callable[[int], None]] = None,
+) -> int:
+    """Import an `export_room` file with batched, parallel writes.
+
+    Documents keep their exported ids, so re-running an import is idempotent.
+    With `room_id` the messages are moved to that room instead (ids are then
+    prefixed with the target room to avoid overwriting the source).
+
+    Progress is checkpointed to `checkpoint_path` (default: `<path>.ckpt`)
+    after every contiguous run of committed batches; an interrupted import
+    resumes from there. The checkpoint is removed on success. Returns the
+    number of messages written by this run.
+    """
+    db = get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    batch_size = min(batch_size or config.IMPORT_BATCH_SIZE, 500)
+    workers = max(1, workers or config.IMPORT_WORKERS)
+    checkpoint_path = checkpoint_path or path + ".ckpt"
+    skip = _read_checkpoint(checkpoint_path)
+    collection = db.collection("messages")
+    # pool threads don't inherit the caller's cost tag
+    tag = current_tag()
+
+    @tagged(tag)
+    def commit(records):
+        batch = db.batch()
+        for record in records:
+            data = _decode_value(record["data"])
+            doc_id = record["id"]
+            if room_id is not None and data.get("room_id") != room_id:
+                doc_id = f"{room_id}__{doc_id}"
+                data["room_id"] = room_id
+            batch.set(collection.document(doc_id), data)
+        batch.commit()
+
+    # future -> (first line before the batch, last line, records); committed
+    # ranges wait in done_ends until every earlier batch is done, so the
+    # checkpoint never skips over a batch that is still in flight
+    pending = {}
+    done_ends = {}
+    lines_done = skip
+    written = 0
+
+    def collect(finished):
+        nonlocal lines_done, written
+        error = None
+        for fut in finished:
+            start, end, count = pending.pop(fut)
+            # record every successful batch before surfacing a failure, so
+            # the checkpoint doesn't depend on the order futures are visited
+            if fut.exception() is not None:
+                error = error or fut.exception()
+                continue
+            done_ends[start] = end
+            written += count
+        advanced = False
+        while lines_done in done_ends:
+            lines_done = done_ends.pop(lines_done)
+            advanced = True
+        if advanced:
+            _write_checkpoint(checkpoint_path, lines_done)
+            if on_progress:
+                on_progress(lines_done)
+        if error is not None:
+            raise error
+
+    with ThreadPoolExecutor(max_workers=workers) as pool, gzip.open(
+        path, "rt", encoding="utf-8"
+    ) as f:
+        records = []
+        line_no = 0
+        batch_start = skip
+        for line in f:
+            line_no += 1
+            if line_no <= skip or not line.strip():
+                continue
+            records.append(json.loads(line))
+            if len(records) >= batch_size:
+                # bound in-flight batches to keep memory constant
+                while len(pending) >= workers * 2:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+                pending[pool.submit(commit, records)] = (
+                    batch_start,
+                    line_no,
+                    len(records),
+                )
+                records = []
+                batch_start = line_no
+        if records:
+            pending[pool.submit(commit, records)] = (
+                batch_start,
+                line_no,
+                len(records),
+            )
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(finished)
+
+    try:
+        os.remove(checkpoint_path)
+    except OSError:
+        pass
+    return written
@@ -0,0 +1,424 @@
+"""IRC gateway: lets ordinary IRC clients join the chat.
+
+An asyncio IRC server speaking the subset a client needs to chat
+(PASS, NICK, USER, JOIN, PART, PRIVMSG, NAMES, PING, QUIT). `#lobby` maps to the
+`lobby` room; `PRIVMSG <nick>` goes to the DM room `dm_room_id(me, nick)`
+with explicit participants, exactly as the GUI writes it.
+
+Fan-out: the gateway holds one store stream per joined room, shared by
+every IRC session in it, plus one watch over DM rooms for all sessions, so
+200 IRC users in `#lobby` cost one Firestore listener. A session never gets
+its own messages echoed back (IRC clients print them locally).
+
+Registration needs the account's password (`PASS`, see `config.IRC_AUTH`):
+a nick is a username, and its session receives that user's DMs.
+
+Messages go through any `services.message_store.MessageStore` (Firestore,
+the LAN relay, or `MemoryStore` in tests); its stream callbacks may fire on
+any thread and are marshalled onto the event loop.
+"""
+import asyncio
+from typing import Callable, Dict, List, Optional, Set
+
+import config
+from services.message_store import MessageStore, get_store
+from services.rooms import LOBBY, dm_room_id
+
+LOBBY_CHANNEL = "#" + LOBBY
+
+# numeric replies
+RPL_WELCOME = "001"
+RPL_YOURHOST = "002"
+RPL_NAMREPLY = "353"
+RPL_ENDOFNAMES = "366"
+ERR_NOSUCHNICK = "401"
+ERR_NOSUCHCHANNEL = "403"
+ERR_CANNOTSENDTOCHAN = "404"
+ERR_UNKNOWNCOMMAND = "421"
+ERR_NONICKNAMEGIVEN = "431"
+ERR_ERRONEUSNICKNAME = "432"
+ERR_NICKNAMEINUSE = "433"
+ERR_NOTONCHANNEL = "442"
+ERR_NOTREGISTERED = "451"
+ERR_NEEDMOREPARAMS = "461"
+ERR_ALREADYREGISTRED = "462"
+ERR_PASSWDMISMATCH = "464"
+
+# (nick, password) -> whether the password belongs to the account `nick`;
+# blocking, run in the executor
+Authenticator = Callable[[str, str], bool]
+
+
+def parse_line(line: str):
+    """Split an IRC line into (command, params); the prefix is dropped."""
+    line = line.rstrip("\r\n")
+    if line.startswith(":"):
+        _, _, line = line.partition(" ")
+    head, sep, trailing = line.partition(" :")
+    params = head.split()
+    if not params:
+        return None, []
+    if sep:
+        params.append(trailing)
+    return params[0].upper(), params[1:]
+
+
+def _valid_nick(nick: str) -> bool:
+    return bool(nick) and len(nick) <= 30 and not set(nick) & set("#:,!@ ")
+
+
+def account_credentials(nick: str, password: str):
+    """(email, password) for a PASS value, or None if it names no account.
+
+    `PASS <email>:<password>` or, with `config.IRC_EMAIL_DOMAIN`, a bare
+    password for `<nick>@<domain>`. The email's username must be `nick`.
+    """
+    head, sep, rest = password.partition(":")
+    if sep and "@" in head:
+        email, password = head, rest
+    elif config.IRC_EMAIL_DOMAIN:
+        email = f"{nick}@{config.IRC_EMAIL_DOMAIN}"
+    else:
+        return None
+    if email.split("@")[0] != nick:
+        return None
+    return email, password
+
+
+def firebase_authenticator(auth=None) -> Authenticator:
+    """Verify IRC logins against Firebase Auth (the GUI's accounts)."""
+    if auth is None:
+        from services.auth_service import AuthService, SessionStore
+
+        # never persists anything: verify_password starts no session
+        auth = AuthService(store=SessionStore(use_keyring=False))
+
+    def authenticate(nick: str, password: str) -> bool:
+        credentials = account_credentials(nick, password)
+        return credentials is not None and auth.verify_password(*credentials)
+
+    return authenticate
+
+
+class IRCSession:
+    """One connected IRC client."""
+
+    def __init__(self, gateway: "IRCGateway", writer: asyncio.StreamWriter):
+        self.gateway = gateway
+        self.writer = writer
+        self.nick: Optional[str] = None
+        self.user: Optional[str] = None
+        self.channels: Set[str] = set()
+        self.password: Optional[str] = None
+        self.registered = False
+
+    @property
+    def prefix(self) -> str:
+        return f"{self.nick}!{self.user or self.nick}@{self.gateway.server_name}"
+
+    def send(self, line: str):
+        if not self.writer.is_closing():
+            self.writer.write(line.encode("utf-8", "replace") + b"\r\n")
+
+    def reply(self, numeric: str, *params: str):
+        params = list(params)
+        if params:
+            params[-1] = ":" + params[-1]
+        target = self.nick or "*"
+        self.send(" ".join([f":{self.gateway.server_name}", numeric, target] + params))
+
+
+class IRCGateway:
+    """asyncio IRC server bridging sessions to a `MessageStore`."""
+
+    def __init__(
+        self,
+        store: MessageStore,
+        server_name: Optional[str] = None,
+        authenticate: Optional[Authenticator] = None,
+    ):
+        self.store = store
+        self.server_name = server_name or config.IRC_SERVER_NAME
+        # None: any nick is accepted (tests, local development)
+        self.authenticate = authenticate
+        self.sessions: Dict[str, IRCSession] = {}
+        # room_id -> IRC sessions in it; one store stream per non-empty room
+        self._members: Dict[str, Set[IRCSession]] = {}
+        self._room_watches: Dict[str, object] = {}
+        self._direct_watch = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def start(self, host: Optional[str] = None, port: Optional[int] = None):
+        self._loop = asyncio.get_running_loop()
+        return await asyncio.start_server(
+            self.handle_client,
+            host or config.IRC_HOST,
+            config.IRC_PORT if port is None else port,
+        )
+
+    # --- store fan-out ---
+
+    def _from_store(self, handler):
+        """Wrap `handler` so stream callbacks from any thread run on the loop."""
+        loop = self._loop or asyncio.get_event_loop()
+        return lambda messages: loop.call_soon_threadsafe(handler, messages)
+
+    def _join_room(self, room_id: str, session: IRCSession):
+        members = self._members.setdefault(room_id, set())
+        members.add(session)
+        if room_id not in self._room_watches:
+            self._room_watches[room_id] = self.store.stream(
+                room_id,
+                self._from_store(lambda msgs: self._deliver_room(room_id, msgs)),
+            )
+
+    def _leave_room(self, room_id: str, session: IRCSession):
+        members = self._members.get(room_id)
+        if not members:
+            return
+        members.discard(session)
+        if not members:
+            del self._members[room_id]
+            watch = self._room_watches.pop(room_id, None)
+            if watch is not None:
+                watch.unsubscribe()
+
+    def _deliver_room(self, room_id: str, messages: List[dict]):
+        channel = "#" + room_id
+        for message in messages:
+            sender = message.get("username") or "unknown"
+            for text_line in (message.get("text") or "").splitlines() or [""]:
+                line = f":{sender}!{sender}@{self.server_name} PRIVMSG {channel} :{text_line}"
+                for session in list(self._members.get(room_id, ())):
+                    if session.nick != sender:
+                        session.send(line)
+
+    def _deliver_direct(self, messages: List[dict]):
+        for message in messages:
+            sender = message.get("username") or "unknown"
+            participants = message.get("participants") or ()
+            for nick in participants:
+                session = self.sessions.get(nick)
+                if session is None or nick == sender:
+                    continue
+                for text_line in (message.get("text") or "").splitlines() or [""]:
+                    session.send(
+                        f":{sender}!{sender}@{self.server_name} PRIVMSG {nick} :{text_line}"
+                    )
+
+    # --- connection handling ---
+
+    async def handle_client(self, reader, writer):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        session = IRCSession(self, writer)
+        try:
+            while True:
+                raw = await reader.readline()
+                if not raw:
+                    break
+                command, params = parse_line(raw.decode("utf-8", "replace"))
+                if command is None:
+                    continue
+                if command == "QUIT":
+                    break
+                await self.dispatch(session, command, params)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._disconnect(session)
+            writer.close()
+
+    def _disconnect(self, session: IRCSession):
+        for channel in list(session.channels):
+            self._part(session, channel, "Quit")
+        if session.nick and self.sessions.get(session.nick) is session:
+            del self.sessions[session.nick]
+        if not self.sessions and self._direct_watch is not None:
+            self._direct_watch.unsubscribe()
+            self._direct_watch = None
+
+    async def dispatch(self, session: IRCSession, command: str, params: List[str]):
+        handler = getattr(self, f"_cmd_{command.lower()}", None)
+        if handler is None:
+            if session.registered:
+                session.reply(ERR_UNKNOWNCOMMAND, command, "Unknown command")
+            return
+        if not session.registered and command not in ("PASS", "NICK", "USER", "PING"):
+            session.reply(ERR_NOTREGISTERED, "You have not registered")
+            return
+        result = handler(session, params)
+        if asyncio.iscoroutine(result):
+            await result
+
+    def _cmd_ping(self, session: IRCSession, params):
+        token = params[0] if params else self.server_name
+        session.send(f":{self.server_name} PONG {self.server_name} :{token}")
+
+    def _cmd_pass(self, session: IRCSession, params):
+        if session.registered:
+            session.reply(ERR_ALREADYREGISTRED, "You may not reregister")
+            return
+        if not params:
+            session.reply(ERR_NEEDMOREPARAMS, "PASS", "Not enough parameters")
+            return
+        session.password = params[0]
+
+    def _cmd_nick(self, session: IRCSession, params):
+        if not params:
+            session.reply(ERR_NONICKNAMEGIVEN, "No nickname given")
+            return
+        nick = params[0]
+        if not _valid_nick(nick):
+            session.reply(ERR_ERRONEUSNICKNAME, nick, "Erroneous nickname")
+            return
+        if session.registered:
+            # renames would orphan the user's DM rooms
+            session.reply(ERR_ERRONEUSNICKNAME, nick, "Nickname changes unsupported")
+            return
+        if nick in self.sessions:
+            session.reply(ERR_NICKNAMEINUSE, nick, "Nickname is already in use")
+            return
+        session.nick = nick
+        return self._maybe_register(session)
+
+    def _cmd_user(self, session: IRCSession, params):
+        if len(params) < 4:
+            session.reply(ERR_NEEDMOREPARAMS, "USER", "Not enough parameters")
+            return
+        session.user = params[0]
+        return self._maybe_register(session)
+
+    async def _verified(self, session: IRCSession) -> bool:
+        if self.authenticate is None:
+            return True
+        password, session.password = session.password, None
+        ok = False
+        if password:
+            try:
+                ok = await asyncio.get_running_loop().run_in_executor(
+                    None, self.authenticate, session.nick, password
+                )
+            except Exception as e:
+                print(f"[WARN] IRC login for {session.nick} not verified: {e}")
+        if not ok:
+            session.reply(ERR_PASSWDMISMATCH, "Password incorrect")
+            session.send(f"ERROR :Closing link: {session.nick} (Bad password)")
+            session.writer.close()
+        return ok
+
+    async def _maybe_register(self, session: IRCSession):
+        if session.registered or not session.nick or not session.user:
+            return
+        if not await self._verified(session):
+            return
+        # re-checked: another session may have taken the nick meanwhile
+        if session.nick in self.sessions:
+            session.reply(ERR_NICKNAMEINUSE, session.nick, "Nickname is already in use")
+            session.nick = None
+            return
+        self.sessions[session.nick] = session
+        session.registered = True
+        if self._direct_watch is None:
+            self._direct_watch = self.store.stream_direct(
+                self._from_store(self._deliver_direct)
+            )
+        session.reply(RPL_WELCOME, f"Welcome to {self.server_name}, {session.prefix}")
+        session.reply(RPL_YOURHOST, f"Your host is {self.server_name}")
+
+    def _room_for_channel(self, channel: str) -> Optional[str]:
+        return LOBBY if channel.lower() == LOBBY_CHANNEL else None
+
+    def _cmd_join(self, session: IRCSession, params):
+        if not params:
+            session.reply(ERR_NEEDMOREPARAMS, "JOIN", "Not enough parameters")
+            return
+        for channel in params[0].split(","):
+            room_id = self._room_for_channel(channel)
+            if room_id is None:
+                session.reply(ERR_NOSUCHCHANNEL, channel, "No such channel")
+                continue
+            channel = "#" + room_id
+            if channel in session.channels:
+                continue
+            session.channels.add(channel)
+            self._join_room(room_id, session)
+            for member in self._members[room_id]:
+                member.send(f":{session.prefix} JOIN {channel}")
+            self._cmd_names(session, [channel])
+
+    def _part(self, session: IRCSession, channel: str, reason: str = ""):
+        room_id = self._room_for_channel(channel)
+        if room_id is None or "#" + room_id not in session.channels:
+            session.reply(ERR_NOTONCHANNEL, channel, "You're not on that channel")
+            return
+        channel = "#" + room_id
+        line = f":{session.prefix} PART {channel}" + (f" :{reason}" if reason else "")
+        for member in self._members.get(room_id, ()):
+            member.send(line)
+        session.channels.discard(channel)
+        self._leave_room(room_id, session)
+
+    def _cmd_part(self, session: IRCSession, params):
+        if not params:
+            session.reply(ERR_NEEDMOREPARAMS, "PART", "Not enough parameters")
+            return
+        reason = params[1] if len(params) > 1 else ""
+        for channel in params[0].split(","):
+            self._part(session, channel, reason)
+
+    def _cmd_names(self, session: IRCSession, params):
+        channels = params[0].split(",") if params else sorted(session.channels)
+        for channel in channels:
+            room_id = self._room_for_channel(channel)
+            if room_id is not None:
+                names = sorted(m.nick for m in self._members.get(room_id, ()))
+                session.reply(RPL_NAMREPLY, "=", "#" + room_id, " ".join(names))
+            session.reply(RPL_ENDOFNAMES, channel, "End of /NAMES list")
+
+    async def _cmd_privmsg(self, session: IRCSession, params):
+        if len(params) < 2:
+            session.reply(ERR_NEEDMOREPARAMS, "PRIVMSG", "Not enough parameters")
+            return
+        target, text = params[0], params[1]
+        participants = None
+        if target.startswith("#"):
+            room_id = self._room_for_channel(target)
+            if room_id is None:
+                session.reply(ERR_NOSUCHCHANNEL, target, "No such channel")
+                return
+            if "#" + room_id not in session.channels:
+                session.reply(ERR_CANNOTSENDTOCHAN, target, "Cannot send to channel")
+                return
+        else:
+            if not _valid_nick(target) or target == session.nick:
+                session.reply(ERR_NOSUCHNICK, target, "No such nick")
+                return
+            room_id = dm_room_id(session.nick, target)
+            participants = [session.nick, target]
+        # recipients (including other IRC sessions) get it from the stream
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.store.add, room_id, session.nick, text, participants
+            )
+        except Exception as e:
+            print(f"[WARN] IRC message from {session.nick} not stored: {e}")
+            session.send(
+                f":{self.server_name} NOTICE {session.nick} :Message not delivered"
+            )
+
+
+async def serve(
+    store: Optional[MessageStore] = None,
+    host: Optional[str] = None,
+    port: Optional[int] = None,
+):
+    """Run the gateway until cancelled (`get_store()` backend by default)."""
+    authenticate = firebase_authenticator() if config.IRC_AUTH else None
+    gateway = IRCGateway(store or get_store(), authenticate=authenticate)
+    server = await gateway.start(host, port)
+    addresses = ", ".join(str(s.getsockname()) for s in server.sockets)
+    print(f"[LOG] IRC gateway listening on {addresses}")
+    async with server:
+        await server.serve_forever()
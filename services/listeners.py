@@ -0,0 +1,374 @@
+"""Supervised Firestore snapshot listeners.
+
+A `SupervisedListener` owns one `on_snapshot` subscription built by a
+`make_query(resume_from)` factory. It records when its last snapshot arrived
+and the newest message `timestamp` it has delivered (the resume point).
+
+`ListenerSupervisor` health-checks its listeners on a background thread. A
+listener whose watch has shut down (`Watch.is_active` is False) or that never
+delivered its first snapshot within `config.LISTENER_STALL_TIMEOUT` is
+resubscribed with exponential backoff. The new query starts at the resume
+point, so a reconnect only downloads what was missed instead of replaying
+the whole initial snapshot; the messages at the resume point itself were
+delivered already, so their ADDED changes are dropped from the first
+snapshot after it. Queries that can't resume (presence) simply ignore
+`resume_from`.
+
+`ListenerHub` shares one supervised listener per source (a room, the global
+message feed, presence) between any number of subscribers, so a second
+consumer of the same stream does not open a duplicate subscription.
+"""
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import config
+from services.costs import current_tag, tagged
+
+
+def _unsubscribe(watcher):
+    if watcher is None:
+        return
+    try:
+        if hasattr(watcher, "unsubscribe"):
+            watcher.unsubscribe()
+        elif callable(watcher):
+            watcher()
+    except Exception as e:
+        print(f"[WARN] Listener unsubscribe failed: {e}")
+
+
+def _advance(changes, newest, ids):
+    """Resume point after `changes`: (newest timestamp, doc ids delivered at it)."""
+    ids = set(ids)
+    for change in changes or ():
+        try:
+            if change.type.name == "REMOVED":
+                continue
+            doc = change.document
+            ts = (doc.to_dict() or {}).get("timestamp")
+        except Exception:
+            continue
+        if ts is None or not hasattr(ts, "timestamp"):
+            continue
+        if newest is None or ts > newest:
+            newest, ids = ts, {doc.id}
+        elif ts == newest:
+            ids.add(doc.id)
+    return newest, ids
+
+
+def _replayed(change, ids) -> bool:
+    try:
+        return change.type.name == "ADDED" and change.document.id in ids
+    except Exception:
+        return False
+
+
+class SupervisedListener:
+    """One snapshot subscription that a `ListenerSupervisor` keeps alive."""
+
+    def __init__(
+        self,
+        name: str,
+        make_query: Callable[[Optional[object]], object],
+        callback: Callable,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self._make_query = make_query
+        self._callback = callback
+        self._clock = clock
+        # restarts happen on the supervisor thread; keep the caller's cost tag
+        self._tag = current_tag()
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._generation = 0
+        self._supervisor: Optional["ListenerSupervisor"] = None
+        self.resume_from = None
+        # doc ids delivered with timestamp == resume_from; `timestamp >=`
+        # returns them again after a resubscription
+        self._resume_ids = set()
+        self._replay = set()
+        self.subscribed_at: Optional[float] = None
+        self.last_snapshot_at: Optional[float] = None
+        self.failures = 0
+        self.retry_at: Optional[float] = None
+        self.stopped = False
+
+    def start(self):
+        """(Re)subscribe from the resume point."""
+        with self._lock:
+            if self.stopped:
+                return
+            _unsubscribe(self._watcher)
+            self._watcher = None
+            self._generation += 1
+            generation = self._generation
+            resume_from = self.resume_from
+            self._replay = set(self._resume_ids) if resume_from is not None else set()
+        with tagged(self._tag):
+            query = self._make_query(resume_from)
+            watcher = query.on_snapshot(
+                lambda snap, changes, read_time: self._on_snapshot(
+                    generation, snap, changes, read_time
+                )
+            )
+        with self._lock:
+            if self.stopped or generation != self._generation:
+                _unsubscribe(watcher)
+                return
+            self._watcher = watcher
+            self.subscribed_at = self._clock()
+            self.last_snapshot_at = None
+
+    def _on_snapshot(self, generation, snapshot, changes, read_time):
+        with self._lock:
+            if self.stopped or generation != self._generation:
+                return  # superseded by a resubscription
+            self.last_snapshot_at = self._clock()
+            self.failures = 0
+            self.retry_at = None
+            replay, self._replay = self._replay, set()
+            if replay:
+                changes = [c for c in changes or () if not _replayed(c, replay)]
+            self.resume_from, self._resume_ids = _advance(
+                changes, self.resume_from, self._resume_ids
+            )
+        self._callback(snapshot, changes, read_time)
+
+    def is_healthy(self, now: Optional[float] = None, stall_timeout=None) -> bool:
+        now = self._clock() if now is None else now
+        stall_timeout = (
+            config.LISTENER_STALL_TIMEOUT if stall_timeout is None else stall_timeout
+        )
+        with self._lock:
+            watcher = self._watcher
+            if watcher is None:
+                return False
+            if not getattr(watcher, "is_active", True):
+                return False
+            if self.last_snapshot_at is None and self.subscribed_at is not None:
+                return now - self.subscribed_at < stall_timeout
+            return True
+
+    def stop(self):
+        with self._lock:
+            self.stopped = True
+            self._generation += 1
+            watcher, self._watcher = self._watcher, None
+        _unsubscribe(watcher)
+
+    def unsubscribe(self):
+        """Stop and detach from the supervisor (same API as a Watch)."""
+        self.stop()
+        if self._supervisor is not None:
+            self._supervisor.discard(self)
+
+
+class ListenerSupervisor:
+    """Health-checks listeners and resubscribes failed ones with backoff."""
+
+    def __init__(
+        self,
+        check_interval: Optional[float] = None,
+        stall_timeout: Optional[float] = None,
+        backoff_base: Optional[float] = None,
+        backoff_max: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.check_interval = check_interval or config.LISTENER_CHECK_INTERVAL
+        self.stall_timeout = stall_timeout or config.LISTENER_STALL_TIMEOUT
+        self.backoff_base = backoff_base or config.LISTENER_BACKOFF_BASE
+        self.backoff_max = backoff_max or config.LISTENER_BACKOFF_MAX
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._listeners: Dict[str, SupervisedListener] = {}
+        self._wake = threading.Event()
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    def add(
+        self,
+        name: str,
+        make_query: Callable[[Optional[object]], object],
+        callback: Callable,
+    ) -> SupervisedListener:
+        """Subscribe a new listener (replacing one with the same name)."""
+        listener = SupervisedListener(name, make_query, callback, clock=self._clock)
+        listener._supervisor = self
+        with self._lock:
+            old = self._listeners.get(name)
+            self._listeners[name] = listener
+        if old is not None:
+            old.stop()
+        try:
+            listener.start()
+        except Exception as e:
+            print(f"[WARN] Listener {name} failed to start: {e}")
+            self._schedule_retry(listener)
+        return listener
+
+    def discard(self, listener: SupervisedListener):
+        with self._lock:
+            if self._listeners.get(listener.name) is listener:
+                del self._listeners[listener.name]
+
+    def backoff(self, failures: int) -> float:
+        return min(self.backoff_base * 2 ** max(failures - 1, 0), self.backoff_max)
+
+    def _schedule_retry(self, listener: SupervisedListener, now=None):
+        now = self._clock() if now is None else now
+        listener.failures += 1
+        listener.retry_at = now + self.backoff(listener.failures)
+
+    def check(self, now: Optional[float] = None) -> int:
+        """Resubscribe unhealthy listeners whose backoff elapsed. Returns restarts."""
+        now = self._clock() if now is None else now
+        with self._lock:
+            listeners = list(self._listeners.values())
+        restarted = 0
+        for listener in listeners:
+            if listener.stopped or listener.is_healthy(now, self.stall_timeout):
+                continue
+            if listener.retry_at is None:
+                # newly detected failure: wait out the backoff first
+                self._schedule_retry(listener, now)
+                continue
+            if now < listener.retry_at:
+                continue
+            print(
+                f"[WARN] Listener {listener.name} unhealthy; resubscribing "
+                f"(attempt {listener.failures})"
+            )
+            listener.retry_at = None
+            try:
+                listener.start()
+                restarted += 1
+            except Exception as e:
+                print(f"[WARN] Listener {listener.name} resubscribe failed: {e}")
+                self._schedule_retry(listener, now)
+        return restarted
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._wake.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop health checks and unsubscribe every listener."""
+        self._running = False
+        self._wake.set()
+        with self._lock:
+            listeners = list(self._listeners.values())
+            self._listeners.clear()
+        for listener in listeners:
+            listener.stop()
+
+    def _run(self):
+        while self._running:
+            self._wake.wait(self.check_interval)
+            self._wake.clear()
+            if self._running:
+                self.check()
+
+
+class SharedSubscription:
+    """A subscriber's handle on a `ListenerHub` source (same API as a Watch)."""
+
+    def __init__(self, hub: "ListenerHub", key: str, callback: Callable):
+        self._hub = hub
+        self.key = key
+        self.callback = callback
+
+    def unsubscribe(self):
+        self._hub.release(self)
+
+
+class _Source:
+    def __init__(self, listener: SupervisedListener):
+        self.listener = listener
+        self.subscribers = []
+        # (snapshot, read_time) of the newest delivery, replayed to late joiners
+        self.last = None
+
+
+class ListenerHub:
+    """One supervised listener per source key, fanned out to its subscribers.
+
+    The first `subscribe()` for a key opens the listener; later ones attach
+    to it and immediately get the latest snapshot replayed with no changes
+    (like an initial snapshot). The listener stops with its last subscriber.
+    """
+
+    def __init__(self, supervisor: ListenerSupervisor):
+        self._supervisor = supervisor
+        self._lock = threading.Lock()
+        self._sources: Dict[str, _Source] = {}
+
+    def subscribe(
+        self,
+        key: str,
+        make_query: Callable[[Optional[object]], object],
+        callback: Callable,
+    ) -> SharedSubscription:
+        subscription = SharedSubscription(self, key, callback)
+        with self._lock:
+            source = self._sources.get(key)
+            if source is not None:
+                source.subscribers.append(subscription)
+                last = source.last
+        if source is not None:
+            if last is not None:
+                snapshot, read_time = last
+                callback(snapshot, [], read_time)
+            return subscription
+
+        source = _Source(None)
+        source.subscribers.append(subscription)
+        with self._lock:
+            self._sources[key] = source
+        source.listener = self._supervisor.add(
+            key,
+            make_query,
+            lambda snapshot, changes, read_time: self._fan_out(
+                source, snapshot, changes, read_time
+            ),
+        )
+        return subscription
+
+    def _fan_out(self, source: _Source, snapshot, changes, read_time):
+        with self._lock:
+            source.last = (snapshot, read_time)
+            subscribers = list(source.subscribers)
+        for subscription in subscribers:
+            subscription.callback(snapshot, changes, read_time)
+
+    def subscribers(self, key: str) -> int:
+        with self._lock:
+            source = self._sources.get(key)
+            return len(source.subscribers) if source else 0
+
+    def release(self, subscription: SharedSubscription):
+        with self._lock:
+            source = self._sources.get(subscription.key)
+            if source is None or subscription not in source.subscribers:
+                return
+            source.subscribers.remove(subscription)
+            if source.subscribers:
+                return
+            del self._sources[subscription.key]
+        if source.listener is not None:
+            source.listener.unsubscribe()
+
+    def stop(self):
+        """Drop every source and stop its listener."""
+        with self._lock:
+            sources = list(self._sources.values())
+            self._sources.clear()
+        for source in sources:
+            if source.listener is not None:
+                source.listener.unsubscribe()
@@ -0,0 +1,328 @@
+"""Pluggable message backends.
+
+`MessageStore` is the small surface the chat needs from a backend: add a
+message, page history, stream new messages, bulk-delete a room and keep
+presence. The GUI sends, loads history and follows the open room through
+it; the IRC gateway uses it for everything. `FirestoreStore` implements it on top of `services.firestore_client`
+and `services.presence`; `MemoryStore` keeps everything in process (tests,
+offline development); `services.relay.RelayStore` talks to a self-hosted
+relay server on the LAN. `get_store()` returns the backend selected by
+`config.MESSAGE_STORE`.
+
+Messages are plain dicts: `_id`, `room_id`, `username`, `text`,
+`timestamp` (aware UTC datetime, None while a server timestamp is pending)
+and `participants` (DM rooms). Stream callbacks get a list of new messages
+and may run on any thread.
+"""
+import abc
+import itertools
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+
+import config
+import services.conversations as conversations
+import services.firestore_client as fc
+import services.presence as presence
+from services.listeners import ListenerSupervisor
+from services.rooms import DM_PREFIX, DM_PREFIX_END
+
+MessagesCallback = Callable[[List[dict]], None]
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def is_direct(room_id: Optional[str]) -> bool:
+    return bool(room_id) and room_id.startswith(DM_PREFIX)
+
+
+class Subscription:
+    """Handle returned by `stream()`; same API as a Firestore Watch."""
+
+    def __init__(self, on_unsubscribe: Callable[[], None]):
+        self._on_unsubscribe = on_unsubscribe
+        self._done = False
+
+    def unsubscribe(self):
+        if not self._done:
+            self._done = True
+            self._on_unsubscribe()
+
+
+class MessageStore(abc.ABC):
+    """Interface every backend implements."""
+
+    @abc.abstractmethod
+    def add(
+        self,
+        room_id: str,
+        username: str,
+        text: str,
+        participants: Optional[List[str]] = None,
+    ) -> str:
+        """Store a message and return its id."""
+
+    @abc.abstractmethod
+    def history(
+        self, room_id: str, limit: int = 50, before: Optional[dict] = None
+    ) -> List[dict]:
+        """Up to `limit` messages older than message `before` (default: newest),
+        oldest first."""
+
+    @abc.abstractmethod
+    def stream(self, room_id: str, callback: MessagesCallback) -> Subscription:
+        """Call `callback` with messages added to `room_id` from now on."""
+
+    @abc.abstractmethod
+    def stream_direct(self, callback: MessagesCallback) -> Subscription:
+        """Call `callback` with messages added to any DM room from now on."""
+
+    @abc.abstractmethod
+    def delete_room(self, room_id: str) -> int:
+        """Delete every message of `room_id`; returns how many were deleted."""
+
+    @abc.abstractmethod
+    def set_presence(self, username: str, state: str = presence.STATE_ACTIVE):
+        """Mark `username` online (refreshes their presence)."""
+
+    @abc.abstractmethod
+    def clear_presence(self, username: str):
+        """Mark `username` offline."""
+
+    @abc.abstractmethod
+    def online_users(self) -> List[str]:
+        """Users whose presence is fresher than `config.PRESENCE_TTL`."""
+
+    def close(self):
+        pass
+
+
+class MemoryStore(MessageStore):
+    """Everything in memory; stream callbacks run synchronously in `add()`."""
+
+    def __init__(self, clock: Callable[[], datetime] = _utcnow):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._messages: Dict[str, List[dict]] = {}
+        self._watchers: Dict[Optional[str], list] = {}
+        self._presence: Dict[str, datetime] = {}
+        self.streams_opened = 0
+
+    def add(self, room_id, username, text, participants=None):
+        message = {
+            "_id": f"m{next(self._ids)}",
+            "room_id": room_id,
+            "username": username,
+            "text": text,
+            "timestamp": self._clock(),
+            "participants": sorted(participants) if participants else None,
+        }
+        with self._lock:
+            self._messages.setdefault(room_id, []).append(message)
+            callbacks = list(self._watchers.get(room_id, ()))
+            if is_direct(room_id):
+                callbacks += self._watchers.get(None, ())
+        for callback in callbacks:
+            callback([dict(message)])
+        return message["_id"]
+
+    def history(self, room_id, limit=50, before=None):
+        with self._lock:
+            messages = list(self._messages.get(room_id, ()))
+        if before is not None:
+            ids = [m["_id"] for m in messages]
+            if before.get("_id") in ids:
+                messages = messages[: ids.index(before["_id"])]
+        return [dict(m) for m in messages[-limit:]]
+
+    def _watch(self, key, callback):
+        with self._lock:
+            self._watchers.setdefault(key, []).append(callback)
+            self.streams_opened += 1
+
+        def remove():
+            with self._lock:
+                self._watchers.get(key, []).remove(callback)
+
+        return Subscription(remove)
+
+    def stream(self, room_id, callback):
+        return self._watch(room_id, callback)
+
+    def stream_direct(self, callback):
+        return self._watch(None, callback)
+
+    def delete_room(self, room_id):
+        with self._lock:
+            return len(self._messages.pop(room_id, []))
+
+    def set_presence(self, username, state=presence.STATE_ACTIVE):
+        with self._lock:
+            self._presence[username] = self._clock()
+
+    def clear_presence(self, username):
+        with self._lock:
+            self._presence.pop(username, None)
+
+    def online_users(self):
+        cutoff = self._clock() - timedelta(seconds=config.PRESENCE_TTL)
+        with self._lock:
+            users = [u for u, seen in self._presence.items() if seen >= cutoff]
+        return sorted(users, key=str.lower)
+
+
+class FirestoreStore(MessageStore):
+    """Backend on the shared firebase_admin client (`init_firestore`).
+
+    `stream_direct` needs a composite index on `messages`: with a `username`
+    (the GUI) `participants` (array-contains) + `timestamp` ascending, the
+    index `services.rooms.recent_dm_rooms` uses with the other direction;
+    without one (service clients such as the IRC gateway) `room_id` +
+    `timestamp` ascending, and a Firestore backend that accepts range
+    filters on two fields (multiple inequality filters, 2024 onwards).
+    """
+
+    def __init__(
+        self,
+        supervisor: Optional[ListenerSupervisor] = None,
+        username: Optional[str] = None,
+    ):
+        self.username = username
+        self._supervisor = supervisor or ListenerSupervisor()
+        self._supervisor.start()
+        self._names = itertools.count(1)
+
+    def _db(self):
+        db = fc.get_db()
+        if db is None:
+            raise RuntimeError("Firestore is not initialized")
+        return db
+
+    def add(self, room_id, username, text, participants=None):
+        _, ref = fc.add_message(room_id, username, text, participants=participants)
+        # every DM writer (GUI, IRC gateway) keeps the participants' conversation
+        # index current; clients with the index on do not watch the collection
+        if participants and is_direct(room_id) and config.CONVERSATION_INDEX:
+            try:
+                conversations.record_message(room_id, username, text, participants)
+            except Exception as e:
+                print(f"[WARN] Conversation index not updated for {room_id}: {e}")
+        return ref.id
+
+    @staticmethod
+    def _message(doc) -> dict:
+        data = doc.to_dict() or {}
+        data["_id"] = doc.id
+        return data
+
+    def history(self, room_id, limit=50, before=None):
+        start_after = None
+        if before is not None and before.get("timestamp") is not None:
+            start_after = {"timestamp": before["timestamp"]}
+        docs, _ = fc.get_history_paginated(
+            room_id, limit=limit, start_after=start_after, direction="desc"
+        )
+        return [self._message(d) for d in reversed(docs)]
+
+    def _watch(self, make_query, callback, keep=lambda message: True):
+        def on_snapshot(snapshot, changes, read_time):
+            messages = [
+                self._message(change.document)
+                for change in changes or ()
+                if change.type.name == "ADDED"
+            ]
+            messages = [m for m in messages if keep(m)]
+            if messages:
+                callback(messages)
+
+        # supervised: resubscribes after failures from the newest seen message
+        return self._supervisor.add(
+            f"store:{next(self._names)}", make_query, on_snapshot
+        )
+
+    def stream(self, room_id, callback):
+        since = _utcnow()
+        return self._watch(
+            lambda resume_from=None: self._db()
+            .collection("messages")
+            .where("room_id", "==", room_id)
+            .where("timestamp", ">=", resume_from or since),
+            callback,
+        )
+
+    def stream_direct(self, callback):
+        since = _utcnow()
+        username = self.username
+
+        # only DM rooms are read (and billed): the user's own, or every DM
+        # room through a room_id prefix range next to the timestamp bound
+        def make_query(resume_from=None):
+            query = self._db().collection("messages")
+            if username:
+                query = query.where("participants", "array_contains", username)
+            else:
+                query = query.where("room_id", ">=", DM_PREFIX).where(
+                    "room_id", "<", DM_PREFIX_END
+                )
+            return query.where("timestamp", ">=", resume_from or since)
+
+        return self._watch(
+            make_query,
+            callback,
+            keep=lambda message: is_direct(message.get("room_id")),
+        )
+
+    def delete_room(self, room_id, batch_size: int = 400):
+        db = self._db()
+        docs = db.collection("messages").where("room_id", "==", room_id).get()
+        batch, pending, deleted = db.batch(), 0, 0
+        for doc in docs:
+            batch.delete(doc.reference)
+            pending += 1
+            if pending >= batch_size:
+                batch.commit()
+                deleted += pending
+                batch, pending = db.batch(), 0
+        if pending:
+            batch.commit()
+            deleted += pending
+        return deleted
+
+    def set_presence(self, username, state=presence.STATE_ACTIVE):
+        presence.set_presence(username, state)
+
+    def clear_presence(self, username):
+        presence.clear_presence(username)
+
+    def online_users(self):
+        roster = presence.PresenceRoster()
+        roster.replace(presence.presence_query().get())
+        return roster.online_users()
+
+    def close(self):
+        self._supervisor.stop()
+
+
+def get_store(
+    kind: Optional[str] = None, username: Optional[str] = None
+) -> MessageStore:
+    """Backend named by `kind` or `config.MESSAGE_STORE` (firestore|relay|memory).
+
+    `username` scopes a relay connection to that user (`config.RELAY_TOKEN`
+    is then the user's token) and a Firestore DM stream to the user's rooms.
+    """
+    kind = kind or config.MESSAGE_STORE
+    if kind == "memory":
+        return MemoryStore()
+    if kind == "relay":
+        from services.relay import RelayStore
+
+        return RelayStore(config.RELAY_HOST, config.RELAY_PORT, username=username)
+    if kind != "firestore":
+        raise ValueError(f"Unknown message store: {kind}")
+    if fc.init_firestore() is None:
+        raise RuntimeError("Firestore is not available")
+    return FirestoreStore(username=username)
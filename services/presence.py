@@ -0,0 +1,486 @@
+"""Presence heartbeat engine and presence document helpers.
+
+The heartbeat adapts its write interval to what the user is doing: it backs
+off when the user is idle or the window is minimised, jitters every wait so
+clients don't write in lockstep, and skips a write when the state did not
+change and the keep-alive is not yet due. Writes run on the heartbeat thread,
+never on the Tk main loop.
+
+Presence reads are bounded by `config.PRESENCE_TTL`: queries only match docs
+whose `last_seen` is inside the freshness window, `PresenceRoster` expires
+entries client-side, and `cleanup_stale_presence` deletes docs left behind
+by crashed clients.
+
+With `config.PRESENCE_MODE == "aggregated"` the roster lives in a handful of
+shard docs (`presence_shards/shard_<n>`, field `users.<username>`) instead of
+one doc per user, so clients watch `PRESENCE_SHARD_COUNT` docs rather than N.
+With `"scoped"` (the default) clients only watch the users they care about via
+`ScopedPresenceWatcher`; everyone else is available on demand through
+`browse_online_page`.
+"""
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import config
+import services.firestore_client as fc
+
+STATE_ACTIVE = "active"
+STATE_IDLE = "idle"
+STATE_HIDDEN = "hidden"
+
+MODE_COLLECTION = "collection"
+MODE_AGGREGATED = "aggregated"
+MODE_SCOPED = "scoped"
+
+SHARDS_COLLECTION = "presence_shards"
+# Firestore caps the number of values in an `in` filter
+IN_QUERY_LIMIT = 30
+
+
+def is_aggregated() -> bool:
+    return config.PRESENCE_MODE == MODE_AGGREGATED
+
+
+def is_scoped() -> bool:
+    return config.PRESENCE_MODE == MODE_SCOPED
+
+
+def shard_for(username: str, shard_count: Optional[int] = None) -> str:
+    """Stable shard doc id for `username` (crc32, independent of PYTHONHASHSEED)."""
+    count = shard_count or config.PRESENCE_SHARD_COUNT
+    return f"shard_{zlib.crc32(username.encode('utf-8')) % count}"
+
+
+def set_presence(username: str, state: str = STATE_ACTIVE):
+    """Write presence for `username` with a server `last_seen`.
+
+    In aggregated mode this merges the user's entry into their shard doc.
+    """
+    db = fc.get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    entry = {"state": state, "last_seen": fc.firestore.SERVER_TIMESTAMP}
+    if is_aggregated():
+        db.collection(SHARDS_COLLECTION).document(shard_for(username)).set(
+            {"users": {username: entry}}, merge=True
+        )
+        return
+    db.collection("presence").document(username).set(dict(entry, username=username))
+
+
+def clear_presence(username: str):
+    """Delete presence for `username` (its doc, or its entry in the shard)."""
+    db = fc.get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    if is_aggregated():
+        db.collection(SHARDS_COLLECTION).document(shard_for(username)).set(
+            {"users": {username: fc.firestore.DELETE_FIELD}}, merge=True
+        )
+        return
+    db.collection("presence").document(username).delete()
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def fresh_presence_query(ttl: Optional[float] = None, now: Optional[datetime] = None):
+    """Query for presence docs whose `last_seen` is within the last `ttl` seconds."""
+    db = fc.get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    ttl = ttl or config.PRESENCE_TTL
+    cutoff = (now or _utcnow()) - timedelta(seconds=ttl)
+    return db.collection("presence").where("last_seen", ">=", cutoff)
+
+
+def presence_query():
+    """Query the UI listens to: shard docs in aggregated mode, else fresh docs."""
+    if is_aggregated():
+        db = fc.get_db()
+        if db is None:
+            raise RuntimeError("Firestore is not initialized")
+        return db.collection(SHARDS_COLLECTION)
+    return fresh_presence_query()
+
+
+def browse_online_page(
+    page_size: Optional[int] = None, start_after: Optional[object] = None
+):
+    """Return (usernames, cursor) for one page of users online right now.
+
+    Pages over fresh presence docs, most recent heartbeat first. `cursor` is
+    the last DocumentSnapshot to pass back as `start_after`, or None when the
+    roster is exhausted.
+    """
+    page_size = page_size or config.PRESENCE_BROWSE_PAGE
+    q = fresh_presence_query().order_by(
+        "last_seen", direction=fc.firestore.Query.DESCENDING
+    )
+    if start_after is not None:
+        q = q.start_after(start_after)
+    docs = list(q.limit(page_size).get())
+    users = [d.to_dict().get("username") for d in docs]
+    cursor = docs[-1] if len(docs) == page_size else None
+    return [u for u in users if u], cursor
+
+
+def _prune_shards(db, cutoff: datetime) -> int:
+    """Remove shard entries whose `last_seen` is older than `cutoff`."""
+    removed = 0
+    for shard in db.collection(SHARDS_COLLECTION).get():
+        users = (shard.to_dict() or {}).get("users") or {}
+        stale = {
+            name: fc.firestore.DELETE_FIELD
+            for name, entry in users.items()
+            if (entry or {}).get("last_seen") and entry["last_seen"] < cutoff
+        }
+        if stale:
+            shard.reference.set({"users": stale}, merge=True)
+            removed += len(stale)
+    return removed
+
+
+def cleanup_stale_presence(
+    max_age: Optional[float] = None, batch_size: int = 400, force: bool = False
+) -> int:
+    """Delete presence docs older than `max_age` seconds. Returns the count.
+
+    Runs at most once per `config.PRESENCE_CLEANUP_INTERVAL` across all clients:
+    the last run is recorded in `presence_meta/cleanup` and a client that finds
+    a recent run skips the job (unless `force`).
+    """
+    db = fc.get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    now = _utcnow()
+    max_age = max_age or config.PRESENCE_TTL * 2
+
+    meta_ref = db.collection("presence_meta").document("cleanup")
+    if not force:
+        try:
+            meta = meta_ref.get()
+            last_run = meta.to_dict().get("last_run") if meta.exists else None
+            if last_run is not None and (now - last_run).total_seconds() < (
+                config.PRESENCE_CLEANUP_INTERVAL
+            ):
+                return 0
+        except Exception as e:
+            print(f"[WARN] Presence cleanup: could not read last run: {e}")
+    meta_ref.set({"last_run": now})
+
+    cutoff = now - timedelta(seconds=max_age)
+    if is_aggregated():
+        return _prune_shards(db, cutoff)
+
+    deleted = 0
+    while True:
+        docs = list(
+            db.collection("presence")
+            .where("last_seen", "<", cutoff)
+            .limit(batch_size)
+            .get()
+        )
+        if not docs:
+            break
+        batch = db.batch()
+        for d in docs:
+            batch.delete(d.reference)
+        batch.commit()
+        deleted += len(docs)
+        if len(docs) < batch_size:
+            break
+    return deleted
+
+
+class PresenceRoster:
+    """Thread-safe client-side view of online users with TTL expiry.
+
+    Listener threads feed it presence docs; the UI calls `expire()` from a
+    timer so users whose client crashed drop off without a server write.
+    """
+
+    def __init__(
+        self,
+        ttl: Optional[float] = None,
+        clock: Callable[[], datetime] = _utcnow,
+    ):
+        self.ttl = ttl or config.PRESENCE_TTL
+        self._clock = clock
+        self._lock = threading.Lock()
+        # username -> (last_seen, state)
+        self._entries: Dict[str, Tuple[datetime, str]] = {}
+
+    def _parse(self, data: dict) -> Iterable[Tuple[str, datetime, str]]:
+        """Yield (username, last_seen, state) from a presence or shard doc."""
+        if "users" in data:
+            items = (
+                dict(entry or {}, username=name)
+                for name, entry in (data.get("users") or {}).items()
+            )
+        else:
+            items = (data,)
+        for item in items:
+            username = item.get("username")
+            if not username:
+                continue
+            # Pending server timestamps come back as None in local snapshots
+            last_seen = item.get("last_seen") or self._clock()
+            yield username, last_seen, item.get("state") or STATE_ACTIVE
+
+    def replace(self, docs: Iterable) -> bool:
+        """Replace the roster with the docs (or shard docs) of a full snapshot."""
+        entries = {}
+        for doc in docs:
+            try:
+                for username, last_seen, state in self._parse(doc.to_dict() or {}):
+                    entries[username] = (last_seen, state)
+            except Exception:
+                continue
+        with self._lock:
+            changed = entries != self._entries
+            self._entries = entries
+        return self.expire() or changed
+
+    def expire(self, now: Optional[datetime] = None) -> bool:
+        """Drop entries older than the TTL. Returns True if anything changed."""
+        cutoff = (now or self._clock()) - timedelta(seconds=self.ttl)
+        with self._lock:
+            stale = [u for u, (seen, _) in self._entries.items() if seen < cutoff]
+            for user in stale:
+                del self._entries[user]
+        return bool(stale)
+
+    def online_users(self) -> List[str]:
+        with self._lock:
+            users = list(self._entries)
+        return sorted(users, key=str.lower)
+
+    def state_of(self, username: str) -> Optional[str]:
+        entry = self._entries.get(username)
+        return entry[1] if entry else None
+
+
+class ScopedPresenceWatcher:
+    """Watches presence for a chosen set of users with batched `in` queries.
+
+    Users are packed into chunks of at most `IN_QUERY_LIMIT`, one listener per
+    chunk. Changing the scope only re-subscribes the chunks that gained or
+    lost members. Every snapshot refreshes `roster` and calls `on_change()`
+    from the listener thread.
+    """
+
+    def __init__(
+        self,
+        roster: PresenceRoster,
+        on_change: Callable[[], None],
+        chunk_size: int = IN_QUERY_LIMIT,
+    ):
+        self._roster = roster
+        self._on_change = on_change
+        self._chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._chunks: List[set] = []
+        self._watchers: List[Optional[object]] = []
+        # per chunk: the subscription its snapshots must carry; drawn from
+        # one counter that never restarts, so a listener of a stopped or
+        # re-subscribed chunk can't match a newer one
+        self._generations: List[int] = []
+        self._generation = 0
+        self._docs: Dict[int, list] = {}
+
+    def scope(self) -> set:
+        with self._lock:
+            return set().union(*self._chunks)
+
+    def set_scope(self, usernames: Iterable[str]):
+        wanted = {u for u in usernames if u}
+        with self._lock:
+            touched = set()
+            for idx, chunk in enumerate(self._chunks):
+                gone = chunk - wanted
+                if gone:
+                    chunk -= gone
+                    touched.add(idx)
+            current = set().union(*self._chunks)
+            for user in sorted(wanted - current):
+                idx = next(
+                    (
+                        i
+                        for i, chunk in enumerate(self._chunks)
+                        if len(chunk) < self._chunk_size
+                    ),
+                    None,
+                )
+                if idx is None:
+                    self._chunks.append(set())
+                    self._watchers.append(None)
+                    self._generations.append(-1)
+                    idx = len(self._chunks) - 1
+                self._chunks[idx].add(user)
+                touched.add(idx)
+            for idx in sorted(touched):
+                self._resubscribe(idx)
+
+    def _resubscribe(self, idx: int):
+        _unsubscribe(self._watchers[idx])
+        self._watchers[idx] = None
+        self._generation += 1
+        self._generations[idx] = self._generation
+        self._docs[idx] = []
+        chunk = sorted(self._chunks[idx])
+        if not chunk:
+            return
+        db = fc.get_db()
+        if db is None:
+            raise RuntimeError("Firestore is not initialized")
+        generation = self._generation
+        query = db.collection("presence").where("username", "in", chunk)
+        self._watchers[idx] = query.on_snapshot(
+            lambda snap, changes, read_time: self._on_snapshot(idx, generation, snap)
+        )
+
+    def _on_snapshot(self, idx: int, generation: int, snapshot):
+        with self._lock:
+            if idx >= len(self._generations) or self._generations[idx] != generation:
+                return  # superseded by a re-subscription or stop()
+            self._docs[idx] = list(snapshot)
+            docs = [d for chunk_docs in self._docs.values() for d in chunk_docs]
+        self._roster.replace(docs)
+        self._on_change()
+
+    def stop(self):
+        with self._lock:
+            for watcher in self._watchers:
+                _unsubscribe(watcher)
+            self._chunks, self._watchers, self._generations = [], [], []
+            self._docs = {}
+
+
+def _unsubscribe(watcher):
+    if watcher is None:
+        return
+    try:
+        if hasattr(watcher, "unsubscribe"):
+            watcher.unsubscribe()
+        elif callable(watcher):
+            watcher()
+    except Exception as e:
+        print(f"[WARN] Presence watcher unsubscribe failed: {e}")
+
+
+class PresenceHeartbeat:
+    """Background presence writer with adaptive, jittered intervals.
+
+    `write_fn(state)` is called from the heartbeat thread. The UI reports
+    activity through `mark_activity()` and window visibility through
+    `set_minimised()`; both are cheap enough to call from Tk event bindings.
+    """
+
+    def __init__(
+        self,
+        write_fn: Callable[[str], None],
+        active_interval: Optional[float] = None,
+        idle_interval: Optional[float] = None,
+        hidden_interval: Optional[float] = None,
+        idle_after: Optional[float] = None,
+        jitter: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+        rand: Callable[[], float] = random.random,
+    ):
+        self._write = write_fn
+        self._intervals = {
+            STATE_ACTIVE: active_interval or config.PRESENCE_INTERVAL_ACTIVE,
+            STATE_IDLE: idle_interval or config.PRESENCE_INTERVAL_IDLE,
+            STATE_HIDDEN: hidden_interval or config.PRESENCE_INTERVAL_HIDDEN,
+        }
+        self.idle_after = idle_after or config.PRESENCE_IDLE_AFTER
+        self.jitter = config.PRESENCE_JITTER if jitter is None else jitter
+        self._clock = clock
+        self._rand = rand
+
+        self._last_activity = clock()
+        self._minimised = False
+        self._last_written_state: Optional[str] = None
+        self._last_write_at: Optional[float] = None
+        self._wake = threading.Event()
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def mark_activity(self):
+        """Record user input; wakes the loop if the user was idle."""
+        was_idle = self.current_state() == STATE_IDLE
+        self._last_activity = self._clock()
+        if was_idle:
+            self._wake.set()
+
+    def set_minimised(self, minimised: bool):
+        if minimised != self._minimised:
+            self._minimised = minimised
+            self._wake.set()
+
+    def current_state(self, now: Optional[float] = None) -> str:
+        if self._minimised:
+            return STATE_HIDDEN
+        now = self._clock() if now is None else now
+        if now - self._last_activity >= self.idle_after:
+            return STATE_IDLE
+        return STATE_ACTIVE
+
+    def interval_for(self, state: str) -> float:
+        return self._intervals[state]
+
+    def next_delay(self, state: str) -> float:
+        """Keep-alive interval for `state` spread by +/- `jitter`."""
+        base = self.interval_for(state)
+        spread = base * self.jitter
+        return max(1.0, base - spread + 2 * spread * self._rand())
+
+    def tick(self, now: Optional[float] = None) -> bool:
+        """Write presence if the state changed or the keep-alive is due.
+
+        Returns True when a write was made.
+        """
+        now = self._clock() if now is None else now
+        state = self.current_state(now)
+        due = (
+            self._last_write_at is None
+            or now - self._last_write_at >= self.interval_for(state) * (1 - self.jitter)
+        )
+        if state == self._last_written_state and not due:
+            return False
+        try:
+            self._write(state)
+        except Exception as e:
+            print(f"[ERROR] Presence heartbeat write failed: {e}")
+            return False
+        self._last_written_state = state
+        self._last_write_at = now
+        return True
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._wake.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+
+    def _run(self):
+        while self._running:
+            self.tick()
+            self._wake.wait(self.next_delay(self.current_state()))
+            self._wake.clear()
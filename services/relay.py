@@ -0,0 +1,414 @@
+"""Self-hosted message relay: an asyncio TCP server with a SQLite log.
+
+For teams on one LAN (or offline development) the relay replaces the round
+trip to Firestore: `python -m src.cli relay` serves the `MessageStore`
+operations over newline-delimited JSON and pushes new messages to
+subscribers as soon as they are written. Messages are appended to a SQLite
+log (WAL mode); presence is kept in memory with the usual TTL.
+
+Every connection starts with `{"op": "auth", "token": ..., "username": ...}`;
+other ops are refused until it succeeds. Without a username the token must
+be `config.RELAY_TOKEN` itself (service clients such as the IRC gateway);
+with one it must be `user_token(RELAY_TOKEN, username)`, and the
+connection may then only write as that user and only sees DM rooms the user
+is a participant of. DM membership always comes from the room id
+(`services.rooms.dm_participants`): a DM is only accepted when its
+participants are exactly the pair the id names.
+
+Wire protocol, one JSON object per line:
+    client -> server  {"id": n, "op": "...", ...params}
+    server -> client  {"id": n, "ok": true, "result": ...}
+                      {"id": n, "ok": false, "error": "..."}
+                      {"event": "messages", "sub": s, "messages": [...]}
+Subscription ids are chosen by the client so a push can never arrive
+before the client knows where to route it.
+
+`RelayStore` is the blocking client used by the app; a reader thread routes
+replies to waiting callers and runs stream callbacks (which therefore must
+not make blocking calls on the same store).
+"""
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+import config
+from services.message_store import MessageStore, Subscription, is_direct
+from services.rooms import dm_participants
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    room_id TEXT NOT NULL,
+    username TEXT,
+    text TEXT,
+    ts REAL NOT NULL,
+    participants TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_room ON messages (room_id, id);
+"""
+
+
+def user_token(secret: str, username: str) -> str:
+    """The relay token for `username`'s client, derived from the server secret."""
+    return hmac.new(
+        secret.encode("utf-8"), username.encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+
+
+def _visible(user: Optional[str], message: dict) -> bool:
+    """Whether a connection scoped to `user` (None: service) may see `message`."""
+    if user is None or not is_direct(message.get("room_id")):
+        return True
+    return user in (dm_participants(message["room_id"]) or ())
+
+
+def _row_to_wire(row) -> dict:
+    msg_id, room_id, username, text, ts, participants = row
+    return {
+        "_id": str(msg_id),
+        "room_id": room_id,
+        "username": username,
+        "text": text,
+        "ts": ts,
+        "participants": json.loads(participants) if participants else None,
+    }
+
+
+def from_wire(message: dict) -> dict:
+    """Wire message -> the store's message dict (epoch -> aware datetime)."""
+    data = dict(message)
+    ts = data.pop("ts", None)
+    data["timestamp"] = (
+        datetime.fromtimestamp(ts, tz=timezone.utc) if ts is not None else None
+    )
+    return data
+
+
+class RelayServer:
+    """Serves one SQLite message log to any number of TCP clients."""
+
+    def __init__(
+        self,
+        db_path: Optional[str] = None,
+        clock: Callable[[], float] = time.time,
+        token: Optional[str] = None,
+    ):
+        self.token = config.RELAY_TOKEN if token is None else token
+        if not self.token:
+            raise ValueError("RELAY_TOKEN is not set")
+        db_path = db_path or config.RELAY_DB_PATH
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # only ever used from the event loop thread
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self._clock = clock
+        # (writer, client sub id) -> room_id, or None for "all DM rooms"
+        self._subs: Dict[Tuple[asyncio.StreamWriter, int], Optional[str]] = {}
+        # authenticated connections -> their user (None: service client)
+        self._clients: Dict[asyncio.StreamWriter, Optional[str]] = {}
+        self._presence: Dict[str, float] = {}
+
+    async def start(self, host: Optional[str] = None, port: Optional[int] = None):
+        return await asyncio.start_server(
+            self.handle_client,
+            host or config.RELAY_HOST,
+            config.RELAY_PORT if port is None else port,
+        )
+
+    def close(self):
+        self.db.close()
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = {}
+                try:
+                    request = json.loads(line)
+                    op = request.get("op", "")
+                    if op != "auth" and writer not in self._clients:
+                        raise PermissionError("not authenticated")
+                    handler = getattr(self, "_op_" + op)
+                    reply = {"id": request.get("id"), "ok": True}
+                    reply["result"] = handler(writer, request)
+                except Exception as e:
+                    reply = {"id": request.get("id"), "ok": False, "error": str(e)}
+                self._send(writer, reply)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for key in [k for k in self._subs if k[0] is writer]:
+                del self._subs[key]
+            self._clients.pop(writer, None)
+            writer.close()
+
+    @staticmethod
+    def _send(writer, payload: dict):
+        if not writer.is_closing():
+            writer.write(json.dumps(payload).encode("utf-8") + b"\n")
+
+    # --- operations ---
+
+    def _op_auth(self, writer, request):
+        if writer in self._clients:
+            raise PermissionError("already authenticated")
+        username = request.get("username")
+        expected = self.token if username is None else user_token(self.token, username)
+        if not hmac.compare_digest(str(request.get("token") or ""), expected):
+            raise PermissionError("bad token")
+        self._clients[writer] = username
+
+    def _require_user(self, writer, username):
+        user = self._clients[writer]
+        if user is not None and username != user:
+            raise PermissionError(f"connection is scoped to {user}")
+
+    def _op_add(self, writer, request) -> str:
+        participants = request.get("participants")
+        self._require_user(writer, request.get("username"))
+        user = self._clients[writer]
+        if is_direct(request["room_id"]):
+            members = dm_participants(request["room_id"])
+            if members is None or sorted(participants or ()) != sorted(members):
+                raise ValueError("participants do not match the DM room id")
+            if user is not None and user not in members:
+                raise PermissionError("not a participant")
+        row = (
+            request["room_id"],
+            request.get("username"),
+            request.get("text"),
+            self._clock(),
+            json.dumps(sorted(participants)) if participants else None,
+        )
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO messages (room_id, username, text, ts, participants)"
+                " VALUES (?, ?, ?, ?, ?)",
+                row,
+            )
+        message = _row_to_wire((cursor.lastrowid,) + row)
+        for (sub_writer, sub), room_id in list(self._subs.items()):
+            if not _visible(self._clients.get(sub_writer), message):
+                continue
+            if room_id == message["room_id"] or (
+                room_id is None and is_direct(message["room_id"])
+            ):
+                self._send(
+                    sub_writer, {"event": "messages", "sub": sub, "messages": [message]}
+                )
+        return message["_id"]
+
+    def _op_history(self, writer, request) -> List[dict]:
+        before = request.get("before_id")
+        rows = self.db.execute(
+            "SELECT id, room_id, username, text, ts, participants FROM messages"
+            " WHERE room_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (
+                request["room_id"],
+                int(before) if before else 2**63 - 1,
+                int(request.get("limit", 50)),
+            ),
+        ).fetchall()
+        user = self._clients[writer]
+        messages = [_row_to_wire(row) for row in reversed(rows)]
+        return [m for m in messages if _visible(user, m)]
+
+    def _op_subscribe(self, writer, request):
+        self._subs[(writer, request["sub"])] = request.get("room_id")
+
+    def _op_unsubscribe(self, writer, request):
+        self._subs.pop((writer, request["sub"]), None)
+
+    def _op_delete_room(self, writer, request) -> int:
+        user = self._clients[writer]
+        # users may only delete their own DM rooms
+        if user is not None and user not in (dm_participants(request["room_id"]) or ()):
+            raise PermissionError(f"cannot delete {request['room_id']}")
+        with self.db:
+            cursor = self.db.execute(
+                "DELETE FROM messages WHERE room_id = ?", (request["room_id"],)
+            )
+        return cursor.rowcount
+
+    def _op_set_presence(self, writer, request):
+        self._require_user(writer, request["username"])
+        self._presence[request["username"]] = self._clock()
+
+    def _op_clear_presence(self, writer, request):
+        self._require_user(writer, request["username"])
+        self._presence.pop(request["username"], None)
+
+    def _op_online(self, writer, request) -> List[str]:
+        cutoff = self._clock() - config.PRESENCE_TTL
+        users = [u for u, seen in self._presence.items() if seen >= cutoff]
+        return sorted(users, key=str.lower)
+
+
+class RelayStore(MessageStore):
+    """Blocking `MessageStore` client for a `RelayServer`.
+
+    `token` defaults to `config.RELAY_TOKEN`; pass `username` when it is that
+    user's token (see `user_token`).
+    """
+
+    def __init__(
+        self,
+        host: Optional[str] = None,
+        port: Optional[int] = None,
+        timeout: Optional[float] = None,
+        token: Optional[str] = None,
+        username: Optional[str] = None,
+    ):
+        self.timeout = timeout or config.RELAY_TIMEOUT
+        self._sock = socket.create_connection(
+            (host or config.RELAY_HOST, port or config.RELAY_PORT), self.timeout
+        )
+        self._sock.settimeout(None)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile("rb")
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, list] = {}
+        self._callbacks: Dict[int, Callable] = {}
+        self._closed = False
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+        try:
+            self._call(
+                "auth",
+                token=config.RELAY_TOKEN if token is None else token,
+                username=username,
+            )
+        except Exception:
+            self.close()
+            raise
+
+    def _read_loop(self):
+        try:
+            for line in self._file:
+                payload = json.loads(line)
+                if "event" in payload:
+                    callback = self._callbacks.get(payload.get("sub"))
+                    if callback is not None:
+                        try:
+                            callback([from_wire(m) for m in payload["messages"]])
+                        except Exception as e:
+                            print(f"[WARN] Relay stream callback failed: {e}")
+                    continue
+                with self._lock:
+                    waiter = self._pending.pop(payload.get("id"), None)
+                if waiter is not None:
+                    waiter[1] = payload
+                    waiter[0].set()
+        except (OSError, ValueError) as e:
+            if not self._closed:
+                print(f"[WARN] Relay connection lost: {e}")
+        finally:
+            with self._lock:
+                waiters, self._pending = list(self._pending.values()), {}
+            for waiter in waiters:
+                waiter[0].set()
+
+    def _call(self, op: str, **params):
+        request_id = next(self._ids)
+        waiter = [threading.Event(), None]
+        with self._lock:
+            self._pending[request_id] = waiter
+        line = json.dumps(dict(params, id=request_id, op=op)).encode("utf-8") + b"\n"
+        with self._send_lock:
+            self._sock.sendall(line)
+        if not waiter[0].wait(self.timeout) or waiter[1] is None:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise ConnectionError(f"relay did not answer {op}")
+        reply = waiter[1]
+        if not reply.get("ok"):
+            raise RuntimeError(f"relay {op} failed: {reply.get('error')}")
+        return reply.get("result")
+
+    def add(self, room_id, username, text, participants=None):
+        return self._call(
+            "add",
+            room_id=room_id,
+            username=username,
+            text=text,
+            participants=participants,
+        )
+
+    def history(self, room_id, limit=50, before=None):
+        before_id = before.get("_id") if before else None
+        messages = self._call(
+            "history", room_id=room_id, limit=limit, before_id=before_id
+        )
+        return [from_wire(m) for m in messages]
+
+    def _subscribe(self, room_id, callback):
+        sub = next(self._ids)
+        self._callbacks[sub] = callback
+        self._call("subscribe", sub=sub, room_id=room_id)
+
+        def unsubscribe():
+            self._callbacks.pop(sub, None)
+            if not self._closed:
+                self._call("unsubscribe", sub=sub)
+
+        return Subscription(unsubscribe)
+
+    def stream(self, room_id, callback):
+        return self._subscribe(room_id, callback)
+
+    def stream_direct(self, callback):
+        return self._subscribe(None, callback)
+
+    def delete_room(self, room_id):
+        return self._call("delete_room", room_id=room_id)
+
+    def set_presence(self, username, state="active"):
+        self._call("set_presence", username=username, state=state)
+
+    def clear_presence(self, username):
+        self._call("clear_presence", username=username)
+
+    def online_users(self):
+        return self._call("online")
+
+    def close(self):
+        self._closed = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+
+async def serve(
+    host: Optional[str] = None,
+    port: Optional[int] = None,
+    db_path: Optional[str] = None,
+):
+    """Run a relay server until cancelled."""
+    relay = RelayServer(db_path)  # raises without RELAY_TOKEN
+    server = await relay.start(host, port)
+    addresses = ", ".join(str(s.getsockname()) for s in server.sockets)
+    print(f"[LOG] Message relay listening on {addresses}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        relay.close()
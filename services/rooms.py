@@ -0,0 +1,310 @@
+"""Room registry: O(1) channel <-> room_id lookups and explicit DM membership.
+
+A channel is what the UI shows ("lobby" or the other user's name); a room_id
+is what messages are stored under. DM rooms are `dm_<a>_<b>` with both
+usernames escaped ("_" -> "%5F"), so the id is unambiguous and, for names
+without underscores, the same as the legacy unescaped one. Legacy ids of
+underscore names collide ("a" + "b_c" and "a_b" + "c" are both `dm_a_b_c`);
+they are only used for rooms whose `rooms/<room_id>` metadata names the
+participants, or whose messages show they hold the pair's older history
+(`find_legacy_dm_room`, checked when such a DM is opened). Participants are stored explicitly there (and on each message)
+so membership never has to be guessed from the id.
+"""
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import services.firestore_client as fc
+
+LOBBY = "lobby"
+ROOMS_COLLECTION = "rooms"
+# messages checked before a legacy DM room is taken over
+LEGACY_PROBE_MESSAGES = 20
+DM_PREFIX = "dm_"
+# first string after every "dm_..." id ("`" follows "_" in ASCII)
+DM_PREFIX_END = "dm`"
+
+
+def _escape(username: str) -> str:
+    return username.replace("%", "%25").replace("_", "%5F")
+
+
+def _unescape(part: str) -> str:
+    return part.replace("%5F", "_").replace("%25", "%")
+
+
+def dm_room_id(user1: str, user2: str) -> str:
+    """Deterministic, sorted, unambiguous room id for a DM between two users."""
+    return "dm_" + "_".join(_escape(u) for u in sorted([user1, user2]))
+
+
+def dm_participants(room_id: str) -> Optional[Tuple[str, str]]:
+    """The two users of an escaped DM room id; None for any other id."""
+    if not room_id or not room_id.startswith(DM_PREFIX):
+        return None
+    parts = room_id[len(DM_PREFIX) :].split("_")
+    if len(parts) != 2:
+        return None
+    names = (_unescape(parts[0]), _unescape(parts[1]))
+    return names if dm_room_id(*names) == room_id else None
+
+
+def legacy_dm_room_id(user1: str, user2: str) -> str:
+    """The unescaped id older clients created (ambiguous for "_" in names)."""
+    return f"dm_{'_'.join(sorted([user1, user2]))}"
+
+
+def dm_partner(room_id: str, username: str) -> Optional[str]:
+    """Other participant of DM room `room_id` if `username` is in it.
+
+    Exact: "ann" does not match "dm_joanna_bob". Legacy ids of underscore
+    names are parsed as well; a candidate is only accepted if
+    `legacy_dm_room_id` rebuilds the same id, but such ids can still fit two
+    pairs, so explicit participants win wherever they are known.
+    """
+    if not room_id or not username or not room_id.startswith("dm_"):
+        return None
+    rest = room_id[3:]
+    parts = rest.split("_")
+    if len(parts) == 2:
+        names = [_unescape(p) for p in parts]
+        if username in names and dm_room_id(*names) == room_id:
+            names.remove(username)
+            return names[0]
+    candidates = []
+    if rest.startswith(username + "_"):
+        candidates.append(rest[len(username) + 1 :])
+    if rest.endswith("_" + username):
+        candidates.append(rest[: -len(username) - 1])
+    for other in candidates:
+        if other and legacy_dm_room_id(username, other) == room_id:
+            return other
+    return None
+
+
+class RoomRegistry:
+    """Bidirectional channel <-> room_id map with per-room participant lists."""
+
+    def __init__(self, username: Optional[str] = None):
+        self._lock = threading.Lock()
+        self.reset(username)
+
+    def reset(self, username: Optional[str] = None):
+        with self._lock:
+            self.username = username
+            self._channel_to_room: Dict[str, str] = {}
+            self._room_to_channel: Dict[str, str] = {}
+            self._participants: Dict[str, Tuple[str, ...]] = {}
+
+    def __contains__(self, channel: str) -> bool:
+        return channel in self._channel_to_room
+
+    def register(self, channel: str, room_id: str, participants: Iterable[str]):
+        with self._lock:
+            old_room = self._channel_to_room.get(channel)
+            if old_room is not None and old_room != room_id:
+                self._room_to_channel.pop(old_room, None)
+            self._channel_to_room[channel] = room_id
+            self._room_to_channel[room_id] = channel
+            self._participants[room_id] = tuple(sorted(participants))
+
+    def register_dm(self, other: str) -> str:
+        """Register the DM with `other` and return its room_id."""
+        room_id = dm_room_id(self.username, other)
+        self.register(other, room_id, (self.username, other))
+        return room_id
+
+    def register_room_doc(self, room_id: str, participants: Iterable[str]) -> bool:
+        """Register a DM from its metadata doc. Returns False if we're not in it.
+
+        The participant list is remembered either way, so `is_member` stays
+        authoritative for rooms whose legacy id is ambiguous.
+        """
+        participants = tuple(sorted(participants or ()))
+        others = [p for p in participants if p != self.username]
+        if self.username not in participants or len(others) != 1:
+            with self._lock:
+                self._participants[room_id] = participants
+            return False
+        self.register(others[0], room_id, participants)
+        return True
+
+    def remove(self, channel: str):
+        with self._lock:
+            room_id = self._channel_to_room.pop(channel, None)
+            if room_id is not None:
+                self._room_to_channel.pop(room_id, None)
+                self._participants.pop(room_id, None)
+
+    def room_for_channel(self, channel: str) -> Optional[str]:
+        """room_id for `channel`; unknown DM channels resolve to their dm id."""
+        if channel == LOBBY:
+            return LOBBY
+        room_id = self._channel_to_room.get(channel)
+        if room_id is None and self.username and channel:
+            room_id = dm_room_id(self.username, channel)
+        return room_id
+
+    def channel_for_room(self, room_id: str) -> Optional[str]:
+        if not room_id:
+            return None
+        if room_id == LOBBY:
+            return LOBBY
+        channel = self._room_to_channel.get(room_id)
+        if channel is None:
+            channel = dm_partner(room_id, self.username)
+        return channel
+
+    def participants(self, room_id: str) -> Tuple[str, ...]:
+        return self._participants.get(room_id, ())
+
+    def is_member(self, room_id: str, username: Optional[str] = None) -> bool:
+        username = username or self.username
+        if room_id == LOBBY:
+            return True
+        known = self._participants.get(room_id)
+        if known is not None:
+            return username in known
+        return dm_partner(room_id, username) is not None
+
+    def dm_channels(self) -> Dict[str, str]:
+        """Snapshot of {channel: room_id} for DM rooms."""
+        with self._lock:
+            return dict(self._channel_to_room)
+
+
+def save_room(room_id: str, participants: Iterable[str]):
+    """Create/update the `rooms/<room_id>` metadata doc."""
+    db = fc.get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    db.collection(ROOMS_COLLECTION).document(room_id).set(
+        {"type": "dm", "participants": sorted(participants)}, merge=True
+    )
+
+
+def load_rooms_for_user(username: str):
+    """Return [(room_id, participants)] for every room `username` is in."""
+    db = fc.get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    docs = (
+        db.collection(ROOMS_COLLECTION)
+        .where("participants", "array_contains", username)
+        .get()
+    )
+    return [(d.id, (d.to_dict() or {}).get("participants") or []) for d in docs]
+
+
+def find_legacy_dm_room(user1: str, user2: str) -> Optional[str]:
+    """Legacy room id holding the DM history of this pair, if it should be used.
+
+    Only for names with "_" (otherwise both ids are the same): returns the
+    unescaped id when the escaped room has no messages yet and the newest
+    `LEGACY_PROBE_MESSAGES` of the legacy room were all written by this pair
+    (and, where recorded, list exactly them as participants) - the legacy id
+    may also belong to another pair.
+    """
+    room_id, legacy = dm_room_id(user1, user2), legacy_dm_room_id(user1, user2)
+    if legacy == room_id:
+        return None
+    db = fc.get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    messages = db.collection("messages")
+    if list(messages.where("room_id", "==", room_id).limit(1).get()):
+        return None
+    docs = list(
+        messages.where("room_id", "==", legacy).limit(LEGACY_PROBE_MESSAGES).get()
+    )
+    pair = sorted([user1, user2])
+    for doc in docs:
+        data = doc.to_dict() or {}
+        participants = data.get("participants")
+        if data.get("username") not in pair or (
+            participants and sorted(participants) != pair
+        ):
+            return None
+    return legacy if docs else None
+
+
+def _first_message_per_dm_room(db) -> Iterator[dict]:
+    """One message of every DM room in `messages`, in room id order.
+
+    Skips from room to room with single-document reads (a range on room_id
+    needs no composite index), so it costs one read per DM room.
+    """
+    last = None
+    while True:
+        q = db.collection("messages")
+        if last is None:
+            q = q.where("room_id", ">=", DM_PREFIX)
+        else:
+            q = q.where("room_id", ">", last)
+        docs = list(
+            q.where("room_id", "<", DM_PREFIX_END).order_by("room_id").limit(1).get()
+        )
+        if not docs:
+            return
+        data = docs[0].to_dict() or {}
+        last = data.get("room_id")
+        if not last:
+            return
+        yield data
+
+
+def dm_room_ids() -> List[str]:
+    """Every DM room id that has messages, including legacy ones without
+    `rooms` metadata (one read per room)."""
+    db = fc.get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    return [data["room_id"] for data in _first_message_per_dm_room(db)]
+
+
+def scan_dm_rooms(username: str) -> List[Tuple[str, List[str]]]:
+    """Return [(room_id, participants)] for every DM room `username` wrote or
+    received messages in, found from `messages` itself.
+
+    For DMs older than the `rooms` metadata: walks every DM room (one read
+    per room, of every user), so it is meant for one-off backfills such as
+    seeding the conversation index.
+    """
+    db = fc.get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    found: List[Tuple[str, List[str]]] = []
+    for data in _first_message_per_dm_room(db):
+        room_id = data["room_id"]
+        participants = sorted(data.get("participants") or [])
+        if participants:
+            if username in participants and len(participants) == 2:
+                found.append((room_id, participants))
+            continue
+        other = dm_partner(room_id, username)
+        if other is not None:
+            found.append((room_id, sorted([username, other])))
+    return found
+
+
+def recent_dm_rooms(username: str, scan: int = 50) -> List[str]:
+    """DM room ids among `username`'s newest `scan` DM messages, most recent first.
+
+    One query over the explicit `participants` field (needs the composite
+    index participants + timestamp desc), so it costs at most `scan` reads.
+    """
+    db = fc.get_db()
+    if db is None:
+        raise RuntimeError("Firestore is not initialized")
+    docs = (
+        db.collection("messages")
+        .where("participants", "array_contains", username)
+        .order_by("timestamp", direction=fc.firestore.Query.DESCENDING)
+        .limit(scan)
+        .get()
+    )
+    room_ids: List[str] = []
+    for doc in docs:
+        room_id = (doc.to_dict() or {}).get("room_id")
+        if room_id and room_id not in room_ids:
+            room_ids.append(room_id)
+    return room_ids
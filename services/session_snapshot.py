@@ -0,0 +1,116 @@
+"""Session snapshot: what the chat looked like last time, for a warm start.
+
+On exit (and every `config.SNAPSHOT_INTERVAL_MS` while chatting) the client
+writes a compact JSON snapshot per user under `config.APP_DATA_DIR`: the DM
+rooms with their participants, unread counts, the newest
+`config.SNAPSHOT_MESSAGES_PER_ROOM` rendered messages per channel and the last
+online roster. Right after the next login the UI paints from it; the first
+history page of the open room then corrects messages edited or deleted in
+the meantime.
+
+Messages are stored as `services.sync_process` compact tuples. Snapshots of
+another version, or files that fail to parse, are ignored.
+"""
+import json
+import os
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import config
+from services.sync_process import compact_message, expand_message
+
+VERSION = 1
+
+
+class SessionSnapshot(NamedTuple):
+    # channel -> (room_id, participants) for the sidebar DMs
+    dms: Dict[str, Tuple[str, Tuple[str, ...]]] = {}
+    # channel -> unread message count
+    unread: Dict[str, int] = {}
+    # channel -> newest rendered messages, oldest first (renderer dicts)
+    messages: Dict[str, List[dict]] = {}
+    online: Tuple[str, ...] = ()
+
+
+def to_record(snapshot: SessionSnapshot) -> dict:
+    return {
+        "version": VERSION,
+        "saved_at": time.time(),
+        "dms": {
+            channel: [room_id, list(participants)]
+            for channel, (room_id, participants) in snapshot.dms.items()
+        },
+        "unread": dict(snapshot.unread),
+        "messages": {
+            channel: [compact_message(m.get("_id"), m) for m in messages]
+            for channel, messages in snapshot.messages.items()
+        },
+        "online": list(snapshot.online),
+    }
+
+
+def _unread_counts(unread) -> Dict[str, int]:
+    # snapshots written before the counts only list the unread channels
+    if isinstance(unread, list):
+        return dict.fromkeys(unread, 1)
+    return {channel: int(count) for channel, count in unread.items()}
+
+
+def from_record(record: dict) -> Optional[SessionSnapshot]:
+    if not isinstance(record, dict) or record.get("version") != VERSION:
+        return None
+    try:
+        return SessionSnapshot(
+            dms={
+                channel: (room_id, tuple(participants))
+                for channel, (room_id, participants) in record["dms"].items()
+            },
+            unread=_unread_counts(record["unread"]),
+            messages={
+                channel: [expand_message(tuple(m)) for m in messages]
+                for channel, messages in record["messages"].items()
+            },
+            online=tuple(record["online"]),
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        print(f"[WARN] Ignoring malformed session snapshot: {e}")
+        return None
+
+
+class SnapshotStore:
+    """One snapshot file per user; writes are atomic (temp file + rename)."""
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or os.path.join(config.APP_DATA_DIR, "snapshots")
+        # the periodic save runs on a worker thread, the exit save on Tk's
+        self._lock = threading.Lock()
+
+    def path(self, username: str) -> str:
+        return os.path.join(self.directory, f"{username}.json")
+
+    def save(self, username: str, snapshot: SessionSnapshot):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(username)
+        tmp = path + ".tmp"
+        record = to_record(snapshot)
+        with self._lock:
+            # recent DM text: create the file user-readable only
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(record, f, separators=(",", ":"))
+            os.replace(tmp, path)
+
+    def load(self, username: str) -> Optional[SessionSnapshot]:
+        try:
+            with open(self.path(username), encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return from_record(record)
+
+    def clear(self, username: str):
+        try:
+            os.remove(self.path(username))
+        except OSError:
+            pass
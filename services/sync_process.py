@@ -0,0 +1,427 @@
+"""Optional sync process: Firestore listeners outside the Tk process.
+
+With `config.SYNC_PROCESS` enabled the GUI starts a child process that owns
+its own Firestore client, the room / global DM / presence listeners and a
+per-room message cache. Snapshot decoding happens there, and only compact,
+picklable deltas cross the process boundary over a `multiprocessing` queue,
+so gRPC callbacks and protobuf decoding never compete with the Tk loop for
+the GIL. The UI drains the event queue from an `after()` timer with
+`SyncProcess.poll()`.
+
+Writes (sending, presence heartbeat, deletes) stay in the UI process; they
+are single calls already made off the UI thread.
+
+Commands (UI -> sync):
+    ("login", username)
+    ("watch_room", room_id, generation, limit)
+    ("presence_scope", [usernames])
+    ("logout",)
+    ("stop",)
+
+Events (sync -> UI):
+    ("ready", ok)
+    ("history", room_id, generation, [message])
+    ("changes", room_id, generation, [added], [modified], [removed_id])
+    ("presence", [usernames])
+    ("dm", room_id, sender, participants)
+
+A message is the tuple `(id, username, text, epoch_seconds, participants)`;
+`expand_message` turns it back into the dict shape the renderer expects.
+"""
+import multiprocessing
+import queue
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Callable, List, Optional, Tuple
+
+import config
+import services.firestore_client as fc
+from services.archive import compacted
+from services.costs import get_meter, tagged
+from services.listeners import ListenerSupervisor
+from services.presence import (
+    PresenceRoster,
+    ScopedPresenceWatcher,
+    is_scoped,
+    presence_query,
+)
+
+Message = Tuple[str, Optional[str], Optional[str], Optional[float], Optional[tuple]]
+
+
+def compact_message(doc_id: str, data: dict) -> Message:
+    """Decode a message doc into the tuple sent to the UI process."""
+    ts = data.get("timestamp")
+    epoch = ts.timestamp() if hasattr(ts, "timestamp") else None
+    participants = data.get("participants")
+    return (
+        doc_id,
+        data.get("username"),
+        data.get("text"),
+        epoch,
+        tuple(participants) if participants else None,
+    )
+
+
+def expand_message(message: Message) -> dict:
+    """The renderer's message dict for a compact message."""
+    doc_id, username, text, epoch, participants = message
+    data = {"_id": doc_id, "username": username, "text": text}
+    data["timestamp"] = (
+        datetime.fromtimestamp(epoch, tz=timezone.utc) if epoch is not None else None
+    )
+    if participants:
+        data["participants"] = list(participants)
+    return data
+
+
+def _since_epoch(messages) -> Optional[float]:
+    epochs = [m[3] for m in messages if m[3] is not None]
+    return min(epochs) if epochs else None
+
+
+class SyncEngine:
+    """Listeners and cache living in the sync process; emits compact events.
+
+    `emit` is called from listener threads as well as the command loop, so it
+    must be thread-safe (a `multiprocessing.Queue.put` is).
+    """
+
+    def __init__(
+        self,
+        emit: Callable[[tuple], None],
+        supervisor: Optional[ListenerSupervisor] = None,
+        cache_rooms: Optional[int] = None,
+        cache_messages: Optional[int] = None,
+    ):
+        self._emit = emit
+        self._listeners = supervisor or ListenerSupervisor()
+        self.cache_rooms = cache_rooms or config.SYNC_CACHE_ROOMS
+        self.cache_messages = cache_messages or config.CHAT_SCROLLBACK_LIMIT
+        self._lock = threading.Lock()
+        # room_id -> OrderedDict(id -> message), oldest first; LRU over rooms
+        self._cache: "OrderedDict[str, OrderedDict]" = OrderedDict()
+        self._roster = PresenceRoster()
+        self._scoped: Optional[ScopedPresenceWatcher] = None
+        self._online: List[str] = []
+        self.username: Optional[str] = None
+
+    # --- commands ---
+
+    def handle(self, command: tuple) -> bool:
+        """Run one command. Returns False when the loop should exit."""
+        kind = command[0]
+        if kind == "stop":
+            return False
+        if kind == "login":
+            self.login(command[1])
+        elif kind == "watch_room":
+            self.watch_room(*command[1:])
+        elif kind == "presence_scope":
+            self.set_presence_scope(command[1])
+        elif kind == "logout":
+            self.logout()
+        else:
+            print(f"[WARN] Unknown sync command: {kind}")
+        return True
+
+    def login(self, username: str):
+        self.logout()
+        self.username = username
+        self._listeners.start()
+        self._watch_global()
+        self._watch_presence()
+
+    def logout(self):
+        self._listeners.stop()
+        if self._scoped is not None:
+            self._scoped.stop()
+            self._scoped = None
+        self._roster.replace(())
+        self._online = []
+        self.username = None
+
+    def stop(self):
+        self.logout()
+
+    # --- room messages ---
+
+    def _room_cache(self, room_id: str) -> OrderedDict:
+        cache = self._cache.get(room_id)
+        if cache is None:
+            cache = self._cache[room_id] = OrderedDict()
+        self._cache.move_to_end(room_id)
+        while len(self._cache) > self.cache_rooms:
+            self._cache.popitem(last=False)
+        return cache
+
+    def _store(self, cache: OrderedDict, messages, removed=()):
+        for msg_id in removed:
+            cache.pop(msg_id, None)
+        for message in messages:
+            cache[message[0]] = message
+        ordered = sorted(cache.values(), key=lambda m: m[3] or float("inf"))
+        cache.clear()
+        for message in ordered[-self.cache_messages :]:
+            cache[message[0]] = message
+
+    @tagged("history")
+    def _fetch_history(self, room_id: str, limit: int) -> List[Message]:
+        docs, _ = fc.get_history_paginated(room_id, limit=limit, direction="desc")
+        messages = [compact_message(d.id, d.to_dict() or {}) for d in docs]
+        messages.sort(key=lambda m: m[3] or 0)
+        return messages
+
+    @tagged("room_listener")
+    def watch_room(self, room_id: str, generation: int, limit: int = 100):
+        """Emit the room's history (cached, else fetched) and listen for changes.
+
+        A cached room skips the history read: the listener starts at the
+        oldest cached message, and its first snapshot is diffed against the
+        cache, so messages edited or deleted while the room was not watched
+        still reach the UI as MODIFIED / REMOVED deltas.
+        """
+        with self._lock:
+            cached = list(self._cache.get(room_id, {}).values())
+        if cached:
+            history = cached[-limit:]
+        else:
+            try:
+                history = self._fetch_history(room_id, limit)
+            except Exception as e:
+                print(f"[WARN] Sync history load failed for {room_id}: {e}")
+                history = []
+        with self._lock:
+            self._store(self._room_cache(room_id), history)
+        self._emit(("history", room_id, generation, history))
+
+        oldest = _since_epoch(history)
+        # lower bound of the current subscription, recorded when its query is built
+        bound = {"since": None, "fresh": False}
+
+        def make_query(resume_from=None):
+            db = fc.get_db()
+            query = db.collection("messages").where("room_id", "==", room_id)
+            since = resume_from
+            if since is None and oldest is not None:
+                since = datetime.fromtimestamp(oldest, tz=timezone.utc)
+            if since is not None:
+                query = query.where("timestamp", ">=", since)
+            bound["since"] = since.timestamp() if since is not None else None
+            bound["fresh"] = True
+            return query
+
+        def on_snapshot(snapshot, changes, read_time):
+            fresh, bound["fresh"] = bound["fresh"], False
+            self._on_room_snapshot(
+                room_id, generation, snapshot, changes, fresh, bound["since"]
+            )
+
+        self._listeners.add("room", make_query, on_snapshot)
+
+    def _on_room_snapshot(self, room_id, generation, snapshot, changes, fresh, since):
+        added, modified, removed = [], [], []
+        with self._lock:
+            cache = self._room_cache(room_id)
+            for change in changes or ():
+                try:
+                    kind = change.type.name
+                    doc = change.document
+                    if kind == "REMOVED":
+                        # compaction moved it into a chunk: still valid
+                        timestamp = (doc.to_dict() or {}).get("timestamp")
+                        if doc.id in cache and not compacted(timestamp):
+                            removed.append(doc.id)
+                        continue
+                    message = compact_message(doc.id, doc.to_dict() or {})
+                except Exception:
+                    continue
+                known = cache.get(message[0])
+                if known is None:
+                    added.append(message)
+                elif known != message:
+                    modified.append(message)
+            if fresh:
+                # first snapshot of a subscription: cached messages inside its
+                # range that it didn't return were deleted in the meantime
+                present = {getattr(d, "id", None) for d in snapshot or ()}
+                removed.extend(
+                    msg_id
+                    for msg_id, m in cache.items()
+                    if msg_id not in present
+                    and (since is None or (m[3] is not None and m[3] >= since))
+                    and not compacted(m[3])
+                    and msg_id not in removed
+                )
+            self._store(cache, added + modified, removed)
+        if added or modified or removed:
+            self._emit(("changes", room_id, generation, added, modified, removed))
+
+    # --- incoming DMs ---
+
+    @tagged("global_listener")
+    def _watch_global(self):
+        session_start = datetime.now(timezone.utc)
+
+        def make_query(resume_from=None):
+            return (
+                fc.get_db()
+                .collection("messages")
+                .where("timestamp", ">=", resume_from or session_start)
+            )
+
+        self._listeners.add("global", make_query, self._on_global_snapshot)
+
+    def _on_global_snapshot(self, snapshot, changes, read_time):
+        for change in changes or ():
+            try:
+                if change.type.name != "ADDED":
+                    continue
+                data = change.document.to_dict() or {}
+            except Exception:
+                continue
+            room_id = data.get("room_id")
+            sender = data.get("username")
+            if not room_id or not sender or not room_id.startswith("dm_"):
+                continue
+            if sender == self.username:
+                continue
+            participants = data.get("participants")
+            self._emit(
+                ("dm", room_id, sender, tuple(participants) if participants else None)
+            )
+
+    # --- presence ---
+
+    @tagged("presence")
+    def _watch_presence(self):
+        if is_scoped():
+            self._scoped = ScopedPresenceWatcher(self._roster, self._emit_presence)
+            return
+        self._listeners.add(
+            "presence",
+            lambda resume_from=None: presence_query(),
+            self._on_presence_snapshot,
+        )
+
+    def _on_presence_snapshot(self, snapshot, changes, read_time):
+        self._roster.replace(snapshot)
+        self._emit_presence()
+
+    @tagged("presence")
+    def set_presence_scope(self, usernames):
+        if self._scoped is None:
+            return
+        scope = set(usernames)
+        if scope == self._scoped.scope():
+            return
+        try:
+            self._scoped.set_scope(scope)
+        except Exception as e:
+            print(f"[WARN] Sync presence scope change failed: {e}")
+
+    def _emit_presence(self):
+        online = self._roster.online_users()
+        if online != self._online:
+            self._online = online
+            self._emit(("presence", online))
+
+    def tick(self):
+        """Periodic work between commands: TTL expiry of the presence roster."""
+        if self.username and self._roster.expire():
+            self._emit_presence()
+
+
+def run_sync(commands, events, key_path: Optional[str] = None):
+    """Entry point of the sync process."""
+    db = fc.init_firestore(key_path)
+    events.put(("ready", db is not None))
+    if db is None:
+        return
+    engine = SyncEngine(events.put)
+    try:
+        while True:
+            try:
+                command = commands.get(timeout=config.PRESENCE_EXPIRE_TICK)
+            except queue.Empty:
+                engine.tick()
+                continue
+            try:
+                if not engine.handle(command):
+                    break
+            except Exception as e:
+                print(f"[ERROR] Sync command {command[0]} failed: {e}")
+    finally:
+        engine.stop()
+        print(f"[LOG] Sync process Firestore usage:\n{get_meter().summary()}")
+
+
+class SyncProcess:
+    """UI-side handle: starts the sync process, sends commands, drains events."""
+
+    def __init__(self, key_path: Optional[str] = None, context=None):
+        # spawn: the gRPC client must not be inherited through fork()
+        self._ctx = context or multiprocessing.get_context("spawn")
+        self._key_path = key_path or config.KEY_JSON_PATH
+        self._commands = self._ctx.Queue()
+        self._events = self._ctx.Queue()
+        self._process = None
+        self._generation = 0
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._process = self._ctx.Process(
+            target=run_sync,
+            args=(self._commands, self._events, self._key_path),
+            name="chat-sync",
+            daemon=True,
+        )
+        self._process.start()
+
+    def send(self, *command):
+        self._commands.put(command)
+
+    def login(self, username: str):
+        self.send("login", username)
+
+    def logout(self):
+        self.send("logout")
+
+    def watch_room(self, room_id: str, limit: int = 100) -> int:
+        """Switch the watched room. Returns the generation its events carry."""
+        self._generation += 1
+        self.send("watch_room", room_id, self._generation, limit)
+        return self._generation
+
+    def is_current(self, generation: int) -> bool:
+        return generation == self._generation
+
+    def set_presence_scope(self, usernames):
+        self.send("presence_scope", sorted(usernames))
+
+    def poll(self, max_events: Optional[int] = None) -> List[tuple]:
+        """Up to `max_events` pending events, without blocking."""
+        max_events = max_events or config.SYNC_POLL_BATCH
+        events = []
+        while len(events) < max_events:
+            try:
+                events.append(self._events.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+    def stop(self, timeout: float = 5.0):
+        if self._process is None:
+            return
+        if self._process.is_alive():
+            self.send("stop")
+            self._process.join(timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+        self._process = None
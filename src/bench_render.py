@@ -0,0 +1,99 @@
+"""Benchmark: per-message history rendering vs the batched insert path.
+
+Needs a display (it creates a real Tk text widget):
+    python -m src.bench_render [--messages 100] [--rounds 20] [--ctk]
+
+The per-message path mirrors the previous `_insert_message_to_history` loop
+(an index query, two inserts and fresh time formatting per message); the
+batched path is `utils.render.build_batch` plus one multi-segment insert.
+Both set the same start/end marks per message.
+"""
+import argparse
+import time
+import tkinter as tk
+from datetime import datetime, timedelta, timezone
+
+from utils.render import build_batch
+
+
+def _messages(count):
+    t0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    return [
+        {
+            "_id": f"m{i}",
+            "username": "me" if i % 3 == 0 else f"user{i % 7}",
+            "text": f"message number {i} " * 3,
+            "timestamp": t0 + timedelta(seconds=37 * i),
+        }
+        for i in range(count)
+    ]
+
+
+def per_message(text, messages):
+    for data in messages:
+        start = text.index("end-1c")
+        ts = data["timestamp"]
+        time_str = f"[{ts.strftime('%H:%M')}]"
+        tag = "user_msg" if data["username"] == "me" else "other_msg"
+        text.insert(tk.END, f"{time_str} {data['username']}: ", tag)
+        text.insert(tk.END, f"{data['text']}\n")
+        text.mark_set(f"msg_s_{data['_id']}", start)
+        text.mark_set(f"msg_e_{data['_id']}", "end-1c")
+
+
+def batched(text, messages):
+    batch = build_batch(messages, "me")
+    base_line = int(text.index("end-1c").split(".")[0])
+    text.insert(tk.END, *batch.segments)
+    for msg_id, offset, line_count in batch.entries:
+        start = base_line + offset
+        text.mark_set(f"msg_s_{msg_id}", f"{start}.0")
+        text.mark_set(f"msg_e_{msg_id}", f"{start + line_count}.0")
+
+
+def _time(render, widget, messages, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        widget.delete("1.0", tk.END)
+        started = time.perf_counter()
+        render(widget, messages)
+        widget.update_idletasks()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.bench_render")
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument(
+        "--ctk", action="store_true", help="measure through a CTkTextbox"
+    )
+    args = parser.parse_args(argv)
+
+    root = tk.Tk()
+    if args.ctk:
+        import customtkinter as ctk
+
+        box = ctk.CTkTextbox(root)
+        box.pack()
+        widget = box._textbox
+        per_message_widget = box
+    else:
+        widget = tk.Text(root)
+        widget.pack()
+        per_message_widget = widget
+    for tag in ("user_msg", "other_msg"):
+        widget.tag_config(tag, foreground="blue")
+
+    messages = _messages(args.messages)
+    slow = _time(per_message, per_message_widget, messages, args.rounds)
+    fast = _time(batched, widget, messages, args.rounds)
+    root.destroy()
+    print(f"messages per render: {args.messages}, best of {args.rounds}")
+    print(f"per-message: {slow * 1000:8.2f} ms")
+    print(f"batched:     {fast * 1000:8.2f} ms  ({slow / fast:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Command line tools: room export/import, archive compaction, IRC gateway,
+message relay.
+
+Usage:
+    python -m src.cli export <room_id> <file.jsonl.gz>
+    python -m src.cli import <file.jsonl.gz> [--room <room_id>]
+    python -m src.cli compact [<room_id>] [--days N]
+    python -m src.cli irc [--host H] [--port P]
+    python -m src.cli relay [--host H] [--port P] [--db PATH]
+    python -m src.cli relay --token-for <username>
+
+`irc` uses the backend selected by MESSAGE_STORE; `relay` needs no Firestore.
+"""
+import argparse
+import asyncio
+import sys
+
+import config
+from services.archive import compact_all, compact_room
+from services.costs import get_meter, tagged
+from services.firestore_client import export_room, import_room, init_firestore
+from services.irc_gateway import serve as serve_irc
+from services.relay import serve as serve_relay
+from services.relay import user_token
+
+
+def _progress(label):
+    def report(count):
+        print(f"\r[LOG] {label}: {count}", end="", flush=True)
+
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.cli")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_export = sub.add_parser("export", help="export a room to gzip'd JSONL")
+    p_export.add_argument("room_id")
+    p_export.add_argument("path")
+    p_export.add_argument("--page-size", type=int, default=None)
+
+    p_import = sub.add_parser("import", help="import a room export")
+    p_import.add_argument("path")
+    p_import.add_argument("--room", default=None, help="import into this room")
+    p_import.add_argument("--batch-size", type=int, default=None)
+    p_import.add_argument("--workers", type=int, default=None)
+    p_import.add_argument("--checkpoint", default=None)
+
+    p_compact = sub.add_parser("compact", help="roll old messages into archive chunks")
+    p_compact.add_argument("room_id", nargs="?", help="default: every room")
+    p_compact.add_argument("--days", type=float, default=None)
+
+    p_irc = sub.add_parser("irc", help="serve IRC clients (#lobby and DMs)")
+    p_irc.add_argument("--host", default=None)
+    p_irc.add_argument("--port", type=int, default=None)
+
+    p_relay = sub.add_parser("relay", help="self-hosted message relay for the LAN")
+    p_relay.add_argument("--host", default=None)
+    p_relay.add_argument("--port", type=int, default=None)
+    p_relay.add_argument("--db", default=None, help="SQLite message log")
+    p_relay.add_argument(
+        "--token-for",
+        default=None,
+        metavar="USERNAME",
+        help="print the relay token for this user's client and exit",
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "relay" and args.token_for:
+        if not config.RELAY_TOKEN:
+            print("[ERROR] RELAY_TOKEN is not set.")
+            return 1
+        print(user_token(config.RELAY_TOKEN, args.token_for))
+        return 0
+    # the servers pick their own backend (see MESSAGE_STORE)
+    if args.command not in ("irc", "relay") and init_firestore() is None:
+        print("[ERROR] Firestore is not available.")
+        return 1
+
+    with tagged(args.command):
+        _run(args)
+    print(get_meter().summary())
+    return 0
+
+
+def _run(args):
+    if args.command == "export":
+        count = export_room(
+            args.room_id,
+            args.path,
+            page_size=args.page_size,
+            on_progress=_progress("exported"),
+        )
+        print(f"\n[LOG] Exported {count} messages from {args.room_id} to {args.path}")
+    elif args.command == "irc":
+        try:
+            asyncio.run(serve_irc(host=args.host, port=args.port))
+        except KeyboardInterrupt:
+            print("[LOG] IRC gateway stopped")
+    elif args.command == "relay":
+        try:
+            asyncio.run(serve_relay(args.host, args.port, args.db))
+        except KeyboardInterrupt:
+            print("[LOG] Message relay stopped")
+    elif args.command == "compact":
+        if args.room_id:
+            moved = {args.room_id: compact_room(args.room_id, args.days)}
+        else:
+            moved = compact_all(args.days)
+        for room_id, count in moved.items():
+            print(f"[LOG] {room_id}: archived {count} messages")
+    else:
+        count = import_room(
+            args.path,
+            room_id=args.room,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            checkpoint_path=args.checkpoint,
+            on_progress=_progress("imported lines"),
+        )
+        print(f"\n[LOG] Imported {count} messages from {args.path}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,6 @@
 """Project main entrypoint used by run scripts/packaging."""
+import multiprocessing
+
 from src.ui.app import run_app
 
 
@@ -7,4 +9,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # frozen builds: a spawned sync worker runs here and exits
+    multiprocessing.freeze_support()
     main()
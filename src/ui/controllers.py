@@ -2,24 +2,101 @@
 
 This controller wraps an existing `AuthApp` instance and adds pagination
 capabilities and a "Load older" control. It keeps a per-room cache of fetched
-messages and tracks the Firestore paging cursors (DocumentSnapshot objects).
+messages and tracks the `services.archive.HistoryCursor` of each room, which
+pages through live messages and then archived chunks.
+
+Older pages also load by scrolling: when the view nears the top of the loaded
+history the next page is shown, and up to `config.HISTORY_READAHEAD_PAGES`
+pages beyond it are prefetched in the background (skipped once a Firestore
+budget is exceeded), so scrolling up rarely waits for a round trip. Once
+live messages evict the top of the view (`ScrollbackTrimmed`), no older page
+is shown until the channel is reloaded, since it would leave a gap.
+
+Once the user's DM rooms are known after login, the newest page of the most
+recently active ones is fetched concurrently on the app's bounded task pool
+(within `config.DM_PREFETCH_READ_BUDGET`), so opening a recent DM renders
+from the cache straight away. Pages restored from the session snapshot are
+shown the same way, then reloaded because they carry no cursor.
 """
-import threading
-from typing import Dict, List, Optional
+import copy
+from typing import Dict, List, Optional, Set, Tuple
 
-import services.firestore_client as fc
+import config
+import services.archive as archive
+from services.costs import get_meter, tagged
+from services.rooms import recent_dm_rooms
+from utils.events import (
+    ChannelSwitched,
+    RoomsLoaded,
+    ScrollbackTrimmed,
+    SessionRestored,
+)
 
 
 class AppController:
-    def __init__(self, app, page_size: int = 50):
+    def __init__(
+        self,
+        app,
+        page_size: int = 50,
+        readahead: Optional[int] = None,
+        threshold: Optional[float] = None,
+    ):
         self.app = app
         self.page_size = page_size
+        self.readahead = (
+            config.HISTORY_READAHEAD_PAGES if readahead is None else readahead
+        )
+        self.threshold = (
+            config.HISTORY_PREFETCH_THRESHOLD if threshold is None else threshold
+        )
         # per-room paging state
         self._last_doc_map: Dict[str, Optional[object]] = {}
         # per-room cached messages (list of dicts in ascending order)
         self._cache: Dict[str, List[dict]] = {}
+        # channels with a "Load older" request in flight
+        self._loading_older = set()
+        # prefetched older pages not shown yet: channel -> [(msgs, cursor)],
+        # newest first; each cursor continues after its own page
+        self._readahead: Dict[str, List[Tuple[List[dict], object]]] = {}
+        self._prefetching: Set[str] = set()
+        # channels whose user asked for the page that is being prefetched
+        self._show_when_ready: Set[str] = set()
+        # channels whose cache holds a prefetched first page not shown yet
+        self._warm: Set[str] = set()
+        # ... of which these came from the session snapshot (no cursor yet)
+        self._stale: Set[str] = set()
+        # channels whose oldest rendered rows were evicted: the cursor is past
+        # them, so older pages would leave a gap until the channel is reloaded
+        self._trimmed: Set[str] = set()
+        # the chat view the button and scroll hook are attached to
+        self._attached_view = None
+        self._attach_ui()
+
+        # channel switches arrive over the app's event bus
+        self._unsubscribe = self.app.events.subscribe(
+            ChannelSwitched, lambda event: self.on_channel_switched(event.channel)
+        )
+        self._unsubscribe_rooms = self.app.events.subscribe(
+            RoomsLoaded, lambda event: self.prefetch_dms(event.channels)
+        )
+        self._unsubscribe_session = self.app.events.subscribe(
+            SessionRestored, lambda event: self.on_session_restored(event.messages)
+        )
+        self._unsubscribe_trimmed = self.app.events.subscribe(
+            ScrollbackTrimmed,
+            lambda event: self.on_scrollback_trimmed(event.channel, event.ids),
+        )
+
+    def _attach_ui(self):
+        """Add the "Load older" button and scroll hook to the current chat view.
 
-        # attach UI button
+        The chat view is (re)built on every login, so this runs again on each
+        channel switch and only acts when the view changed.
+        """
+        view = getattr(self.app, "chat_history", None)
+        if view is None or view is self._attached_view:
+            return
+        self._attached_view = view
         try:
             header = getattr(self.app, "chat_title_label", None)
             if header is not None:
@@ -36,140 +113,311 @@ class AppController:
                 self._load_older_btn.grid(row=1, column=0, sticky="w", pady=(4, 0))
         except Exception:
             pass
-
-        # Monkey-patch the app.switch_channel to notify controller
         try:
-            orig_switch = self.app.switch_channel
+            # chain the scrollbar's yscrollcommand to see where the view is
+            text = view._textbox
+            scrollbar_set = text.cget("yscrollcommand")
 
-            def wrapped_switch(new_channel):
-                orig_switch(new_channel)
-                try:
-                    self.on_channel_switched(new_channel)
-                except Exception:
-                    pass
+            def on_yscroll(first, last):
+                if scrollbar_set:
+                    text.tk.call(scrollbar_set, first, last)
+                self.on_scroll(float(first), float(last))
 
-            self.app.switch_channel = wrapped_switch
-        except Exception:
-            pass
+            text.configure(yscrollcommand=on_yscroll)
+        except Exception as e:
+            print(f"[WARN] Infinite scroll unavailable: {e}")
 
     def on_channel_switched(self, new_channel: str):
+        self._attach_ui()
         # reset pagination state for the channel
         if new_channel not in self._cache:
             self._cache[new_channel] = []
             self._last_doc_map[new_channel] = None
-        # load initial page
-        threading.Thread(
-            target=self.load_initial_page, args=(new_channel,), daemon=True
-        ).start()
+        # a switch drops pending "Load older" pages and prefetches along with
+        # their flags; read-ahead pages would not match the reloaded first page
+        self._loading_older.clear()
+        self._prefetching.clear()
+        self._show_when_ready.clear()
+        self._readahead.clear()
+        self._trimmed.clear()
+        if new_channel in self._warm:
+            # prefetched at login: render now; the app's own history load and
+            # listener bring anything newer
+            self._warm.discard(new_channel)
+            self.app._clear_chat_history()
+            if self._cache[new_channel]:
+                self.app._update_ui_with_new_messages(self._cache[new_channel])
+            if new_channel not in self._stale:
+                self.app.tasks.cancel("history")
+                self._prefetch(new_channel)
+                return
+            # painted from the snapshot; the first page below replaces it
+            self._stale.discard(new_channel)
+        # no older pages until the first page lands: a revisit's cursor points
+        # below pages the reload drops, and clearing the view scrolls to the top
+        self._last_doc_map[new_channel] = None
+        # load initial page; supersedes (cancels) loads for the previous channel
+        self.app.tasks.submit(
+            "history", lambda token: self.load_initial_page(new_channel, token)
+        )
 
-    def _room_id_for_channel(self, channel: str) -> Optional[str]:
-        if channel == "lobby":
-            return "lobby"
-        return self.app.dm_list.get(channel) or self.app.get_dm_room_id(
-            self.app.username, channel
+    def on_session_restored(self, messages: Dict[str, List[dict]]):
+        """New login: forget the last session's pages, seed the snapshot's."""
+        self._cache.clear()
+        self._last_doc_map.clear()
+        # logout cancelled the loads these flags wait for; their apply()
+        # never runs
+        self._loading_older.clear()
+        self._prefetching.clear()
+        self._show_when_ready.clear()
+        self._readahead.clear()
+        self._trimmed.clear()
+        for channel, msgs in messages.items():
+            self._cache[channel] = list(msgs)
+            self._last_doc_map[channel] = None
+        self._warm = set(messages)
+        self._stale = set(messages)
+
+    def on_scrollback_trimmed(self, channel: str, ids: List[str]):
+        """Live messages evicted the top of the view: stop paging older."""
+        self._trimmed.add(channel)
+        self._readahead.pop(channel, None)
+        self._show_when_ready.discard(channel)
+        evicted = set(ids)
+        self._cache[channel] = [
+            m for m in self._cache.get(channel, []) if m.get("_id") not in evicted
+        ]
+
+    def prefetch_dms(self, channels: List[str]):
+        """Fetch the newest page of the most recently active DM rooms."""
+        if (
+            not channels
+            or config.DM_PREFETCH_COUNT <= 0
+            or not get_meter().allow_background()
+        ):
+            return
+        # supersedes a prefetch still running for a previous login
+        self.app.tasks.submit(
+            "dm_prefetch", lambda token: self._plan_dm_prefetch(channels, token)
         )
 
-    def load_initial_page(self, channel: str):
+    @tagged("dm_prefetch")
+    def _plan_dm_prefetch(self, channels: List[str], token=None):
+        budget = config.DM_PREFETCH_READ_BUDGET
+        try:
+            recent = recent_dm_rooms(self.app.username, config.DM_PREFETCH_SCAN)
+            budget -= config.DM_PREFETCH_SCAN
+            by_room = {self._room_id_for_channel(c): c for c in channels}
+            ranked = [by_room[room_id] for room_id in recent if room_id in by_room]
+        except Exception as e:
+            # e.g. the participants/timestamp index is missing: sidebar order
+            print(f"[WARN] Recent DM scan failed: {e}")
+            ranked = list(channels)
+        # every page may cost up to page_size reads
+        count = min(config.DM_PREFETCH_COUNT, max(budget, 0) // self.page_size)
+        for channel in ranked[:count]:
+            if token is not None and token.cancelled:
+                return
+            # the pool bounds how many pages are fetched at once
+            self.app.tasks.submit(
+                "dm_prefetch",
+                lambda token, channel=channel: self._prefetch_dm(channel, token),
+                supersede=False,
+            )
+
+    @tagged("dm_prefetch")
+    def _prefetch_dm(self, channel: str, token=None):
+        room_id = self._room_id_for_channel(channel)
+        if room_id is None or not get_meter().allow_background():
+            return
+        msgs, cursor = self._read_page(room_id, None)
+        if not msgs and cursor is not None:
+            return  # the read failed
+
+        def apply():
+            # never replace a page the user already opened (snapshot pages
+            # are fine to replace: this one is fresh and has a cursor)
+            opened = channel == getattr(self.app, "current_channel", None)
+            if opened or (self._cache.get(channel) and channel not in self._stale):
+                return
+            self._cache[channel] = msgs
+            self._last_doc_map[channel] = cursor if msgs else None
+            self._warm.add(channel)
+            self._stale.discard(channel)
+
+        self._on_ui(token, apply)
+
+    def _room_id_for_channel(self, channel: str) -> Optional[str]:
+        return self.app.rooms.room_for_channel(channel)
+
+    @tagged("history_pages")
+    def load_initial_page(self, channel: str, token=None):
         room_id = self._room_id_for_channel(channel)
         if room_id is None:
             return
-        # Fetch newest messages first (descending) and reverse to display oldest->newest
-        docs, last = fc.get_history_paginated(
-            room_id, limit=self.page_size, start_after=None, direction="desc"
-        )
-        if not docs:
-            # clear UI
-            self.app.after(
-                0,
-                lambda: (
-                    self.app.chat_history.configure(state="normal"),
-                    self.app.chat_history.delete("1.0", "end"),
-                    self.app.chat_history.configure(state="disabled"),
-                ),
+        # Newest page first; archive.read_history stitches live messages and
+        # archived chunks and returns them oldest->newest
+        msgs, cursor = self._read_page(room_id, None)
+
+        def apply():
+            self._cache[channel] = msgs
+            self._last_doc_map[channel] = cursor if msgs else None
+            self._readahead.pop(channel, None)
+            # also drops message marks and displayed ids, so the re-render
+            # is not deduplicated away
+            self.app._clear_chat_history()
+            if msgs:
+                self.app._update_ui_with_new_messages(msgs)
+            self._prefetch(channel)
+
+        self._on_ui(token, apply)
+
+    def _on_ui(self, token, fn):
+        """Run `fn` on the UI thread, unless `token`'s load was superseded."""
+        if token is None:
+            self.app.after(0, fn)
+        else:
+            self.app.tasks.deliver(token, fn)
+
+    def _read_page(self, room_id: str, cursor):
+        if config.MESSAGE_STORE != "firestore":
+            return self._read_store_page(room_id, cursor)
+        # read_history advances the cursor in place; work on a copy so a
+        # superseded (dropped) page doesn't move the stored cursor
+        cursor = copy.copy(cursor)
+        try:
+            return archive.read_history(room_id, limit=self.page_size, cursor=cursor)
+        except Exception as e:
+            print(f"[ERROR] read_history failed: {e}")
+            return [], cursor
+
+    def _read_store_page(self, room_id: str, before: Optional[dict]):
+        """Page of the app's MessageStore; the cursor is the oldest message."""
+        try:
+            msgs = self.app.message_store().history(
+                room_id, limit=self.page_size, before=before
             )
-            self._cache[channel] = []
-            self._last_doc_map[channel] = None
-            return
+        except Exception as e:
+            print(f"[ERROR] Store history failed: {e}")
+            return [], before
+        # a short page means the start of the room was reached
+        return msgs, (msgs[0] if len(msgs) == self.page_size else None)
 
-        # convert docs to dicts and reverse order
-        msgs = []
-        for d in docs:
-            try:
-                dd = d.to_dict()
-            except Exception:
-                try:
-                    dd = dict(d)
-                except Exception:
-                    dd = {}
-            try:
-                dd["_id"] = getattr(d, "id", None)
-            except Exception:
-                pass
-            msgs.append(dd)
-
-        msgs = list(reversed(msgs))
-        self._cache[channel] = msgs
-        self._last_doc_map[channel] = last
-
-        # render messages on UI thread
-        self.app.after(
-            0,
-            lambda: (
-                self.app.chat_history.configure(state="normal"),
-                self.app.chat_history.delete("1.0", "end"),
-                self.app._update_ui_with_new_messages(self._cache[channel]),
-            ),
-        )
+    def on_scroll(self, first: float, last: float):
+        """yscrollcommand hook: near the top of the loaded history, show more."""
+        if first <= self.threshold:
+            self.load_older_for_current()
 
     def load_older_for_current(self):
         channel = getattr(self.app, "current_channel", None)
-        if not channel:
+        if channel:
+            self.show_older(channel)
+
+    def show_older(self, channel: str):
+        """Show the next older page: from read-ahead if ready, else fetch it."""
+        if channel in self._trimmed:
+            return
+        buffered = self._readahead.get(channel)
+        if buffered:
+            msgs, cursor = buffered.pop(0)
+            self._apply_older(channel, msgs, cursor)
             return
-        threading.Thread(target=lambda: self.load_older(channel), daemon=True).start()
+        if channel in self._prefetching:
+            # that page is on its way; show it when it lands
+            self._show_when_ready.add(channel)
+            return
+        if channel in self._loading_older or self._last_doc_map.get(channel) is None:
+            return
+        self._loading_older.add(channel)
+        # joins the current "history" generation; a channel switch drops it
+        self.app.tasks.submit(
+            "history",
+            lambda token: self.load_older(channel, token),
+            supersede=False,
+        )
 
-    def load_older(self, channel: str):
+    @tagged("history_pages")
+    def load_older(self, channel: str, token=None):
+        scheduled = False
+        try:
+            scheduled = self._load_older(channel, token)
+        finally:
+            # otherwise the UI-thread apply() clears the flag, so a second
+            # click can't read the cursor before this page is applied
+            if not scheduled:
+                self._loading_older.discard(channel)
+
+    def _load_older(self, channel: str, token):
         room_id = self._room_id_for_channel(channel)
         if room_id is None:
-            return
-        last = self._last_doc_map.get(channel)
-        # If last is None and we have cache, it means there were less than a page fetched; no older available
-        if last is None:
-            return
+            return False
+        cursor = self._last_doc_map.get(channel)
+        # No cursor means the history of this room is exhausted
+        if cursor is None:
+            return False
 
-        docs, new_last = fc.get_history_paginated(
-            room_id, limit=self.page_size, start_after=last, direction="desc"
-        )
-        if not docs:
-            # no more older messages
-            self._last_doc_map[channel] = None
+        msgs, new_cursor = self._read_page(room_id, cursor)
+
+        def apply():
+            self._loading_older.discard(channel)
+            self._apply_older(channel, msgs, new_cursor)
+
+        self._on_ui(token, apply)
+        return True
+
+    def _apply_older(self, channel: str, msgs: List[dict], cursor):
+        """Prepend an older page above the rendered history (UI thread)."""
+        if channel in self._trimmed:
             return
+        self._last_doc_map[channel] = cursor
+        if msgs:
+            self._cache[channel] = msgs + self._cache.get(channel, [])
+            if channel == getattr(self.app, "current_channel", None):
+                self.app._prepend_history(msgs)
+        self._prefetch(channel)
 
-        msgs = []
-        for d in docs:
-            try:
-                dd = d.to_dict()
-            except Exception:
-                try:
-                    dd = dict(d)
-                except Exception:
-                    dd = {}
-            try:
-                dd["_id"] = getattr(d, "id", None)
-            except Exception:
-                pass
-            msgs.append(dd)
-
-        msgs = list(reversed(msgs))
-        # prepend to cache
-        self._cache[channel] = msgs + self._cache.get(channel, [])
-        self._last_doc_map[channel] = new_last
-
-        # re-render full cache on UI thread
-        self.app.after(
-            0,
-            lambda: (
-                self.app.chat_history.configure(state="normal"),
-                self.app.chat_history.delete("1.0", "end"),
-                self.app._update_ui_with_new_messages(self._cache[channel]),
-            ),
+    def _prefetch(self, channel: str):
+        """Top up the read-ahead buffer of `channel` in the background."""
+        buffered = self._readahead.setdefault(channel, [])
+        # the next page continues from the newest read-ahead page, if any
+        cursor = buffered[-1][1] if buffered else self._last_doc_map.get(channel)
+        if (
+            cursor is None  # history exhausted
+            or channel in self._trimmed
+            or len(buffered) >= self.readahead
+            or channel in self._prefetching
+            or channel in self._loading_older
+            or not get_meter().allow_background()
+        ):
+            return
+        room_id = self._room_id_for_channel(channel)
+        if room_id is None:
+            return
+        self._prefetching.add(channel)
+        # joins the current "history" generation; a channel switch drops it
+        self.app.tasks.submit(
+            "history",
+            lambda token: self._prefetch_page(channel, room_id, cursor, token),
+            supersede=False,
         )
+
+    @tagged("history_prefetch")
+    def _prefetch_page(self, channel: str, room_id: str, cursor, token=None):
+        msgs, new_cursor = self._read_page(room_id, cursor)
+
+        def apply():
+            self._prefetching.discard(channel)
+            if channel in self._trimmed:
+                return
+            if not msgs and new_cursor is not None:
+                # the read failed; leave it to the next scroll or click
+                self._show_when_ready.discard(channel)
+                return
+            self._readahead.setdefault(channel, []).append((msgs, new_cursor))
+            if channel in self._show_when_ready:
+                self._show_when_ready.discard(channel)
+                self.show_older(channel)
+            else:
+                self._prefetch(channel)
+
+        self._on_ui(token, apply)
@@ -4,10 +4,11 @@ This module currently wraps the existing `client_gui.AuthApp` so the controller
 can operate on a stable view object during migration. Later we can move UI
 components here and remove `client_gui.py`.
 """
-from client_gui import AuthApp
+from client_gui import AuthApp, init_app
 
 
 def create_app():
     """Instantiate and return the main application view (AuthApp)."""
+    init_app()
     app = AuthApp()
     return app
@@ -0,0 +1,135 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+
+import services.archive as archive
+import services.firestore_client as fc
+
+T0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def _doc(doc_id, minute, **extra):
+    doc = MagicMock()
+    doc.id = doc_id
+    doc.to_dict.return_value = dict(
+        room_id="lobby", text=doc_id, timestamp=T0 + timedelta(minutes=minute), **extra
+    )
+    return doc
+
+
+def _chunk(ids_minutes):
+    doc = MagicMock()
+    doc.to_dict.return_value = {
+        "messages": [
+            {"_id": i, "text": i, "timestamp": T0 + timedelta(minutes=m)}
+            for i, m in ids_minutes
+        ]
+    }
+    return doc
+
+
+class TestBuildChunk(unittest.TestCase):
+    def test_packs_messages_without_room_id(self):
+        chunk, packed = archive.build_chunk("lobby", [_doc("a", 1), _doc("b", 2)])
+        self.assertEqual(chunk["count"], 2)
+        self.assertEqual(chunk["first_ts"], T0 + timedelta(minutes=1))
+        self.assertEqual(chunk["last_ts"], T0 + timedelta(minutes=2))
+        self.assertEqual([m["_id"] for m in chunk["messages"]], ["a", "b"])
+        self.assertNotIn("room_id", chunk["messages"][0])
+        self.assertEqual(len(packed), 2)
+
+    def test_stops_at_byte_budget(self):
+        docs = [_doc("a", 1, text_pad="x" * 100), _doc("b", 2, text_pad="x" * 100)]
+        chunk, packed = archive.build_chunk("lobby", docs, max_bytes=250)
+        self.assertEqual(chunk["count"], 1)
+        self.assertEqual(packed, docs[:1])
+
+    def test_stops_before_a_message_larger_than_a_chunk(self):
+        docs = [_doc("a", 1), _doc("big", 2, text_pad="x" * 1000), _doc("c", 3)]
+        chunk, packed = archive.build_chunk("lobby", docs, max_bytes=500)
+        self.assertEqual(packed, docs[:1])
+        self.assertEqual(
+            archive.build_chunk("lobby", docs[1:], max_bytes=500), (None, [])
+        )
+
+    def test_empty(self):
+        self.assertEqual(archive.build_chunk("lobby", []), (None, []))
+
+
+class TestCompactRoom(unittest.TestCase):
+    def test_chunk_write_and_deletes_share_one_batch(self):
+        db = MagicMock()
+        batches = []
+        db.batch.side_effect = lambda: batches.append(MagicMock()) or batches[-1]
+        pages = [[_doc("a", 1), _doc("b", 2)], [_doc("c", 3)]]
+        with patch.object(fc, "_firestore_db", db, create=True), patch.object(
+            archive, "_fetch_cold", side_effect=pages
+        ):
+            moved = archive.compact_room("lobby", chunk_size=2, now=T0)
+        self.assertEqual(moved, 3)
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(batches[0].set.call_count, 1)
+        self.assertEqual(batches[0].delete.call_count, 2)
+        batches[0].commit.assert_called_once()
+
+    def test_compact_all_includes_dm_rooms_without_metadata(self):
+        db = MagicMock()
+        room = MagicMock()
+        room.id = "dm_ann_bob"
+        db.collection.return_value.get.return_value = [room]
+        with patch.object(fc, "_firestore_db", db, create=True), patch.object(
+            archive, "dm_room_ids", return_value=["dm_ann_bob", "dm_a_b_c"]
+        ), patch.object(archive, "compact_room", return_value=0) as compact:
+            archive.compact_all(30)
+        rooms = [c.args[0] for c in compact.call_args_list]
+        self.assertEqual(rooms, ["lobby", "dm_a_b_c", "dm_ann_bob"])
+
+
+class TestCompacted(unittest.TestCase):
+    def test_only_messages_old_enough_to_be_archived(self):
+        with patch.object(archive.config, "ARCHIVE_AFTER_DAYS", 30):
+            self.assertTrue(archive.compacted(T0 - timedelta(days=31), now=T0))
+            self.assertFalse(archive.compacted(T0 - timedelta(days=2), now=T0))
+            self.assertFalse(archive.compacted(None, now=T0))
+
+
+class TestReadHistory(unittest.TestCase):
+    def _read(self, live, chunks, limit, cursor=None):
+        with patch.object(fc, "_firestore_db", MagicMock(), create=True), patch.object(
+            archive, "_fetch_live", side_effect=live
+        ), patch.object(archive, "_fetch_chunk", side_effect=chunks):
+            return archive.read_history("lobby", limit=limit, cursor=cursor)
+
+    def test_stitches_live_and_chunks_across_pages(self):
+        live = [[_doc("e", 5), _doc("d", 4)]]
+        msgs, cursor = self._read(live, [_chunk([("a", 1), ("b", 2), ("c", 3)])], 3)
+        self.assertEqual([m["_id"] for m in msgs], ["c", "d", "e"])
+        self.assertEqual(msgs[0]["room_id"], "lobby")
+        self.assertIsNotNone(cursor)
+
+        # the rest of the chunk is buffered; next page costs one more probe
+        msgs, cursor = self._read([], [None], 3, cursor)
+        self.assertEqual([m["_id"] for m in msgs], ["a", "b"])
+        self.assertIsNone(cursor)
+
+    def test_skips_chunk_messages_newer_than_loaded_live_ones(self):
+        live = [[_doc("d", 4)]]
+        chunk = _chunk([("a", 1), ("d", 4), ("x", 9)])
+        msgs, _ = self._read(live, [chunk, None], 10)
+        # "x" is newer than the oldest live message already shown; entries
+        # with an equal timestamp are kept and the UI dedupes them by id
+        self.assertEqual([m["_id"] for m in msgs], ["a", "d", "d"])
+
+    def test_full_live_page_does_not_touch_chunks(self):
+        live = [[_doc("b", 2), _doc("a", 1)]]
+        with patch.object(fc, "_firestore_db", MagicMock(), create=True), patch.object(
+            archive, "_fetch_live", side_effect=live
+        ), patch.object(archive, "_fetch_chunk") as fetch_chunk:
+            msgs, cursor = archive.read_history("lobby", limit=2)
+        fetch_chunk.assert_not_called()
+        self.assertEqual(len(msgs), 2)
+        self.assertFalse(cursor.live_done)
+
+
+if __name__ == "__main__":
+    unittest.main()
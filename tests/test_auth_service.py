@@ -0,0 +1,110 @@
+import os
+import stat
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+import requests
+
+from services.auth_service import AuthService, SessionStore
+
+
+def _response(payload):
+    resp = MagicMock()
+    resp.json.return_value = payload
+    return resp
+
+
+class TestAuthSessions(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = SessionStore(
+            os.path.join(self.tmp.name, "session.json"), use_keyring=False
+        )
+        self.http = MagicMock()
+        self.service = AuthService(
+            {"apiKey": "test-key"}, store=self.store, http=self.http
+        )
+        self.addCleanup(self.service.close)
+
+    def test_sign_in_persists_refresh_token_privately(self):
+        self.http.post.return_value = _response(
+            {
+                "email": "ann@example.com",
+                "localId": "uid1",
+                "idToken": "id1",
+                "refreshToken": "r1",
+                "expiresIn": "3600",
+            }
+        )
+        self.service.sign_in("ann@example.com", "secret")
+
+        self.assertEqual(
+            self.store.load(), {"email": "ann@example.com", "refresh_token": "r1"}
+        )
+        mode = stat.S_IMODE(os.stat(self.store.path).st_mode)
+        self.assertEqual(mode & 0o077, 0)
+        self.assertIn("signInWithPassword", self.http.post.call_args.args[0])
+
+    def test_restore_uses_single_refresh_call(self):
+        self.store.save("ann@example.com", "r1")
+        self.http.post.return_value = _response(
+            {
+                "user_id": "uid1",
+                "id_token": "id2",
+                "refresh_token": "r2",
+                "expires_in": "3600",
+            }
+        )
+        session = self.service.restore_session()
+
+        self.assertEqual(session.username, "ann")
+        self.assertEqual(self.service.id_token(), "id2")
+        self.http.post.assert_called_once()
+        self.assertEqual(self.store.load()["refresh_token"], "r2")
+
+    def _fail_refresh(self, status, message):
+        response = MagicMock(status_code=status)
+        response.json.return_value = {"error": {"code": status, "message": message}}
+        error = requests.HTTPError(str(status), response=response)
+        self.http.post.return_value.raise_for_status.side_effect = error
+
+    def test_revoked_token_clears_stored_session(self):
+        self.store.save("ann@example.com", "revoked")
+        self._fail_refresh(400, "TOKEN_EXPIRED")
+        self.assertIsNone(self.service.restore_session())
+        self.assertIsNone(self.store.load())
+
+    def test_transient_failures_keep_stored_session(self):
+        self.store.save("ann@example.com", "r1")
+        self.http.post.side_effect = requests.ConnectionError("offline")
+        self.assertIsNone(self.service.restore_session())
+        self.assertEqual(self.store.load()["refresh_token"], "r1")
+
+        self.http.post.side_effect = None
+        self._fail_refresh(503, "UNAVAILABLE")
+        self.assertIsNone(self.service.restore_session())
+        self._fail_refresh(400, "MISSING_GRANT_TYPE")
+        self.assertIsNone(self.service.restore_session())
+        self.assertEqual(self.store.load()["refresh_token"], "r1")
+
+    def test_verify_password_starts_no_session(self):
+        self.http.post.return_value = _response({"localId": "uid1"})
+        self.assertTrue(self.service.verify_password("ann@example.com", "secret"))
+        self.assertIsNone(self.service.session)
+        self.assertIsNone(self.store.load())
+        self.http.post.return_value.raise_for_status.side_effect = requests.HTTPError(
+            "400"
+        )
+        self.assertFalse(self.service.verify_password("ann@example.com", "wrong"))
+
+    def test_sign_out_forgets_session(self):
+        self.store.save("ann@example.com", "r1")
+        self.service.sign_out()
+        self.assertIsNone(self.store.load())
+        self.assertIsNone(self.service.session)
+
+
+if __name__ == "__main__":
+    unittest.main()
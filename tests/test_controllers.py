@@ -0,0 +1,243 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from services.message_store import MemoryStore
+from src.ui.controllers import AppController
+
+
+class FakeHistory:
+    """`archive.read_history` over `pages` (newest first); the cursor is an int."""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.reads = []
+
+    def __call__(self, room_id, limit=50, cursor=None):
+        index = cursor or 0
+        self.reads.append(index)
+        if index >= len(self.pages):
+            return [], None
+        following = index + 1
+        return self.pages[index], (following if following < len(self.pages) else None)
+
+
+def _page(*texts):
+    return [{"_id": text, "text": text} for text in texts]
+
+
+class TestHistoryPrefetch(unittest.TestCase):
+    def setUp(self):
+        self.app = MagicMock()
+        self.app.chat_history = None
+        self.app.current_channel = "lobby"
+        self.app.rooms.room_for_channel.return_value = "lobby"
+        self.app.after.side_effect = lambda delay, fn: fn()
+        self.app.tasks.submit.side_effect = lambda view, fn, supersede=True: fn(None)
+        self.history = FakeHistory([_page("e", "f"), _page("c", "d"), _page("a", "b")])
+        patcher = patch("src.ui.controllers.archive.read_history", self.history)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.meter = MagicMock()
+        self.meter.allow_background.return_value = True
+        patcher = patch("src.ui.controllers.get_meter", return_value=self.meter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.controller = AppController(
+            self.app, page_size=2, readahead=1, threshold=0.1
+        )
+
+    def test_first_page_prefetches_one_page_ahead(self):
+        self.controller.on_channel_switched("lobby")
+        self.app._update_ui_with_new_messages.assert_called_once_with(_page("e", "f"))
+        self.assertEqual(self.history.reads, [0, 1])
+        self.app._prepend_history.assert_not_called()
+
+    def test_scrolling_to_the_top_shows_prefetched_pages(self):
+        self.controller.on_channel_switched("lobby")
+        self.controller.on_scroll(0.5, 1.0)  # not near the top
+        self.app._prepend_history.assert_not_called()
+
+        self.controller.on_scroll(0.05, 0.5)
+        self.app._prepend_history.assert_called_once_with(_page("c", "d"))
+        self.assertEqual(self.history.reads, [0, 1, 2])  # refilled the buffer
+
+        self.controller.on_scroll(0.0, 0.3)
+        self.app._prepend_history.assert_called_with(_page("a", "b"))
+        self.assertEqual(self.controller._cache["lobby"], _page(*"abcdef"))
+
+        # history is exhausted: no more reads
+        self.controller.on_scroll(0.0, 0.2)
+        self.assertEqual(self.history.reads, [0, 1, 2])
+        self.assertEqual(self.app._prepend_history.call_count, 2)
+
+    def test_pages_come_from_the_message_store_off_firestore(self):
+        store = MemoryStore()
+        for text in "abcde":
+            store.add("lobby", "ann", text)
+        self.app.message_store.return_value = store
+        with patch("src.ui.controllers.config.MESSAGE_STORE", "relay"):
+            self.controller.on_channel_switched("lobby")
+            self.controller.on_scroll(0.0, 0.5)
+            self.controller.on_scroll(0.0, 0.5)
+
+        def texts(msgs):
+            return [m["text"] for m in msgs]
+
+        first = self.app._update_ui_with_new_messages.call_args.args[0]
+        self.assertEqual(texts(first), ["d", "e"])
+        older = [texts(c.args[0]) for c in self.app._prepend_history.call_args_list]
+        self.assertEqual(older, [["b", "c"], ["a"]])
+        self.assertEqual(self.history.reads, [])  # archive not used
+
+    def test_no_background_reads_over_budget(self):
+        self.meter.allow_background.return_value = False
+        self.controller.on_channel_switched("lobby")
+        self.assertEqual(self.history.reads, [0])
+
+        # scrolling still loads pages, on demand
+        self.controller.on_scroll(0.0, 0.5)
+        self.app._prepend_history.assert_called_once_with(_page("c", "d"))
+        self.assertEqual(self.history.reads, [0, 1])
+
+    def test_scroll_during_prefetch_waits_for_that_page(self):
+        pending = []
+        self.app.tasks.submit.side_effect = lambda view, fn, supersede=True: (
+            pending.append(fn)
+        )
+        self.controller.on_channel_switched("lobby")
+        pending.pop(0)(None)  # first page, starts the prefetch
+        self.controller.on_scroll(0.0, 0.5)
+        self.assertEqual(len(pending), 1)  # no second read of the same page
+        pending.pop(0)(None)
+        self.app._prepend_history.assert_called_once_with(_page("c", "d"))
+
+    def test_revisit_waits_for_the_first_page_before_older_ones(self):
+        self.controller.on_channel_switched("lobby")
+        self.controller.on_scroll(0.0, 0.5)  # shows page 2, cursor -> page 3
+        pending = []
+        self.app.tasks.submit.side_effect = lambda view, fn, supersede=True: (
+            pending.append(fn)
+        )
+        self.history.reads.clear()
+        self.app._prepend_history.reset_mock()
+
+        self.controller.on_channel_switched("lobby")
+        self.controller.on_scroll(0.0, 0.0)  # the cleared view is at the top
+        self.assertEqual(len(pending), 1)  # only the first page
+        pending.pop(0)(None)
+        self.assertEqual(self.history.reads, [0])
+        self.app._prepend_history.assert_not_called()
+
+    def test_no_older_pages_after_the_top_was_trimmed(self):
+        self.controller.on_channel_switched("lobby")  # e f, c d prefetched
+        self.controller.on_scrollback_trimmed("lobby", ["e"])
+        self.assertEqual(self.controller._cache["lobby"], _page("f"))
+        self.controller.on_scroll(0.0, 0.5)
+        self.app._prepend_history.assert_not_called()
+
+        # reopening the channel reloads it and pages again
+        self.controller.on_channel_switched("lobby")
+        self.controller.on_scroll(0.0, 0.5)
+        self.app._prepend_history.assert_called_once_with(_page("c", "d"))
+
+    def test_new_login_forgets_loads_cancelled_by_logout(self):
+        pending = []
+        self.app.tasks.submit.side_effect = lambda view, fn, supersede=True: (
+            pending.append(fn)
+        )
+        self.controller.on_channel_switched("lobby")
+        pending.pop(0)(None)  # first page, starts the prefetch
+        self.controller.on_scroll(0.0, 0.5)  # waits for the prefetch
+        pending.clear()  # logout cancels it
+
+        self.controller.on_session_restored({})
+        self.assertEqual(self.controller._prefetching, set())
+        self.app.tasks.submit.side_effect = lambda view, fn, supersede=True: fn(None)
+        self.controller.load_initial_page("lobby")
+        self.controller.on_scroll(0.0, 0.5)
+        self.app._prepend_history.assert_called_once_with(_page("c", "d"))
+
+
+class TestDmPrefetch(unittest.TestCase):
+    def setUp(self):
+        self.app = MagicMock()
+        self.app.chat_history = None
+        self.app.username = "ann"
+        self.app.current_channel = "lobby"
+        self.app.rooms.room_for_channel.side_effect = lambda c: f"dm_ann_{c}"
+        self.app.after.side_effect = lambda delay, fn: fn()
+        self.app.tasks.submit.side_effect = lambda view, fn, supersede=True: fn(None)
+        self.reads = []
+
+        def read_history(room_id, limit=50, cursor=None):
+            self.reads.append(room_id)
+            return _page(f"{room_id}-1", f"{room_id}-2"), None
+
+        for target, value in (
+            ("src.ui.controllers.archive.read_history", read_history),
+            ("src.ui.controllers.get_meter", MagicMock()),
+            ("src.ui.controllers.recent_dm_rooms", MagicMock()),
+            ("src.ui.controllers.config.DM_PREFETCH_COUNT", 2),
+            ("src.ui.controllers.config.DM_PREFETCH_SCAN", 10),
+            ("src.ui.controllers.config.DM_PREFETCH_READ_BUDGET", 100),
+        ):
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        from src.ui import controllers
+
+        self.recent = controllers.recent_dm_rooms
+        self.recent.return_value = ["dm_ann_cat", "dm_ann_zed", "dm_ann_bob"]
+        controllers.get_meter.return_value.allow_background.return_value = True
+        self.controller = AppController(self.app, page_size=20, readahead=0)
+
+    def test_prefetches_most_recent_rooms_within_count(self):
+        self.controller.prefetch_dms(["bob", "cat", "dan"])
+        # zed is not in the sidebar; dan had no recent messages
+        self.assertEqual(self.reads, ["dm_ann_cat", "dm_ann_bob"])
+        self.assertEqual(self.controller._warm, {"cat", "bob"})
+
+    def test_budget_limits_the_pages(self):
+        with patch("src.ui.controllers.config.DM_PREFETCH_READ_BUDGET", 40):
+            self.controller.prefetch_dms(["bob", "cat"])
+        # 10 reads for the scan leave room for one 20-message page
+        self.assertEqual(self.reads, ["dm_ann_cat"])
+
+    def test_falls_back_to_sidebar_order_when_the_scan_fails(self):
+        self.recent.side_effect = RuntimeError("index missing")
+        self.controller.prefetch_dms(["bob", "cat", "dan"])
+        self.assertEqual(self.reads, ["dm_ann_bob", "dm_ann_cat"])
+
+    def test_opening_a_prefetched_dm_renders_from_cache(self):
+        self.controller.prefetch_dms(["bob"])
+        self.app.current_channel = "bob"
+        self.controller.on_channel_switched("bob")
+        self.app._update_ui_with_new_messages.assert_called_once_with(
+            _page("dm_ann_bob-1", "dm_ann_bob-2")
+        )
+        self.app.tasks.cancel.assert_called_with("history")
+        self.assertEqual(self.reads, ["dm_ann_bob"])  # no second fetch
+
+        # only the first open uses the prefetched page
+        self.controller.on_channel_switched("bob")
+        self.assertEqual(self.reads, ["dm_ann_bob", "dm_ann_bob"])
+
+    def test_snapshot_pages_render_then_reload(self):
+        cached = _page("old-1")
+        self.controller.on_session_restored({"bob": cached, "cat": cached})
+        self.app.current_channel = "bob"
+        self.controller.on_channel_switched("bob")
+        first, second = self.app._update_ui_with_new_messages.call_args_list
+        self.assertEqual(first.args, (cached,))
+        self.assertEqual(second.args, (_page("dm_ann_bob-1", "dm_ann_bob-2"),))
+        self.assertEqual(self.reads, ["dm_ann_bob"])
+
+        # a login prefetch replaces a snapshot page, it has a cursor
+        self.app.current_channel = "lobby"
+        self.controller.prefetch_dms(["cat"])
+        self.assertEqual(self.controller._cache["cat"][0]["_id"], "dm_ann_cat-1")
+        self.assertEqual(self.controller._stale, set())
+
+
+if __name__ == "__main__":
+    unittest.main()
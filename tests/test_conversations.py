@@ -0,0 +1,92 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+
+import services.conversations as conversations
+
+
+class TestPreview(unittest.TestCase):
+    def test_first_line_truncated(self):
+        self.assertEqual(conversations.preview("hello\nworld", limit=10), "hello")
+        self.assertEqual(conversations.preview("abcdefghij", limit=5), "abcd…")
+        self.assertEqual(conversations.preview(None), "")
+
+
+class TestRecordMessage(unittest.TestCase):
+    def test_one_batch_resets_sender_and_increments_others(self):
+        db = MagicMock()
+        db.collection.return_value.document.side_effect = lambda user: user
+        batch = db.batch.return_value
+        with patch("services.conversations.fc.get_db", return_value=db):
+            conversations.record_message("dm_ann_bob", "ann", "hi", ["bob", "ann"])
+        self.assertEqual(batch.set.call_count, 2)
+        entries = {
+            call.args[0]: call.args[1]["rooms"]["dm_ann_bob"]
+            for call in batch.set.call_args_list
+        }
+        ann, bob = "ann", "bob"
+        self.assertEqual(entries[ann]["unread"], 0)
+        self.assertEqual(entries[ann]["participants"], ["ann", "bob"])
+        self.assertEqual(entries[ann]["last_sender"], "ann")
+        self.assertEqual(entries[ann]["last_text"], "hi")
+        self.assertIsNot(entries[bob]["unread"], 0)
+        for call in batch.set.call_args_list:
+            self.assertTrue(call.kwargs["merge"])
+        batch.commit.assert_called_once_with()
+
+
+class TestIndexDoc(unittest.TestCase):
+    def test_missing_doc_is_none(self):
+        doc = MagicMock(exists=False)
+        self.assertIsNone(conversations.entries_from_doc(doc))
+        self.assertIsNone(conversations.entries_from_doc(None))
+
+    def test_entries(self):
+        doc = MagicMock(exists=True)
+        doc.to_dict.return_value = {"rooms": {"dm_ann_bob": {"unread": 2}, "junk": "x"}}
+        self.assertEqual(
+            conversations.entries_from_doc(doc), {"dm_ann_bob": {"unread": 2}}
+        )
+
+    def test_unread_count_stops_at_read_cursor(self):
+        read = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+        later = read + timedelta(minutes=1)
+        entry = {"unread": 2, "last_ts": later, "read_at": read}
+        self.assertEqual(conversations.unread_count(entry), 2)
+        entry["read_at"] = later
+        self.assertEqual(conversations.unread_count(entry), 0)
+        self.assertEqual(conversations.unread_count({"unread": 1}), 1)
+        self.assertEqual(conversations.unread_count({"unread": "x"}), 0)
+
+    def test_mark_read_moves_cursor(self):
+        db = MagicMock()
+        with patch("services.conversations.fc.get_db", return_value=db):
+            conversations.mark_read("ann", "dm_ann_bob")
+        ref = db.collection.return_value.document.return_value
+        entry = ref.set.call_args.args[0]["rooms"]["dm_ann_bob"]
+        self.assertEqual(entry["unread"], 0)
+        self.assertIn("read_at", entry)
+
+    def test_seed_from_room_metadata(self):
+        db = MagicMock()
+        with patch("services.conversations.fc.get_db", return_value=db):
+            conversations.seed("ann", [("dm_ann_bob", ("bob", "ann"))])
+        ref = db.collection.return_value.document.return_value
+        # no unread count: merging must not reset an existing entry's
+        ref.set.assert_called_once_with(
+            {"rooms": {"dm_ann_bob": {"participants": ["ann", "bob"]}}, "seeded": True},
+            merge=True,
+        )
+
+    def test_partial_index_is_not_seeded(self):
+        # created by someone else's DM before the user's first login
+        doc = MagicMock(exists=True)
+        doc.to_dict.return_value = {"rooms": {"dm_ann_bob": {"unread": 1}}}
+        self.assertFalse(conversations.is_seeded(doc))
+        self.assertFalse(conversations.is_seeded(None))
+        doc.to_dict.return_value["seeded"] = True
+        self.assertTrue(conversations.is_seeded(doc))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+from unittest.mock import MagicMock
+
+from services.costs import CostMeter, MeteredClient, current_tag, tagged
+
+
+class TestCostMeter(unittest.TestCase):
+    def test_counts_per_tag_and_totals(self):
+        meter = CostMeter(read_budget=0, write_budget=0)
+        with tagged("history"):
+            meter.add(reads=3)
+            with tagged("send"):
+                meter.add(writes=1)
+        meter.add(events=2)
+        self.assertEqual(meter.by_tag()["history"]["reads"], 3)
+        self.assertEqual(meter.by_tag()["send"]["writes"], 1)
+        self.assertEqual(meter.by_tag()["untagged"]["events"], 2)
+        self.assertEqual(meter.totals(), {"reads": 3, "writes": 1, "events": 2})
+        self.assertIn("history", meter.summary())
+
+    def test_budget_exceeded_once_and_pauses_background(self):
+        exceeded = []
+        meter = CostMeter(
+            read_budget=5, write_budget=0, on_exceeded=lambda k, b: exceeded.append(k)
+        )
+        meter.add("x", reads=5)
+        self.assertTrue(meter.allow_background())
+        meter.add("x", reads=1)
+        meter.add("x", reads=1)
+        self.assertFalse(meter.allow_background())
+        self.assertEqual(exceeded, ["reads"])
+
+    def test_tagged_works_as_decorator(self):
+        @tagged("presence")
+        def inner():
+            return current_tag()
+
+        self.assertEqual(inner(), "presence")
+        self.assertEqual(current_tag(), "untagged")
+
+
+class TestMeteredClient(unittest.TestCase):
+    def setUp(self):
+        self.meter = CostMeter(read_budget=0, write_budget=0)
+        self.raw = MagicMock()
+        self.db = MeteredClient(self.raw, self.meter)
+
+    def test_query_get_counts_documents_with_minimum_one(self):
+        self.raw.collection.return_value.where.return_value.get.return_value = [1, 2]
+        with tagged("history"):
+            docs = self.db.collection("messages").where("a", "==", 1).get()
+            self.raw.collection.return_value.where.return_value.get.return_value = []
+            self.db.collection("messages").where("a", "==", 1).get()
+        self.assertEqual(docs, [1, 2])
+        self.assertEqual(self.meter.by_tag()["history"]["reads"], 3)
+
+    def test_writes_and_batches(self):
+        with tagged("send"):
+            self.db.collection("messages").add({"text": "hi"})
+            batch = self.db.batch()
+            ref = self.db.collection("messages").document("a")
+            batch.delete(ref)
+            batch.delete(ref)
+            batch.commit()
+        self.assertEqual(self.meter.by_tag()["send"]["writes"], 3)
+        # the proxied reference is unwrapped before reaching the SDK
+        self.raw.batch.return_value.delete.assert_called_with(
+            self.raw.collection.return_value.document.return_value
+        )
+
+    def test_listener_keeps_subscription_tag(self):
+        received = []
+        with tagged("room_listener"):
+            self.db.collection("messages").on_snapshot(
+                lambda *args: received.append(args)
+            )
+        callback = self.raw.collection.return_value.on_snapshot.call_args[0][0]
+        callback(["snap"], ["c1", "c2"], "t")
+        self.assertEqual(received, [(["snap"], ["c1", "c2"], "t")])
+        self.assertEqual(
+            self.meter.by_tag()["room_listener"], {"reads": 2, "writes": 0, "events": 1}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
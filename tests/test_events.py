@@ -0,0 +1,55 @@
+import threading
+import unittest
+
+from utils.events import ChannelSwitched, EventBus, MessagesAdded, PresenceChanged
+
+
+class TestEventBus(unittest.TestCase):
+    def setUp(self):
+        self.posted = []
+        self.bus = EventBus(post=self.posted.append)
+        self.seen = []
+
+    def test_handlers_receive_only_their_type(self):
+        self.bus.subscribe(ChannelSwitched, self.seen.append)
+        self.bus.publish(PresenceChanged(["ann"]))
+        self.bus.publish(ChannelSwitched("bob", "dm_ann_bob"))
+        self.assertEqual(self.seen, [ChannelSwitched("bob", "dm_ann_bob")])
+
+    def test_every_subscriber_is_called(self):
+        other = []
+        self.bus.subscribe(PresenceChanged, self.seen.append)
+        self.bus.subscribe(PresenceChanged, other.append)
+        self.bus.publish(PresenceChanged(["ann"]))
+        self.assertEqual(len(self.seen), 1)
+        self.assertEqual(len(other), 1)
+
+    def test_publish_from_other_thread_is_posted(self):
+        self.bus.subscribe(MessagesAdded, self.seen.append)
+        event = MessagesAdded("lobby", [{"_id": "m1"}])
+        thread = threading.Thread(target=lambda: self.bus.publish(event))
+        thread.start()
+        thread.join()
+        self.assertEqual(self.seen, [])
+        self.posted[0]()
+        self.assertEqual(self.seen, [event])
+
+    def test_failing_handler_does_not_block_others(self):
+        def broken(event):
+            raise ValueError("boom")
+
+        self.bus.subscribe(PresenceChanged, broken)
+        self.bus.subscribe(PresenceChanged, self.seen.append)
+        self.bus.publish(PresenceChanged([]))
+        self.assertEqual(len(self.seen), 1)
+
+    def test_unsubscribe(self):
+        unsubscribe = self.bus.subscribe(PresenceChanged, self.seen.append)
+        unsubscribe()
+        unsubscribe()
+        self.bus.publish(PresenceChanged([]))
+        self.assertEqual(self.seen, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,9 @@
+import gzip
+import json
+import os
+import tempfile
 import unittest
+from datetime import datetime, timezone
 from unittest.mock import MagicMock, patch
 
 import services.firestore_client as fc
@@ -24,5 +29,121 @@ class TestFirestoreClient(unittest.TestCase):
             mock_add.assert_called()
 
 
+def _doc(doc_id, data):
+    doc = MagicMock()
+    doc.id = doc_id
+    doc.to_dict.return_value = data
+    return doc
+
+
+class TestRoomExportImport(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "room.jsonl.gz")
+        self.ts = datetime(2025, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _export(self, pages, page_size):
+        query = MagicMock()
+        query.where.return_value = query
+        query.order_by.return_value = query
+        query.limit.return_value = query
+        query.start_after.return_value = query
+        query.get.side_effect = pages
+        db = MagicMock()
+        db.collection.return_value = query
+        with patch.object(fc, "_firestore_db", db, create=True):
+            count = fc.export_room(
+                "lobby", self.path, page_size=page_size, include_archive=False
+            )
+        return count, query
+
+    def _import_db(self):
+        db = MagicMock()
+        db.collection.return_value.document.side_effect = lambda doc_id: doc_id
+        self.writes = []
+        db.batch.side_effect = lambda: MagicMock(
+            set=lambda ref, data: self.writes.append((ref, data))
+        )
+        return db
+
+    def test_export_pages_until_short_page(self):
+        pages = [
+            [_doc("a", {"room_id": "lobby", "text": "1", "timestamp": self.ts})] * 2,
+            [_doc("c", {"room_id": "lobby", "text": "3"})],
+        ]
+        count, query = self._export(pages, page_size=2)
+        self.assertEqual(count, 3)
+        self.assertEqual(query.get.call_count, 2)
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(
+            lines[0]["data"]["timestamp"], {"__datetime__": self.ts.isoformat()}
+        )
+        self.assertFalse(os.path.exists(self.path + ".part"))
+
+    def test_import_round_trip_restores_types_and_ids(self):
+        pages = [
+            [
+                _doc(f"m{i}", {"room_id": "lobby", "timestamp": self.ts})
+                for i in range(5)
+            ]
+        ]
+        self._export(pages, page_size=10)
+        db = self._import_db()
+        with patch.object(fc, "_firestore_db", db, create=True):
+            written = fc.import_room(self.path, batch_size=2, workers=2)
+        self.assertEqual(written, 5)
+        self.assertEqual(db.batch.call_count, 3)
+        self.assertEqual(
+            sorted(ref for ref, _ in self.writes), [f"m{i}" for i in range(5)]
+        )
+        self.assertTrue(all(data["timestamp"] == self.ts for _, data in self.writes))
+        self.assertFalse(os.path.exists(self.path + ".ckpt"))
+
+    def test_import_into_other_room_prefixes_ids(self):
+        self._export([[_doc("m1", {"room_id": "lobby", "text": "x"})]], page_size=10)
+        db = self._import_db()
+        with patch.object(fc, "_firestore_db", db, create=True):
+            fc.import_room(self.path, room_id="archive")
+        self.assertEqual(
+            self.writes, [("archive__m1", {"room_id": "archive", "text": "x"})]
+        )
+
+    def test_import_resumes_from_checkpoint(self):
+        pages = [[_doc(f"m{i}", {"room_id": "lobby"}) for i in range(4)]]
+        self._export(pages, page_size=10)
+        with open(self.path + ".ckpt", "w", encoding="utf-8") as f:
+            json.dump({"lines_done": 3}, f)
+        db = self._import_db()
+        with patch.object(fc, "_firestore_db", db, create=True):
+            written = fc.import_room(self.path, batch_size=2)
+        self.assertEqual(written, 1)
+        self.assertEqual([ref for ref, _ in self.writes], ["m3"])
+
+    def test_failed_batch_keeps_checkpoint_at_last_contiguous_batch(self):
+        pages = [[_doc(f"m{i}", {"room_id": "lobby"}) for i in range(4)]]
+        self._export(pages, page_size=10)
+        db = self._import_db()
+        calls = []
+
+        def make_batch():
+            batch = MagicMock()
+            calls.append(batch)
+            if len(calls) == 2:
+                batch.commit.side_effect = RuntimeError("boom")
+            return batch
+
+        db.batch.side_effect = make_batch
+        with patch.object(fc, "_firestore_db", db, create=True):
+            with self.assertRaises(RuntimeError):
+                fc.import_room(self.path, batch_size=2, workers=1)
+        with open(self.path + ".ckpt", encoding="utf-8") as f:
+            self.assertEqual(json.load(f), {"lines_done": 2})
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,187 @@
+import asyncio
+import unittest
+from unittest.mock import MagicMock, patch
+
+from services.irc_gateway import (
+    IRCGateway,
+    account_credentials,
+    firebase_authenticator,
+    parse_line,
+)
+from services.message_store import MemoryStore
+
+
+class Client:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def send(self, line):
+        self.writer.write(line.encode() + b"\r\n")
+        await self.writer.drain()
+
+    async def expect(self, fragment, timeout=2):
+        """Read lines until one contains `fragment`; return it."""
+        while True:
+            raw = await asyncio.wait_for(self.reader.readline(), timeout)
+            if not raw:
+                raise AssertionError(f"connection closed before {fragment!r}")
+            line = raw.decode().rstrip("\r\n")
+            if fragment in line:
+                return line
+
+    async def silent(self, timeout=0.2):
+        try:
+            raw = await asyncio.wait_for(self.reader.readline(), timeout)
+        except asyncio.TimeoutError:
+            return True
+        raise AssertionError(f"unexpected line {raw!r}")
+
+
+class TestParseLine(unittest.TestCase):
+    def test_prefix_params_and_trailing(self):
+        self.assertEqual(
+            parse_line(":ann!a@h PRIVMSG #lobby :hello there\r\n"),
+            ("PRIVMSG", ["#lobby", "hello there"]),
+        )
+        self.assertEqual(parse_line("nick ann"), ("NICK", ["ann"]))
+        self.assertEqual(parse_line("   "), (None, []))
+
+
+class TestAccountCredentials(unittest.TestCase):
+    def test_email_in_pass_must_match_nick(self):
+        self.assertEqual(
+            account_credentials("ann", "ann@example.com:s:cret"),
+            ("ann@example.com", "s:cret"),
+        )
+        self.assertIsNone(account_credentials("bob", "ann@example.com:secret"))
+
+    def test_bare_password_needs_email_domain(self):
+        with patch("services.irc_gateway.config.IRC_EMAIL_DOMAIN", ""):
+            self.assertIsNone(account_credentials("ann", "secret"))
+        with patch("services.irc_gateway.config.IRC_EMAIL_DOMAIN", "example.com"):
+            self.assertEqual(
+                account_credentials("ann", "secret"), ("ann@example.com", "secret")
+            )
+
+    def test_firebase_authenticator(self):
+        auth = MagicMock()
+        auth.verify_password.return_value = True
+        authenticate = firebase_authenticator(auth)
+        self.assertTrue(authenticate("ann", "ann@example.com:secret"))
+        auth.verify_password.assert_called_once_with("ann@example.com", "secret")
+        self.assertFalse(authenticate("bob", "ann@example.com:secret"))
+        self.assertEqual(auth.verify_password.call_count, 1)
+
+
+class TestIRCGateway(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.store = MemoryStore()
+        self.gateway = IRCGateway(self.store, server_name="test")
+        self.server = await self.gateway.start("127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.clients = []
+
+    async def asyncTearDown(self):
+        for client in self.clients:
+            client.writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def connect(self, nick, join=True, password=None):
+        client = Client(*await asyncio.open_connection("127.0.0.1", self.port))
+        self.clients.append(client)
+        if password is not None:
+            await client.send(f"PASS {password}")
+        await client.send(f"NICK {nick}")
+        await client.send(f"USER {nick} 0 * :{nick}")
+        await client.expect(" 001 ")
+        if join:
+            await client.send("JOIN #lobby")
+            await client.expect(" 366 ")
+        return client
+
+    async def test_room_messages_fan_out_over_one_watch(self):
+        ann = await self.connect("ann")
+        bob = await self.connect("bob")
+        carl = await self.connect("carl")
+
+        await ann.expect("carl!carl@test JOIN")  # the others joined
+        await ann.send("PRIVMSG #lobby :hi all")
+        for client in (bob, carl):
+            line = await client.expect("PRIVMSG")
+            self.assertEqual(line, ":ann!ann@test PRIVMSG #lobby :hi all")
+        await ann.silent()  # no echo to the sender
+
+        # one room stream for the three sessions (+ one shared DM stream)
+        self.assertEqual(self.store.streams_opened, 2)
+        self.assertEqual(self.store.history("lobby")[0]["text"], "hi all")
+
+    async def test_messages_from_other_clients_are_delivered(self):
+        ann = await self.connect("ann")
+        self.store.add("lobby", "gui_user", "from the app")
+        line = await ann.expect("PRIVMSG")
+        self.assertEqual(line, ":gui_user!gui_user@test PRIVMSG #lobby :from the app")
+
+    async def test_direct_messages_use_dm_rooms(self):
+        ann = await self.connect("ann", join=False)
+        bob = await self.connect("bob", join=False)
+        await ann.send("PRIVMSG bob :psst")
+        line = await bob.expect("PRIVMSG")
+        self.assertEqual(line, ":ann!ann@test PRIVMSG bob :psst")
+        (stored,) = self.store.history("dm_ann_bob")
+        self.assertEqual(stored["participants"], ["ann", "bob"])
+
+    async def test_names_join_and_part(self):
+        ann = await self.connect("ann")
+        bob = await self.connect("bob")
+        await ann.expect("JOIN #lobby")  # bob joined
+        await bob.send("NAMES #lobby")
+        self.assertTrue((await bob.expect(" 353 ")).endswith(":ann bob"))
+
+        await bob.send("PART #lobby :bye")
+        self.assertEqual(await ann.expect("PART"), ":bob!bob@test PART #lobby :bye")
+        await ann.send("PART #lobby")
+        await ann.expect("PART")
+        self.assertEqual(self.gateway._room_watches, {})
+
+    async def test_errors(self):
+        ann = await self.connect("ann", join=False)
+        await ann.send("PRIVMSG #lobby :not joined")
+        await ann.expect(" 404 ")
+        await ann.send("JOIN #random")
+        await ann.expect(" 403 ")
+
+        dup = Client(*await asyncio.open_connection("127.0.0.1", self.port))
+        self.clients.append(dup)
+        await dup.send("NICK ann")
+        await dup.expect(" 433 ")
+        await dup.send("JOIN #lobby")
+        await dup.expect(" 451 ")
+
+    async def test_registration_requires_password_when_authenticating(self):
+        self.gateway.authenticate = lambda nick, password: password == "secret"
+        ann = Client(*await asyncio.open_connection("127.0.0.1", self.port))
+        self.clients.append(ann)
+        await ann.send("NICK ann")
+        await ann.send("USER ann 0 * :ann")
+        await ann.expect(" 464 ")
+        await ann.expect("ERROR")
+        self.assertEqual(self.gateway.sessions, {})
+
+        ann = await self.connect("ann", password="secret")
+        self.assertIn("ann", self.gateway.sessions)
+        await ann.send("PASS again")
+        await ann.expect(" 462 ")
+
+    async def test_quit_releases_watches(self):
+        ann = await self.connect("ann")
+        await ann.send("QUIT :bye")
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.gateway.sessions, {})
+        self.assertEqual(self.gateway._room_watches, {})
+        self.assertIsNone(self.gateway._direct_watch)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+from services.listeners import ListenerHub, ListenerSupervisor
+
+T0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeWatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.is_active = True
+        self.unsubscribed = False
+
+    def unsubscribe(self):
+        self.unsubscribed = True
+        self.is_active = False
+
+
+def _change(kind, minute, doc_id=None):
+    change = MagicMock()
+    change.type.name = kind
+    if doc_id is not None:
+        change.document.id = doc_id
+    change.document.to_dict.return_value = {"timestamp": T0 + timedelta(minutes=minute)}
+    return change
+
+
+class ListenerFixture:
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sup = ListenerSupervisor(
+            check_interval=1,
+            stall_timeout=30,
+            backoff_base=1,
+            backoff_max=8,
+            clock=self.clock,
+        )
+        self.watches = []
+        self.resumes = []
+        self.received = []
+
+    def make_query(self, resume_from=None):
+        self.resumes.append(resume_from)
+        query = MagicMock()
+
+        def on_snapshot(callback):
+            watch = FakeWatch(callback)
+            self.watches.append(watch)
+            return watch
+
+        query.on_snapshot.side_effect = on_snapshot
+        return query
+
+
+class TestListenerSupervisor(ListenerFixture, unittest.TestCase):
+    def add(self):
+        return self.sup.add(
+            "room", self.make_query, lambda *args: self.received.append(args)
+        )
+
+    def test_tracks_resume_point_and_resubscribes_from_it(self):
+        self.add()
+        self.watches[0].callback(
+            [], [_change("ADDED", 1), _change("ADDED", 5), _change("REMOVED", 9)], None
+        )
+        self.assertEqual(len(self.received), 1)
+
+        self.watches[0].is_active = False  # watch gave up
+        self.assertEqual(self.sup.check(), 0)  # backoff first
+        self.clock.now += 1
+        self.assertEqual(self.sup.check(), 1)
+        self.assertEqual(self.resumes, [None, T0 + timedelta(minutes=5)])
+        self.assertTrue(self.watches[0].unsubscribed)
+
+    def test_messages_at_the_resume_point_are_not_added_twice(self):
+        listener = self.add()
+        self.watches[0].callback(
+            [], [_change("ADDED", 1, "a"), _change("ADDED", 5, "b")], None
+        )
+        listener.start()  # reconnect: timestamp >= minute 5
+        self.watches[1].callback(
+            [], [_change("ADDED", 5, "b"), _change("ADDED", 5, "c")], None
+        )
+        changes = self.received[-1][1]
+        self.assertEqual([c.document.id for c in changes], ["c"])
+        # later snapshots are passed through as they are
+        self.watches[1].callback([], [_change("MODIFIED", 5, "b")], None)
+        self.assertEqual(len(self.received[-1][1]), 1)
+
+    def test_stalled_subscription_is_restarted(self):
+        self.add()
+        self.clock.now = 29
+        self.sup.check()
+        self.assertEqual(len(self.watches), 1)
+        self.clock.now = 31
+        self.sup.check()  # detected, backing off
+        self.clock.now = 32
+        self.sup.check()
+        self.assertEqual(len(self.watches), 2)
+
+    def test_backoff_grows_and_is_capped(self):
+        self.assertEqual([self.sup.backoff(n) for n in range(1, 7)], [1, 2, 4, 8, 8, 8])
+
+    def test_callbacks_from_superseded_watch_are_dropped(self):
+        listener = self.add()
+        first = self.watches[0]
+        listener.start()
+        first.callback([], [_change("ADDED", 1)], None)
+        self.assertEqual(self.received, [])
+        self.watches[1].callback([], [], None)
+        self.assertEqual(len(self.received), 1)
+
+    def test_unsubscribe_detaches_from_supervisor(self):
+        listener = self.add()
+        listener.unsubscribe()
+        self.assertTrue(self.watches[0].unsubscribed)
+        self.clock.now = 100
+        self.assertEqual(self.sup.check(), 0)
+        self.assertEqual(len(self.watches), 1)
+
+
+class TestListenerHub(ListenerFixture, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.hub = ListenerHub(self.sup)
+
+    def subscribe(self, received):
+        return self.hub.subscribe(
+            "room:lobby", self.make_query, lambda *args: received.append(args)
+        )
+
+    def test_subscribers_share_one_listener(self):
+        first, second = [], []
+        self.subscribe(first)
+        self.subscribe(second)
+        self.assertEqual(len(self.watches), 1)
+        self.watches[0].callback(["doc"], [_change("ADDED", 1)], None)
+        self.assertEqual(len(first), 1)
+        self.assertEqual(len(second), 1)
+
+    def test_late_subscriber_gets_latest_snapshot(self):
+        self.subscribe([])
+        self.watches[0].callback(["doc"], [_change("ADDED", 1)], "t1")
+        late = []
+        self.subscribe(late)
+        self.assertEqual(late, [(["doc"], [], "t1")])
+
+    def test_listener_stops_with_last_subscriber(self):
+        first = self.subscribe([])
+        second = self.subscribe([])
+        first.unsubscribe()
+        self.assertFalse(self.watches[0].unsubscribed)
+        second.unsubscribe()
+        self.assertTrue(self.watches[0].unsubscribed)
+        self.assertEqual(self.hub.subscribers("room:lobby"), 0)
+        # a new subscriber opens a fresh stream
+        self.subscribe([])
+        self.assertEqual(len(self.watches), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+
+import config
+from services.message_store import FirestoreStore, MemoryStore, get_store
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def __call__(self):
+        self.now += timedelta(seconds=1)
+        return self.now
+
+
+class TestMemoryStore(unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryStore(clock=FakeClock())
+
+    def test_history_pages_backwards_oldest_first(self):
+        for i in range(5):
+            self.store.add("lobby", "ann", f"m{i}")
+        newest = self.store.history("lobby", limit=2)
+        self.assertEqual([m["text"] for m in newest], ["m3", "m4"])
+        older = self.store.history("lobby", limit=2, before=newest[0])
+        self.assertEqual([m["text"] for m in older], ["m1", "m2"])
+        self.assertEqual(self.store.history("other"), [])
+
+    def test_streams_get_room_and_direct_messages(self):
+        room, direct = MagicMock(), MagicMock()
+        sub = self.store.stream("lobby", room)
+        self.store.stream_direct(direct)
+
+        self.store.add("lobby", "ann", "hi")
+        self.store.add("dm_ann_bob", "ann", "psst", participants=["bob", "ann"])
+        (messages,), _ = room.call_args
+        self.assertEqual(messages[0]["text"], "hi")
+        (messages,), _ = direct.call_args
+        self.assertEqual(messages[0]["participants"], ["ann", "bob"])
+        self.assertEqual(room.call_count, 1)
+
+        sub.unsubscribe()
+        sub.unsubscribe()  # idempotent
+        self.store.add("lobby", "ann", "again")
+        self.assertEqual(room.call_count, 1)
+        self.assertEqual(self.store.streams_opened, 2)
+
+    def test_delete_room(self):
+        self.store.add("lobby", "ann", "a")
+        self.store.add("lobby", "bob", "b")
+        self.assertEqual(self.store.delete_room("lobby"), 2)
+        self.assertEqual(self.store.history("lobby"), [])
+
+    def test_presence_expires_after_ttl(self):
+        self.store.set_presence("bob")
+        self.store.set_presence("Ann")
+        self.assertEqual(self.store.online_users(), ["Ann", "bob"])
+        self.store.clear_presence("bob")
+        self.assertEqual(self.store.online_users(), ["Ann"])
+        self.store._clock.now += timedelta(seconds=config.PRESENCE_TTL + 5)
+        self.assertEqual(self.store.online_users(), [])
+
+
+class TestFirestoreStore(unittest.TestCase):
+    def test_history_pages_desc_and_returns_oldest_first(self):
+        docs = []
+        for i in (2, 1):
+            doc = MagicMock(id=f"d{i}")
+            doc.to_dict.return_value = {"text": f"m{i}", "timestamp": i}
+            docs.append(doc)
+        store = FirestoreStore(supervisor=MagicMock())
+        with patch(
+            "services.message_store.fc.get_history_paginated",
+            return_value=(docs, None),
+        ) as page:
+            messages = store.history("lobby", limit=2, before={"timestamp": 3})
+        page.assert_called_once_with(
+            "lobby", limit=2, start_after={"timestamp": 3}, direction="desc"
+        )
+        self.assertEqual([m["_id"] for m in messages], ["d1", "d2"])
+
+    def test_direct_messages_update_the_conversation_index(self):
+        store = FirestoreStore(supervisor=MagicMock())
+        ref = MagicMock(id="d1")
+        with patch(
+            "services.message_store.fc.add_message", return_value=(None, ref)
+        ), patch("services.message_store.conversations.record_message") as record:
+            self.assertEqual(store.add("lobby", "ann", "hi"), "d1")
+            record.assert_not_called()
+            store.add("dm_ann_bob", "ann", "hi", participants=["ann", "bob"])
+        record.assert_called_once_with("dm_ann_bob", "ann", "hi", ["ann", "bob"])
+
+    def test_direct_stream_queries_only_dm_rooms(self):
+        supervisor = MagicMock()
+        store = FirestoreStore(supervisor=supervisor)
+        db = MagicMock()
+        with patch("services.message_store.fc.get_db", return_value=db):
+            store.stream_direct(lambda messages: None)
+            make_query = supervisor.add.call_args.args[1]
+            make_query()
+        query = db.collection.return_value
+        query.where.assert_called_once_with("room_id", ">=", "dm_")
+        query = query.where.return_value
+        query.where.assert_called_once_with("room_id", "<", "dm`")
+        self.assertLess("dm_zed_zoe", "dm`")
+
+    def test_user_stream_direct_reads_only_the_users_rooms(self):
+        supervisor = MagicMock()
+        store = FirestoreStore(supervisor=supervisor, username="ann")
+        db = MagicMock()
+        with patch("services.message_store.fc.get_db", return_value=db):
+            store.stream_direct(lambda messages: None)
+            supervisor.add.call_args.args[1]()
+        query = db.collection.return_value
+        query.where.assert_called_once_with("participants", "array_contains", "ann")
+        query.where.return_value.where.assert_called_once()
+        self.assertEqual(
+            query.where.return_value.where.call_args.args[:2], ("timestamp", ">=")
+        )
+
+
+class TestGetStore(unittest.TestCase):
+    def test_selects_backend(self):
+        self.assertIsInstance(get_store("memory"), MemoryStore)
+        with self.assertRaises(ValueError):
+            get_store("carrier-pigeon")
+        with patch("services.message_store.fc.init_firestore", return_value=None):
+            with self.assertRaises(RuntimeError):
+                get_store("firestore")
+
+
+if __name__ == "__main__":
+    unittest.main()
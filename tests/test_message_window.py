@@ -0,0 +1,46 @@
+import unittest
+
+from utils.message_window import MessageWindow
+
+
+def _marks(msg_id):
+    return (f"msg_s_{msg_id}", f"msg_e_{msg_id}")
+
+
+class TestMessageWindow(unittest.TestCase):
+    def test_dedupe_and_removal(self):
+        window = MessageWindow(limit=10)
+        window.add("a", _marks("a"))
+        self.assertIn("a", window)
+        self.assertEqual(window.marks("a"), _marks("a"))
+        self.assertEqual(window.remove("a"), _marks("a"))
+        self.assertNotIn("a", window)
+        self.assertIsNone(window.remove("a"))
+
+    def test_overflow_pops_oldest_first(self):
+        window = MessageWindow(limit=2)
+        for msg_id in "abcd":
+            window.add(msg_id, _marks(msg_id))
+        evicted = window.overflow()
+        self.assertEqual([msg_id for msg_id, _ in evicted], ["a", "b"])
+        self.assertEqual(list(window), ["c", "d"])
+        self.assertEqual(window.overflow(), [])
+
+    def test_add_above_makes_older_pages_evict_first(self):
+        window = MessageWindow(limit=2)
+        window.add("c", _marks("c"))
+        for msg_id in "ba":  # an older page, tracked newest first
+            window.add_above(msg_id, _marks(msg_id))
+        self.assertEqual(list(window), ["a", "b", "c"])
+        self.assertEqual([msg_id for msg_id, _ in window.overflow()], ["a"])
+
+    def test_clear_empties_the_index(self):
+        window = MessageWindow(limit=2)
+        window.add("a", _marks("a"))
+        window.clear()
+        self.assertEqual(len(window), 0)
+        self.assertNotIn("a", window)
+
+
+if __name__ == "__main__":
+    unittest.main()
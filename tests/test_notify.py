@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import utils.notify as notify
+from utils.notify import NotificationWorker, summarize
+
+
+class TestSummarize(unittest.TestCase):
+    def test_burst_from_one_sender_becomes_one_toast(self):
+        events = [("bob", "T", f"msg {i}") for i in range(5)]
+        self.assertEqual(summarize(events), [("5 нови съобщения от bob", "msg 4")])
+
+    def test_single_message_keeps_title(self):
+        self.assertEqual(summarize([("bob", "T", "hi")]), [("T", "hi")])
+
+    def test_many_senders_collapse_into_summary(self):
+        events = [(f"user{i}", "T", "hi") for i in range(5)]
+        toasts = summarize(events, max_toasts=3)
+        self.assertEqual(len(toasts), 1)
+        self.assertEqual(toasts[0][0], "5 нови съобщения")
+        self.assertIn("и още 3", toasts[0][1])
+
+
+class TestNotificationWorker(unittest.TestCase):
+    def test_sound_is_rate_limited(self):
+        now = [0.0]
+        toast, sound = MagicMock(), MagicMock()
+        worker = NotificationWorker(
+            coalesce_window=0,
+            sound_interval=5,
+            show_toast=toast,
+            play_sound=sound,
+            clock=lambda: now[0],
+        )
+        worker.deliver([("bob", "T", "a")])
+        now[0] = 2
+        worker.deliver([("ann", "T", "b")])
+        self.assertEqual(toast.call_count, 2)
+        self.assertEqual(sound.call_count, 1)
+        now[0] = 6
+        worker.deliver([("ann", "T", "c")])
+        self.assertEqual(sound.call_count, 2)
+
+    def test_worker_thread_coalesces_queued_events(self):
+        toast, sound = MagicMock(), MagicMock()
+        worker = NotificationWorker(
+            coalesce_window=0.2, show_toast=toast, play_sound=sound
+        )
+        for i in range(30):
+            worker.submit("bob", f"msg {i}")
+        worker.start()
+        worker.stop()
+        worker._thread.join(timeout=2)
+        toast.assert_called_once_with("30 нови съобщения от bob", "msg 29")
+        sound.assert_called_once()
+
+
+class TestSound(unittest.TestCase):
+    def _file(self, suffix):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.write(fd, b"RIFF")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_only_wav_files_are_cached(self):
+        self.assertEqual(notify._load_sound(self._file(".WAV")), b"RIFF")
+        self.assertIsNone(notify._load_sound(self._file(".mp3")))
+
+    def test_uncached_files_play_from_their_path(self):
+        played = MagicMock()
+        with patch.object(
+            notify.platform, "system", return_value="Windows"
+        ), patch.object(notify, "playsound", played):
+            notify._play_sound("ding.mp3", None)
+        played.assert_called_once_with("ding.mp3")
+
+
+if __name__ == "__main__":
+    unittest.main()
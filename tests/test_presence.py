@@ -0,0 +1,218 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+
+import services.firestore_client as fc
+import services.presence as presence
+from services.presence import (
+    STATE_ACTIVE,
+    STATE_HIDDEN,
+    STATE_IDLE,
+    PresenceHeartbeat,
+    PresenceRoster,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPresenceHeartbeat(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.write = MagicMock()
+        self.hb = PresenceHeartbeat(
+            self.write,
+            active_interval=30,
+            idle_interval=90,
+            hidden_interval=120,
+            idle_after=300,
+            jitter=0.2,
+            clock=self.clock,
+            rand=lambda: 0.5,
+        )
+
+    def test_first_tick_writes_and_unchanged_state_is_skipped(self):
+        self.assertTrue(self.hb.tick())
+        self.write.assert_called_once_with(STATE_ACTIVE)
+        self.clock.now += 10
+        self.assertFalse(self.hb.tick())
+        self.assertEqual(self.write.call_count, 1)
+
+    def test_keepalive_written_when_due(self):
+        self.hb.tick()
+        self.clock.now += 30
+        self.assertTrue(self.hb.tick())
+        self.assertEqual(self.write.call_count, 2)
+
+    def test_idle_and_minimised_states(self):
+        self.hb.tick()
+        self.clock.now += 301
+        self.assertEqual(self.hb.current_state(), STATE_IDLE)
+        self.assertTrue(self.hb.tick())
+        self.write.assert_called_with(STATE_IDLE)
+
+        self.hb.mark_activity()
+        self.assertEqual(self.hb.current_state(), STATE_ACTIVE)
+        self.hb.set_minimised(True)
+        self.assertEqual(self.hb.current_state(), STATE_HIDDEN)
+
+    def test_next_delay_is_jittered_within_bounds(self):
+        self.hb._rand = lambda: 0.0
+        self.assertAlmostEqual(self.hb.next_delay(STATE_IDLE), 72.0)
+        self.hb._rand = lambda: 1.0
+        self.assertAlmostEqual(self.hb.next_delay(STATE_IDLE), 108.0)
+
+    def test_failed_write_is_retried_next_tick(self):
+        self.write.side_effect = RuntimeError("offline")
+        self.assertFalse(self.hb.tick())
+        self.write.side_effect = None
+        self.assertTrue(self.hb.tick())
+
+
+def _doc(data):
+    doc = MagicMock()
+    doc.to_dict.return_value = data
+    return doc
+
+
+class TestPresenceRoster(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime(2025, 1, 1, 12, 0, tzinfo=timezone.utc)
+        self.roster = PresenceRoster(ttl=180, clock=lambda: self.now)
+
+    def test_replace_and_expire(self):
+        changed = self.roster.replace(
+            [
+                _doc({"username": "bob", "last_seen": self.now}),
+                _doc({"username": "Ann", "last_seen": self.now - timedelta(60)}),
+                _doc({"username": "carl", "last_seen": None}),
+            ]
+        )
+        self.assertTrue(changed)
+        # Ann's doc is days old and is dropped right away
+        self.assertEqual(self.roster.online_users(), ["bob", "carl"])
+
+        self.now += timedelta(seconds=181)
+        self.assertTrue(self.roster.expire())
+        self.assertEqual(self.roster.online_users(), [])
+        self.assertFalse(self.roster.expire())
+
+
+class TestCleanupStalePresence(unittest.TestCase):
+    def test_skips_when_recent_run_recorded(self):
+        db = MagicMock()
+        meta = MagicMock(exists=True)
+        meta.to_dict.return_value = {"last_run": datetime.now(timezone.utc)}
+        db.collection.return_value.document.return_value.get.return_value = meta
+
+        with patch.object(fc, "_firestore_db", db, create=True):
+            self.assertEqual(presence.cleanup_stale_presence(), 0)
+        db.batch.assert_not_called()
+
+    def test_deletes_stale_docs_in_batches(self):
+        db = MagicMock()
+        stale = [_doc({"username": "ghost"}), _doc({"username": "crashed"})]
+        query = db.collection.return_value.where.return_value.limit.return_value
+        query.get.return_value = stale
+
+        with patch.object(fc, "_firestore_db", db, create=True):
+            deleted = presence.cleanup_stale_presence(batch_size=10, force=True)
+        self.assertEqual(deleted, 2)
+        self.assertEqual(db.batch.return_value.delete.call_count, 2)
+        db.batch.return_value.commit.assert_called_once()
+
+
+class TestAggregatedPresence(unittest.TestCase):
+    def test_shard_for_is_stable_and_bounded(self):
+        self.assertEqual(presence.shard_for("bob", 8), presence.shard_for("bob", 8))
+        shards = {presence.shard_for(f"user{i}", 4) for i in range(200)}
+        self.assertEqual(shards, {f"shard_{i}" for i in range(4)})
+
+    def test_set_presence_merges_into_user_shard(self):
+        db = MagicMock()
+        with patch.object(fc, "_firestore_db", db, create=True), patch.object(
+            presence.config, "PRESENCE_MODE", presence.MODE_AGGREGATED
+        ):
+            presence.set_presence("bob", STATE_IDLE)
+        db.collection.assert_called_with(presence.SHARDS_COLLECTION)
+        db.collection.return_value.document.assert_called_with(
+            presence.shard_for("bob")
+        )
+        args, kwargs = db.collection.return_value.document.return_value.set.call_args
+        self.assertEqual(args[0]["users"]["bob"]["state"], STATE_IDLE)
+        self.assertTrue(kwargs["merge"])
+
+    def test_roster_reads_shard_docs(self):
+        now = datetime(2025, 1, 1, 12, 0, tzinfo=timezone.utc)
+        roster = PresenceRoster(ttl=180, clock=lambda: now)
+        roster.replace(
+            [
+                _doc({"users": {"bob": {"last_seen": now, "state": STATE_IDLE}}}),
+                _doc({"users": {"ann": {"last_seen": now - timedelta(hours=1)}}}),
+            ]
+        )
+        self.assertEqual(roster.online_users(), ["bob"])
+        self.assertEqual(roster.state_of("bob"), STATE_IDLE)
+
+
+class TestScopedPresenceWatcher(unittest.TestCase):
+    def setUp(self):
+        self.db = MagicMock()
+        self.patcher = patch.object(fc, "_firestore_db", self.db, create=True)
+        self.patcher.start()
+        self.addCleanup(self.patcher.stop)
+        self.roster = PresenceRoster(ttl=180)
+        self.changed = MagicMock()
+        self.watcher = presence.ScopedPresenceWatcher(
+            self.roster, self.changed, chunk_size=2
+        )
+
+    def _in_queries(self):
+        where = self.db.collection.return_value.where
+        return [c.args[2] for c in where.call_args_list]
+
+    def test_users_are_chunked_into_in_queries(self):
+        self.watcher.set_scope(["a", "b", "c"])
+        self.assertEqual(self._in_queries(), [["a", "b"], ["c"]])
+
+    def test_scope_change_only_resubscribes_touched_chunks(self):
+        self.watcher.set_scope(["a", "b", "c"])
+        self.db.collection.return_value.where.reset_mock()
+        self.watcher.set_scope(["a", "b", "d"])
+        self.assertEqual(self._in_queries(), [["d"]])
+        self.assertEqual(self.watcher.scope(), {"a", "b", "d"})
+
+    def test_snapshot_updates_roster_and_ignores_superseded_listeners(self):
+        self.watcher.set_scope(["a"])
+        on_snapshot = self.db.collection.return_value.where.return_value.on_snapshot
+        callback = on_snapshot.call_args.args[0]
+        now = datetime.now(timezone.utc)
+        callback([_doc({"username": "a", "last_seen": now})], [], None)
+        self.assertEqual(self.roster.online_users(), ["a"])
+        self.changed.assert_called_once()
+
+        self.watcher.set_scope(["b"])
+        callback([_doc({"username": "zed", "last_seen": now})], [], None)
+        self.assertNotIn("zed", self.roster.online_users())
+
+    def test_listeners_from_before_stop_are_ignored(self):
+        on_snapshot = self.db.collection.return_value.where.return_value.on_snapshot
+        self.watcher.set_scope(["a"])
+        stale = on_snapshot.call_args.args[0]
+        self.watcher.stop()
+        now = datetime.now(timezone.utc)
+        stale([_doc({"username": "a", "last_seen": now})], [], None)  # no chunks
+
+        self.watcher.set_scope(["b"])  # chunk 0 again
+        stale([_doc({"username": "zed", "last_seen": now})], [], None)
+        self.assertEqual(self.roster.online_users(), [])
+        self.changed.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from services.relay import RelayServer, RelayStore, user_token
+
+
+class TestRelay(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.clock_now = 1000.0
+        self.relay = RelayServer(
+            os.path.join(self.tmp, "relay.sqlite3"),
+            clock=lambda: self.clock_now,
+            token="secret",
+        )
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            self.relay.start("127.0.0.1", 0), self.loop
+        ).result(5)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.store = self.connect()
+        self.stores = [self.store]
+
+    def connect(self, token="secret", username=None):
+        return RelayStore(
+            "127.0.0.1", self.port, timeout=5, token=token, username=username
+        )
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+
+        async def shutdown():
+            self.server.close()
+            await self.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.loop.close()
+        self.relay.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def collector(self):
+        received, arrived = [], threading.Event()
+
+        def callback(messages):
+            received.extend(messages)
+            arrived.set()
+
+        return received, arrived, callback
+
+    def test_add_and_page_history(self):
+        for i in range(5):
+            self.store.add("lobby", "ann", f"m{i}")
+        newest = self.store.history("lobby", limit=2)
+        self.assertEqual([m["text"] for m in newest], ["m3", "m4"])
+        self.assertEqual(newest[0]["timestamp"].timestamp(), 1000.0)
+        older = self.store.history("lobby", limit=10, before=newest[0])
+        self.assertEqual([m["text"] for m in older], ["m0", "m1", "m2"])
+
+    def test_streams_push_new_messages(self):
+        room, room_arrived, on_room = self.collector()
+        direct, direct_arrived, on_direct = self.collector()
+        sub = self.store.stream("lobby", on_room)
+        self.store.stream_direct(on_direct)
+
+        self.store.add("lobby", "ann", "hi")
+        self.store.add("dm_ann_bob", "ann", "psst", participants=["bob", "ann"])
+        self.assertTrue(room_arrived.wait(2))
+        self.assertTrue(direct_arrived.wait(2))
+        self.assertEqual([m["text"] for m in room], ["hi"])
+        self.assertEqual(direct[0]["participants"], ["ann", "bob"])
+
+        sub.unsubscribe()
+        self.store.add("lobby", "ann", "after")
+        self.store.history("lobby")  # round trip: any push would be here by now
+        self.assertEqual(len(room), 1)
+
+    def test_delete_room_and_presence(self):
+        self.store.add("lobby", "ann", "a")
+        self.store.add("lobby", "bob", "b")
+        self.assertEqual(self.store.delete_room("lobby"), 2)
+        self.assertEqual(self.store.history("lobby"), [])
+
+        self.store.set_presence("bob")
+        self.store.set_presence("Ann")
+        self.assertEqual(self.store.online_users(), ["Ann", "bob"])
+        self.store.clear_presence("bob")
+        self.assertEqual(self.store.online_users(), ["Ann"])
+
+    def test_connections_must_authenticate(self):
+        with self.assertRaises(RuntimeError):
+            self.connect(token="guess")
+        with self.assertRaises(RuntimeError):
+            self.connect(token="secret", username="bob")  # bob's needs his token
+
+    def test_user_tokens_scope_to_own_dms(self):
+        bob = self.connect(user_token("secret", "bob"), "bob")
+        self.stores.append(bob)
+        direct, arrived, on_direct = self.collector()
+        bob.stream_direct(on_direct)
+
+        self.store.add("dm_ann_cat", "ann", "not for bob", participants=["ann", "cat"])
+        self.store.add("dm_ann_bob", "ann", "for bob", participants=["ann", "bob"])
+        self.assertTrue(arrived.wait(2))
+        self.assertEqual([m["text"] for m in direct], ["for bob"])
+        self.assertEqual(bob.history("dm_ann_cat"), [])
+
+        with self.assertRaises(RuntimeError):
+            bob.add("lobby", "ann", "impersonating")
+        with self.assertRaises(RuntimeError):
+            bob.delete_room("dm_ann_cat")
+        with self.assertRaises(RuntimeError):
+            bob.delete_room("lobby")
+        bob.add("lobby", "bob", "hi")
+        self.assertEqual(bob.delete_room("dm_ann_bob"), 1)
+
+    def test_dm_participants_must_match_the_room_id(self):
+        mallory = self.connect(user_token("secret", "mallory"), "mallory")
+        self.stores.append(mallory)
+        with self.assertRaises(RuntimeError):
+            mallory.add("dm_bob_cat", "mallory", "hi", participants=["mallory", "bob"])
+        with self.assertRaises(RuntimeError):
+            self.store.add("dm_bob_cat", "bob", "hi", participants=["bob"])
+        self.assertEqual(self.store.history("dm_bob_cat"), [])
+        self.store.add("dm_bob_cat", "bob", "hi", participants=["cat", "bob"])
+        with self.assertRaises(RuntimeError):
+            mallory.delete_room("dm_bob_cat")
+        self.assertEqual(mallory.history("dm_bob_cat"), [])
+
+    def test_server_errors_are_raised(self):
+        with self.assertRaises(RuntimeError):
+            self.store._call("no_such_op")
+        self.assertEqual(self.store.history("lobby"), [])  # still usable
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from utils.render import NO_TIME, build_batch, time_label
+
+T = datetime(2025, 1, 1, 9, 5, 30, tzinfo=timezone.utc)
+
+
+class TestTimeLabel(unittest.TestCase):
+    def test_shapes(self):
+        self.assertEqual(time_label(T), "[09:05]")
+        self.assertEqual(
+            time_label(SimpleNamespace(seconds=int(T.timestamp()))), "[09:05]"
+        )
+        self.assertEqual(time_label(None), NO_TIME)
+        self.assertEqual(time_label("garbage"), NO_TIME)
+
+
+class TestBuildBatch(unittest.TestCase):
+    def test_segments_tags_and_line_offsets(self):
+        batch = build_batch(
+            [
+                {"_id": "a", "username": "me", "text": "hi", "timestamp": T},
+                {"_id": "b", "username": "bob", "text": "two\nlines"},
+                {"username": "bob", "text": "no id"},
+            ],
+            me="me",
+        )
+        self.assertEqual(
+            batch.segments[:4], ["[09:05] me: ", ("user_msg",), "hi\n", ()]
+        )
+        self.assertEqual(batch.segments[5], ("other_msg",))
+        self.assertEqual(batch.entries, [("a", 0, 1), ("b", 1, 2), (None, 3, 1)])
+        self.assertEqual(batch.lines, 4)
+
+    def test_skips_rendered_and_repeated_ids(self):
+        batch = build_batch(
+            [{"_id": "a"}, {"_id": "b"}, {"_id": "b"}], me="me", skip_ids={"a"}
+        )
+        self.assertEqual([e[0] for e in batch.entries], ["b"])
+
+    def test_empty_batch_is_falsy(self):
+        self.assertFalse(build_batch([], me="me"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,206 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from services.rooms import (
+    RoomRegistry,
+    dm_participants,
+    dm_partner,
+    dm_room_id,
+    find_legacy_dm_room,
+    legacy_dm_room_id,
+    recent_dm_rooms,
+    scan_dm_rooms,
+)
+
+
+class TestDmPartner(unittest.TestCase):
+    def test_substring_usernames_do_not_match(self):
+        self.assertIsNone(dm_partner("dm_bob_joanna", "ann"))
+        self.assertEqual(dm_partner("dm_bob_joanna", "joanna"), "bob")
+
+    def test_usernames_with_underscores(self):
+        room_id = dm_room_id("ann_lee", "bob")
+        self.assertEqual(dm_partner(room_id, "ann_lee"), "bob")
+        self.assertEqual(dm_partner(room_id, "bob"), "ann_lee")
+        self.assertIsNone(dm_partner(room_id, "ann"))
+
+    def test_ids_do_not_collide(self):
+        self.assertNotEqual(dm_room_id("a", "b_c"), dm_room_id("a_b", "c"))
+        self.assertEqual(dm_partner(dm_room_id("a", "b_c"), "a"), "b_c")
+        self.assertEqual(dm_partner(dm_room_id("a_b", "c"), "c"), "a_b")
+        # names without underscores keep their legacy id
+        self.assertEqual(dm_room_id("bob", "ann"), legacy_dm_room_id("ann", "bob"))
+
+    def test_legacy_underscore_ids(self):
+        room_id = legacy_dm_room_id("ann_lee", "bob")
+        self.assertEqual(dm_partner(room_id, "ann_lee"), "bob")
+        # ambiguous ("ann" + "lee_bob" builds it too); explicit participants
+        # settle it
+        self.assertEqual(dm_partner(room_id, "ann"), "lee_bob")
+        rooms = RoomRegistry("ann")
+        rooms.register_room_doc(room_id, ["ann_lee", "bob"])
+        self.assertFalse(rooms.is_member(room_id, "ann"))
+
+    def test_non_dm_rooms(self):
+        self.assertIsNone(dm_partner("lobby", "ann"))
+
+    def test_participants_come_from_escaped_ids_only(self):
+        self.assertEqual(dm_participants(dm_room_id("b_c", "a")), ("a", "b_c"))
+        self.assertIsNone(dm_participants("dm_a_b_c"))  # legacy, ambiguous
+        self.assertIsNone(dm_participants("dm_b_a"))  # not sorted
+        self.assertIsNone(dm_participants("lobby"))
+
+
+class TestRoomRegistry(unittest.TestCase):
+    def setUp(self):
+        self.rooms = RoomRegistry("ann")
+
+    def test_bidirectional_lookup(self):
+        room_id = self.rooms.register_dm("bob")
+        self.assertEqual(self.rooms.room_for_channel("bob"), room_id)
+        self.assertEqual(self.rooms.channel_for_room(room_id), "bob")
+        self.assertEqual(self.rooms.participants(room_id), ("ann", "bob"))
+        self.assertIn("bob", self.rooms)
+        self.assertEqual(self.rooms.room_for_channel("lobby"), "lobby")
+
+    def test_unknown_channel_resolves_without_registering(self):
+        self.assertEqual(self.rooms.room_for_channel("carl"), "dm_ann_carl")
+        self.assertNotIn("carl", self.rooms)
+
+    def test_membership_prefers_explicit_participants(self):
+        self.assertTrue(self.rooms.register_room_doc("room-x", ["ann", "bob"]))
+        self.assertTrue(self.rooms.is_member("room-x"))
+        self.assertFalse(self.rooms.is_member("room-x", "carl"))
+        self.assertFalse(self.rooms.register_room_doc("room-y", ["bob", "carl"]))
+        self.assertFalse(self.rooms.is_member("dm_bob_joanna"))
+
+    def test_remove(self):
+        room_id = self.rooms.register_dm("bob")
+        self.rooms.remove("bob")
+        self.assertNotIn("bob", self.rooms)
+        self.assertEqual(self.rooms.dm_channels(), {})
+        self.assertEqual(self.rooms.channel_for_room(room_id), "bob")
+
+
+class TestRecentDmRooms(unittest.TestCase):
+    def test_distinct_rooms_newest_first(self):
+        docs = []
+        for room_id in ("dm_ann_cat", "dm_ann_bob", "dm_ann_cat", None):
+            doc = MagicMock()
+            doc.to_dict.return_value = {"room_id": room_id}
+            docs.append(doc)
+        db = MagicMock()
+        query = db.collection.return_value.where.return_value
+        query.order_by.return_value.limit.return_value.get.return_value = docs
+        with patch("services.rooms.fc.get_db", return_value=db):
+            self.assertEqual(
+                recent_dm_rooms("ann", scan=4), ["dm_ann_cat", "dm_ann_bob"]
+            )
+        db.collection.return_value.where.assert_called_once_with(
+            "participants", "array_contains", "ann"
+        )
+        query.order_by.return_value.limit.assert_called_once_with(4)
+
+
+class FakeMessages:
+    """`messages` filtered on room_id ranges, ordered by room_id, limited."""
+
+    def __init__(self, rows, filters=(), limit=None):
+        self.rows, self.filters, self.limit_to = rows, filters, limit
+
+    def where(self, field, op, value):
+        return FakeMessages(self.rows, self.filters + ((op, value),), self.limit_to)
+
+    def order_by(self, field):
+        return self
+
+    def limit(self, count):
+        return FakeMessages(self.rows, self.filters, count)
+
+    def get(self):
+        tests = {"==": str.__eq__, ">=": str.__ge__, ">": str.__gt__, "<": str.__lt__}
+        rows = sorted(
+            (
+                r
+                for r in self.rows
+                if all(tests[op](r["room_id"], v) for op, v in self.filters)
+            ),
+            key=lambda r: r["room_id"],
+        )
+        docs = []
+        for row in rows[: self.limit_to]:
+            doc = MagicMock()
+            doc.to_dict.return_value = row
+            docs.append(doc)
+        return docs
+
+
+class TestScanDmRooms(unittest.TestCase):
+    def test_finds_the_users_rooms_one_read_each(self):
+        rows = [
+            {"room_id": "lobby"},
+            {"room_id": "dm_ann_bob"},
+            {"room_id": "dm_ann_bob"},
+            {"room_id": "dm_bob_cat"},
+            {"room_id": "dm_a%5Fb_ann", "participants": ["a_b", "ann"]},
+            {"room_id": "dm_ann_x_y"},  # legacy id of ann + "x_y"
+        ]
+        db = MagicMock()
+        messages = FakeMessages(rows)
+        db.collection.return_value = messages
+        with patch("services.rooms.fc.get_db", return_value=db):
+            rooms = scan_dm_rooms("ann")
+        self.assertEqual(
+            rooms,
+            [
+                ("dm_a%5Fb_ann", ["a_b", "ann"]),
+                ("dm_ann_bob", ["ann", "bob"]),
+                ("dm_ann_x_y", ["ann", "x_y"]),
+            ],
+        )
+        # one query per distinct DM room, plus the empty one that ends it
+        self.assertEqual(db.collection.call_count, 5)
+
+
+class TestFindLegacyDmRoom(unittest.TestCase):
+    def _find(self, rows, user1="ann", user2="x_y"):
+        db = MagicMock()
+        db.collection.return_value = FakeMessages(rows)
+        with patch("services.rooms.fc.get_db", return_value=db):
+            return find_legacy_dm_room(user1, user2)
+
+    def test_history_of_the_pair_under_the_legacy_id(self):
+        rows = [{"room_id": "dm_ann_x_y", "username": u} for u in ("ann", "x_y")]
+        self.assertEqual(self._find(rows), "dm_ann_x_y")
+
+    def test_new_room_in_use_or_no_history(self):
+        legacy = {"room_id": "dm_ann_x_y", "username": "ann"}
+        new = {"room_id": dm_room_id("ann", "x_y"), "username": "ann"}
+        self.assertIsNone(self._find([legacy, new]))
+        self.assertIsNone(self._find([]))
+
+    def test_legacy_room_of_another_pair(self):
+        # "ann_x" + "y" share the legacy id
+        rows = [
+            {"room_id": "dm_ann_x_y", "username": "ann_x"},
+            {"room_id": "dm_ann_x_y", "username": "ann"},
+        ]
+        self.assertIsNone(self._find(rows))
+        rows = [
+            {
+                "room_id": "dm_ann_x_y",
+                "username": "ann",
+                "participants": ["ann", "ann_x"],
+            }
+        ]
+        self.assertIsNone(self._find(rows))
+
+    def test_names_without_underscores_never_probe(self):
+        db = MagicMock()
+        with patch("services.rooms.fc.get_db", return_value=db):
+            self.assertIsNone(find_legacy_dm_room("ann", "bob"))
+        db.collection.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timezone
+
+from services.session_snapshot import SessionSnapshot, SnapshotStore
+
+
+class TestSnapshotStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.store = SnapshotStore(self.tmp)
+
+    def test_round_trip(self):
+        sent = datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc)
+        snapshot = SessionSnapshot(
+            dms={"bob": ("dm_ann_bob", ("ann", "bob"))},
+            unread={"bob": 3},
+            messages={
+                "lobby": [
+                    {"_id": "m1", "username": "bob", "text": "hi", "timestamp": None},
+                    {"_id": "m2", "username": "ann", "text": "yo", "timestamp": sent},
+                ]
+            },
+            online=("ann", "bob"),
+        )
+        self.store.save("ann", snapshot)
+        loaded = self.store.load("ann")
+        self.assertEqual(loaded.dms, snapshot.dms)
+        self.assertEqual(loaded.unread, {"bob": 3})
+        self.assertEqual(loaded.online, ("ann", "bob"))
+        self.assertEqual(loaded.messages["lobby"][1]["timestamp"], sent)
+        self.assertEqual([m["text"] for m in loaded.messages["lobby"]], ["hi", "yo"])
+        self.assertIsNone(self.store.load("bob"))
+
+    def test_unread_list_from_older_snapshots(self):
+        os.makedirs(self.tmp, exist_ok=True)
+        record = {
+            "version": 1,
+            "dms": {},
+            "unread": ["bob"],
+            "messages": {},
+            "online": [],
+        }
+        with open(self.store.path("ann"), "w", encoding="utf-8") as f:
+            json.dump(record, f)
+        self.assertEqual(self.store.load("ann").unread, {"bob": 1})
+
+    def test_other_versions_and_garbage_are_ignored(self):
+        os.makedirs(self.tmp, exist_ok=True)
+        with open(self.store.path("ann"), "w", encoding="utf-8") as f:
+            json.dump({"version": 0, "dms": {}}, f)
+        self.assertIsNone(self.store.load("ann"))
+        with open(self.store.path("ann"), "w", encoding="utf-8") as f:
+            f.write("{not json")
+        self.assertIsNone(self.store.load("ann"))
+        with open(self.store.path("ann"), "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "dms": {"bob": "oops"}}, f)
+        self.assertIsNone(self.store.load("ann"))
+
+    @unittest.skipIf(os.name == "nt", "POSIX permissions")
+    def test_file_is_private(self):
+        self.store.save("ann", SessionSnapshot())
+        self.assertEqual(os.stat(self.store.path("ann")).st_mode & 0o777, 0o600)
+
+    def test_clear(self):
+        self.store.save("ann", SessionSnapshot())
+        self.store.clear("ann")
+        self.assertIsNone(self.store.load("ann"))
+        self.store.clear("ann")  # already gone
+
+
+if __name__ == "__main__":
+    unittest.main()
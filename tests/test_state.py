@@ -0,0 +1,110 @@
+import threading
+import unittest
+
+from utils.state import (
+    ChatSnapshot,
+    ChatStore,
+    add_dms,
+    mark_read,
+    mark_unread,
+    remove_dm,
+    reset,
+    select_channel,
+    set_unread,
+    unread_count,
+)
+
+
+class TestChanges(unittest.TestCase):
+    def test_select_channel_marks_it_read(self):
+        state = ChatSnapshot(dm_channels=("bob",), unread_counts=(("bob", 1),))
+        state = select_channel(state, "bob")
+        self.assertEqual(state.current_channel, "bob")
+        self.assertEqual(state.unread, frozenset())
+
+    def test_add_dms_sorted_and_deduplicated(self):
+        state = add_dms(ChatSnapshot(), ["bob", "Ann", "lobby"])
+        state = add_dms(state, ["bob", "carl"])
+        self.assertEqual(state.dm_channels, ("Ann", "bob", "carl"))
+        self.assertIs(add_dms(state, ["bob"]), state)
+
+    def test_active_channel_is_never_unread(self):
+        state = ChatSnapshot(current_channel="bob")
+        self.assertIs(mark_unread(state, "bob"), state)
+        self.assertEqual(mark_unread(state, "ann").unread, frozenset({"ann"}))
+
+    def test_counts_are_incremental(self):
+        state = mark_unread(ChatSnapshot(), "bob")
+        state = mark_unread(state, "bob", 2)
+        self.assertEqual(unread_count(state, "bob"), 3)
+        self.assertEqual(state.unread_counts, (("bob", 3),))
+        state = select_channel(state, "bob")
+        self.assertEqual(unread_count(state, "bob"), 0)
+        self.assertEqual(state.unread_counts, ())
+
+    def test_set_unread_replaces_count(self):
+        state = mark_unread(ChatSnapshot(), "bob", 4)
+        state = set_unread(state, "bob", 1)
+        self.assertEqual(unread_count(state, "bob"), 1)
+        self.assertIs(set_unread(state, "bob", 1), state)
+        state = set_unread(state, "bob", 0)
+        self.assertEqual(state.unread, frozenset())
+        self.assertEqual(set_unread(ChatSnapshot("bob"), "bob", 5).unread, frozenset())
+
+    def test_remove_dm_drops_unread_marker(self):
+        state = ChatSnapshot(dm_channels=("ann", "bob"), unread_counts=(("bob", 2),))
+        state = remove_dm(state, "bob")
+        self.assertEqual(state.dm_channels, ("ann",))
+        self.assertEqual(state.unread, frozenset())
+        self.assertEqual(mark_read(state, "ann"), state)
+
+    def test_reset_keeps_active_channel(self):
+        state = ChatSnapshot("bob", ("bob",), (("ann", 1),))
+        self.assertEqual(reset(state), ChatSnapshot(current_channel="bob"))
+
+
+class TestChatStore(unittest.TestCase):
+    def setUp(self):
+        self.posted = []
+        self.store = ChatStore(post=self.posted.append)
+        self.seen = []
+        self.store.subscribe(lambda old, new: self.seen.append((old, new)))
+
+    def test_writer_thread_applies_immediately(self):
+        self.store.dispatch(add_dms, ["bob"])
+        self.assertEqual(self.store.snapshot.dm_channels, ("bob",))
+        self.assertEqual(len(self.seen), 1)
+        self.assertEqual(self.posted, [])
+
+    def test_other_threads_post_to_writer(self):
+        thread = threading.Thread(
+            target=lambda: self.store.dispatch(mark_unread, "bob")
+        )
+        thread.start()
+        thread.join()
+        self.assertEqual(self.store.snapshot.unread, frozenset())
+        self.assertEqual(len(self.posted), 1)
+
+        self.posted[0]()
+        self.assertEqual(self.store.snapshot.unread, frozenset({"bob"}))
+
+    def test_no_notification_without_change(self):
+        self.store.dispatch(select_channel, "lobby")
+        self.assertEqual(self.seen, [])
+
+    def test_readers_keep_their_snapshot(self):
+        before = self.store.snapshot
+        self.store.dispatch(add_dms, ["bob"])
+        self.assertEqual(before.dm_channels, ())
+        old, new = self.seen[0]
+        self.assertIs(old, before)
+        self.assertIs(new, self.store.snapshot)
+
+    def test_unsubscribe(self):
+        unsubscribe = self.store.subscribe(lambda old, new: self.fail("called"))
+        unsubscribe()
+        self.store.dispatch(add_dms, ["bob"])
+
+
+if __name__ == "__main__":
+    unittest.main()
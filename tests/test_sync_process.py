@@ -0,0 +1,185 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+
+from services.listeners import ListenerSupervisor
+from services.sync_process import SyncEngine, compact_message, expand_message
+
+# recent: REMOVED changes of messages old enough to be archived are ignored
+T0 = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(hours=1)
+
+
+class FakeQuery:
+    def __init__(self, watches):
+        self.filters = []
+        self._watches = watches
+
+    def where(self, *args):
+        self.filters.append(args)
+        return self
+
+    def on_snapshot(self, callback):
+        watch = MagicMock(is_active=True)
+        watch.callback = callback
+        self._watches.append((self, watch))
+        return watch
+
+
+def _doc(doc_id, minute, text="hi", username="ann"):
+    doc = MagicMock()
+    doc.id = doc_id
+    doc.to_dict.return_value = {
+        "username": username,
+        "text": text,
+        "timestamp": T0 + timedelta(minutes=minute),
+        "room_id": "lobby",
+    }
+    return doc
+
+
+def _change(kind, doc):
+    change = MagicMock()
+    change.type.name = kind
+    change.document = doc
+    return change
+
+
+class TestMessageCodec(unittest.TestCase):
+    def test_round_trip(self):
+        data = {
+            "username": "ann",
+            "text": "hi",
+            "timestamp": T0,
+            "participants": ["ann", "bob"],
+        }
+        message = compact_message("m1", data)
+        self.assertEqual(message, ("m1", "ann", "hi", T0.timestamp(), ("ann", "bob")))
+        self.assertEqual(
+            expand_message(message),
+            {
+                "_id": "m1",
+                "username": "ann",
+                "text": "hi",
+                "timestamp": T0,
+                "participants": ["ann", "bob"],
+            },
+        )
+
+    def test_pending_server_timestamp(self):
+        message = compact_message("m1", {"username": "ann", "text": "hi"})
+        self.assertIsNone(expand_message(message)["timestamp"])
+
+
+class TestSyncEngine(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.watches = []
+        self.db = MagicMock()
+        self.db.collection.side_effect = lambda name: FakeQuery(self.watches)
+        patcher = patch("services.sync_process.fc.get_db", return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.history = patch(
+            "services.sync_process.fc.get_history_paginated",
+            return_value=([_doc("b", 2), _doc("a", 1)], None),
+        )
+        self.get_history = self.history.start()
+        self.addCleanup(self.history.stop)
+        self.engine = SyncEngine(
+            self.events.append, supervisor=ListenerSupervisor(), cache_rooms=2
+        )
+
+    def _snapshot(self, docs, changes):
+        _, watch = self.watches[-1]
+        watch.callback(docs, changes, None)
+
+    def test_first_watch_fetches_history_oldest_first(self):
+        self.engine.watch_room("lobby", 1)
+        kind, room_id, generation, history = self.events[0]
+        self.assertEqual((kind, room_id, generation), ("history", "lobby", 1))
+        self.assertEqual([m[0] for m in history], ["a", "b"])
+        query, _ = self.watches[-1]
+        self.assertIn(("timestamp", ">=", T0 + timedelta(minutes=1)), query.filters)
+
+    def test_initial_snapshot_matching_history_emits_nothing(self):
+        self.engine.watch_room("lobby", 1)
+        a, b = _doc("a", 1), _doc("b", 2)
+        self._snapshot([a, b], [_change("ADDED", a), _change("ADDED", b)])
+        self.assertEqual(len(self.events), 1)
+
+    def test_live_changes_become_deltas(self):
+        self.engine.watch_room("lobby", 1)
+        a, b = _doc("a", 1), _doc("b", 2)
+        self._snapshot([a, b], [_change("ADDED", a), _change("ADDED", b)])
+        c, edited = _doc("c", 3), _doc("a", 1, text="edited")
+        self._snapshot(
+            [edited, c],
+            [
+                _change("ADDED", c),
+                _change("MODIFIED", edited),
+                _change("REMOVED", b),
+            ],
+        )
+        kind, _, generation, added, modified, removed = self.events[-1]
+        self.assertEqual(kind, "changes")
+        self.assertEqual(generation, 1)
+        self.assertEqual([m[0] for m in added], ["c"])
+        self.assertEqual([m[2] for m in modified], ["edited"])
+        self.assertEqual(removed, ["b"])
+
+    def test_messages_moved_into_chunks_are_not_removed(self):
+        self.engine.watch_room("lobby", 1)
+        old = _doc("old", -60 * 24 * 365)  # a year old: archived by compaction
+        self._snapshot([old], [_change("ADDED", old)])
+        self.events.clear()
+        self._snapshot([], [_change("REMOVED", old)])
+        self.assertEqual(self.events, [])
+
+    def test_cached_room_skips_history_read_and_diffs_first_snapshot(self):
+        self.engine.watch_room("lobby", 1)
+        self.engine.watch_room("dm_ann_bob", 2)
+        self.engine.watch_room("lobby", 3)
+        self.assertEqual(self.get_history.call_count, 2)
+        self.assertEqual([m[0] for m in self.events[-1][3]], ["a", "b"])
+
+        # "b" was deleted while another room was watched
+        a = _doc("a", 1)
+        self._snapshot([a], [_change("ADDED", a)])
+        self.assertEqual(self.events[-1], ("changes", "lobby", 3, [], [], ["b"]))
+
+    def test_room_cache_is_lru_bounded(self):
+        for generation, room_id in enumerate(["r1", "r2", "r3"], 1):
+            self.engine.watch_room(room_id, generation)
+        self.engine.watch_room("r1", 4)
+        self.assertEqual(self.get_history.call_count, 4)
+
+    def test_global_listener_emits_dms_from_others(self):
+        self.engine.username = "ann"
+        self.engine._watch_global()
+        dm = _doc("m1", 1, username="bob")
+        dm.to_dict.return_value.update(
+            room_id="dm_ann_bob", participants=["ann", "bob"]
+        )
+        mine = _doc("m2", 1, username="ann")
+        mine.to_dict.return_value["room_id"] = "dm_ann_bob"
+        lobby = _doc("m3", 1, username="bob")
+        self._snapshot(
+            [dm, mine, lobby],
+            [_change("ADDED", d) for d in (dm, mine, lobby)],
+        )
+        self.assertEqual(self.events, [("dm", "dm_ann_bob", "bob", ("ann", "bob"))])
+
+    def test_presence_emits_only_on_change(self):
+        self.engine._roster.replace = MagicMock()
+        self.engine._roster.online_users = MagicMock(return_value=["ann"])
+        self.engine._emit_presence()
+        self.engine._emit_presence()
+        self.assertEqual(self.events, [("presence", ["ann"])])
+
+    def test_stop_command_ends_loop(self):
+        self.assertTrue(self.engine.handle(("presence_scope", ["ann"])))
+        self.assertFalse(self.engine.handle(("stop",)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import threading
+import unittest
+
+from utils.tasks import TaskExecutor
+
+
+class TestTaskExecutor(unittest.TestCase):
+    def setUp(self):
+        self.dispatched = []
+        self.executor = TaskExecutor(max_workers=1, dispatch=self.dispatched.append)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def _block_pool(self):
+        """Occupy the single worker until the returned event is set."""
+        release, started = threading.Event(), threading.Event()
+        self.executor.submit("blocker", lambda token: (started.set(), release.wait(5)))
+        started.wait(5)
+        return release
+
+    def _drain(self):
+        # a task submitted after the others only runs once they are done
+        done = threading.Event()
+        self.executor.submit("drain", lambda token: done.set())
+        done.wait(5)
+
+    def test_superseded_queued_task_never_runs(self):
+        release = self._block_pool()
+        ran = []
+        self.executor.submit("chat", lambda token: ran.append("a"))
+        self.executor.submit("chat", lambda token: ran.append("b"))
+        release.set()
+        self._drain()
+        self.assertEqual(ran, ["b"])
+
+    def test_result_of_superseded_running_task_is_dropped(self):
+        results = []
+        proceed, started = threading.Event(), threading.Event()
+
+        def slow(token):
+            started.set()
+            proceed.wait(5)
+            return "room A"
+
+        first = self.executor.submit("chat", slow, on_done=results.append)
+        started.wait(5)
+        self.executor.submit("chat", lambda token: "room B", on_done=results.append)
+        self.assertTrue(first.cancelled)
+        proceed.set()
+        self._drain()
+        for fn in self.dispatched:
+            fn()
+        self.assertEqual(results, ["room B"])
+
+    def test_token_rechecked_when_dispatched_callback_runs(self):
+        results = []
+        self.executor.submit("chat", lambda token: 1, on_done=results.append)
+        self._drain()
+        self.executor.cancel("chat")  # switch happens before the UI runs it
+        for fn in self.dispatched:
+            fn()
+        self.assertEqual(results, [])
+
+    def test_non_superseding_task_joins_current_generation(self):
+        results = []
+        release = self._block_pool()
+        self.executor.submit("history", lambda token: "page 1", on_done=results.append)
+        self.executor.submit(
+            "history", lambda token: "older", on_done=results.append, supersede=False
+        )
+        release.set()
+        self._drain()
+        for fn in self.dispatched:
+            fn()
+        self.assertEqual(results, ["page 1", "older"])
+
+
+if __name__ == "__main__":
+    unittest.main()
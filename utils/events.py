@@ -0,0 +1,94 @@
+"""Typed in-process event bus for the chat window.
+
+Producers (snapshot listeners, the sync process pump, `send_message`,
+`switch_channel`) publish small immutable events; consumers subscribe by
+event type instead of wrapping methods or opening listeners of their own.
+
+Like `utils.state.ChatStore`, handlers always run on the writer thread (the
+Tk thread that created the bus): `publish()` there delivers immediately,
+from any other thread the delivery is handed to `post`.
+"""
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Type
+
+
+class ChannelSwitched(NamedTuple):
+    channel: str
+    room_id: Optional[str]
+
+
+class MessagesAdded(NamedTuple):
+    room_id: Optional[str]
+    messages: List[dict]
+
+
+class MessagesModified(NamedTuple):
+    room_id: Optional[str]
+    messages: List[dict]
+
+
+class MessagesRemoved(NamedTuple):
+    room_id: Optional[str]
+    ids: List[str]
+
+
+class PresenceChanged(NamedTuple):
+    online: List[str]
+
+
+class RoomsLoaded(NamedTuple):
+    """The user's DM rooms are known (after login); channels in sidebar order."""
+
+    channels: List[str]
+
+
+class SessionRestored(NamedTuple):
+    """A login started; DM channel -> messages from the session snapshot
+    (empty without one)."""
+
+    messages: Dict[str, List[dict]]
+
+
+class ScrollbackTrimmed(NamedTuple):
+    """The oldest rendered messages of `channel` were dropped from the view."""
+
+    channel: str
+    ids: List[str]
+
+
+class SendAcked(NamedTuple):
+    room_id: str
+    message: dict
+
+
+class EventBus:
+    """Synchronous pub/sub keyed by event type."""
+
+    def __init__(self, post: Optional[Callable[[Callable[[], None]], None]] = None):
+        self._post = post
+        self._writer = threading.current_thread()
+        self._handlers: Dict[Type, List[Callable]] = defaultdict(list)
+
+    def subscribe(self, event_type: Type, handler: Callable) -> Callable[[], None]:
+        """Call `handler(event)` for every published `event_type`. Returns an unsubscribe."""
+        self._handlers[event_type].append(handler)
+        return lambda: self._discard(event_type, handler)
+
+    def _discard(self, event_type, handler):
+        handlers = self._handlers.get(event_type, [])
+        if handler in handlers:
+            handlers.remove(handler)
+
+    def publish(self, event: Tuple):
+        if self._post is None or threading.current_thread() is self._writer:
+            self._deliver(event)
+        else:
+            self._post(lambda: self._deliver(event))
+
+    def _deliver(self, event):
+        for handler in list(self._handlers.get(type(event), ())):
+            try:
+                handler(event)
+            except Exception as e:
+                print(f"[WARN] {type(event).__name__} handler failed: {e}")
@@ -0,0 +1,55 @@
+"""Bounded index of the messages rendered in the chat view.
+
+`MessageWindow` maps doc id -> (start_mark, end_mark) in render order. It is
+the dedupe index: an id is in the window exactly while its text is in the
+widget. Clearing the view clears the window, and trimming scrollback removes
+the oldest entries together with their text, so the index never outgrows
+what is on screen.
+"""
+from collections import OrderedDict
+from typing import Iterator, List, Optional, Tuple
+
+Marks = Tuple[str, str]
+
+
+class MessageWindow:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._entries: "OrderedDict[str, Marks]" = OrderedDict()
+
+    def __contains__(self, msg_id) -> bool:
+        return msg_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def items(self):
+        return self._entries.items()
+
+    def add(self, msg_id: str, marks: Marks):
+        """Record a message rendered below everything already in the window."""
+        self._entries[msg_id] = marks
+
+    def add_above(self, msg_id: str, marks: Marks):
+        """Record a message rendered above everything in the window (older page)."""
+        self._entries[msg_id] = marks
+        self._entries.move_to_end(msg_id, last=False)
+
+    def marks(self, msg_id: str) -> Optional[Marks]:
+        return self._entries.get(msg_id)
+
+    def remove(self, msg_id: str) -> Optional[Marks]:
+        return self._entries.pop(msg_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def overflow(self) -> List[Tuple[str, Marks]]:
+        """Pop and return the oldest entries beyond `limit`, oldest first."""
+        evicted = []
+        while len(self._entries) > self.limit:
+            evicted.append(self._entries.popitem(last=False))
+        return evicted
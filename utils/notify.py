@@ -1,6 +1,24 @@
+"""Desktop alerts for incoming direct messages.
+
+`notify_dm` queues alerts on one shared `NotificationWorker` thread, which
+coalesces bursts into a few toasts (`summarize`) and plays at most one sound
+per `config.NOTIFY_SOUND_INTERVAL`. Toasts go through plyer when it is
+installed.
+
+A `.wav` sound file is read once when the worker is created and, on
+Windows, played from memory (`winsound.SND_MEMORY` only plays WAV). Other
+formats and platforms go through `playsound`, which takes the path and reads
+the file on every alert; without it Windows beeps and elsewhere the terminal
+bell is used. The rate limit bounds those reads.
+"""
 import platform
+import queue
 import threading
 import time
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+import config
 
 try:
     from playsound import playsound
@@ -12,33 +30,12 @@ try:
 except Exception:
     notification = None
 
+DEFAULT_TITLE = "Ново лично съобщение"
 
-def _play_sound_thread(file_or_none=None):
-    try:
-        if playsound and file_or_none:
-            playsound(file_or_none)
-        else:
-            # fallback: use simple system beep
-            if platform.system() == "Windows":
-                try:
-                    import winsound
-
-                    winsound.MessageBeep()
-                except Exception:
-                    pass
-            else:
-                # bell character
-                print("\a", end="")
-    except Exception:
-        pass
-
+_STOP = object()
 
-def notify_dm(title: str, message: str, sound_file: str = None):
-    """Cross-platform notification for incoming DM.
 
-    Attempts to show a desktop notification via plyer (if available) and play a short sound.
-    """
-    # Show desktop notification if possible
+def _show_toast(title: str, message: str):
     try:
         if notification:
             notification.notify(
@@ -47,10 +44,192 @@ def notify_dm(title: str, message: str, sound_file: str = None):
     except Exception:
         pass
 
-    # Play sound in a separate thread to avoid blocking UI
+
+def _load_sound(file_or_none=None) -> Optional[bytes]:
+    """Read a WAV file once so repeated alerts don't hit the disk (Windows)."""
+    if not file_or_none or not file_or_none.lower().endswith(".wav"):
+        return None
     try:
-        threading.Thread(
-            target=_play_sound_thread, args=(sound_file,), daemon=True
-        ).start()
+        with open(file_or_none, "rb") as f:
+            return f.read()
+    except Exception as e:
+        print(f"[WARN] Неуспешно зареждане на звук {file_or_none}: {e}")
+        return None
+
+
+def _play_sound(file_or_none=None, data: Optional[bytes] = None):
+    try:
+        windows = platform.system() == "Windows"
+        if windows and data:
+            import winsound
+
+            winsound.PlaySound(data, winsound.SND_MEMORY)
+        elif playsound and file_or_none:
+            playsound(file_or_none)
+        elif windows:
+            import winsound
+
+            winsound.MessageBeep()
+        else:
+            # bell character
+            print("\a", end="")
     except Exception:
         pass
+
+
+def summarize(
+    events: List[Tuple[Optional[str], str, str]], max_toasts: int = 3
+) -> List[Tuple[str, str]]:
+    """Collapse a burst of (sender, title, message) events into toasts.
+
+    One toast per sender ("5 нови съобщения от X"); if more than `max_toasts`
+    senders are involved, a single summary toast is returned instead.
+    """
+    groups: "OrderedDict[str, list]" = OrderedDict()
+    for sender, title, message in events:
+        groups.setdefault(sender or title, []).append((sender, title, message))
+
+    if len(groups) > max_toasts:
+        names = list(groups)
+        shown = ", ".join(names[: max_toasts - 1])
+        return [
+            (
+                f"{len(events)} нови съобщения",
+                f"От: {shown} и още {len(names) - (max_toasts - 1)}",
+            )
+        ]
+
+    toasts = []
+    for items in groups.values():
+        sender, title, message = items[-1]
+        if len(items) == 1 or sender is None:
+            toasts.append((title, message))
+        else:
+            toasts.append((f"{len(items)} нови съобщения от {sender}", message))
+    return toasts
+
+
+class NotificationWorker:
+    """Single long-lived thread that delivers DM alerts.
+
+    `submit()` is safe to call from any thread. The worker waits
+    `coalesce_window` seconds after the first event of a burst, shows the
+    collapsed toasts from `summarize()` and plays at most one sound per
+    `sound_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        sound_file: Optional[str] = None,
+        coalesce_window: Optional[float] = None,
+        sound_interval: Optional[float] = None,
+        max_toasts: int = 3,
+        show_toast: Callable[[str, str], None] = _show_toast,
+        play_sound: Callable[..., None] = _play_sound,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.sound_file = sound_file
+        self.coalesce_window = (
+            config.NOTIFY_COALESCE_WINDOW
+            if coalesce_window is None
+            else coalesce_window
+        )
+        self.sound_interval = (
+            config.NOTIFY_SOUND_INTERVAL if sound_interval is None else sound_interval
+        )
+        self.max_toasts = max_toasts
+        self._show_toast = show_toast
+        self._play_sound = play_sound
+        self._clock = clock
+        self._sound_data = _load_sound(sound_file)
+        self._last_sound_at: Optional[float] = None
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(
+        self,
+        sender: Optional[str],
+        message: Optional[str] = None,
+        title: str = DEFAULT_TITLE,
+    ):
+        self._queue.put((sender, title, message or f"От: {sender}"))
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._queue.put(_STOP)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = self._clock() + self.coalesce_window
+            stopping = False
+            while True:
+                remaining = deadline - self._clock()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self.deliver(batch)
+            if stopping:
+                return
+
+    def deliver(self, batch: List[Tuple[Optional[str], str, str]]):
+        for title, message in summarize(batch, self.max_toasts):
+            self._show_toast(title, message)
+        now = self._clock()
+        if self._last_sound_at is None or (
+            now - self._last_sound_at >= self.sound_interval
+        ):
+            self._last_sound_at = now
+            self._play_sound(self.sound_file, self._sound_data)
+
+
+_worker: Optional[NotificationWorker] = None
+_worker_lock = threading.Lock()
+
+
+def get_worker(sound_file: Optional[str] = None) -> NotificationWorker:
+    """Return the shared, started notification worker.
+
+    `sound_file` (or `config.NOTIFY_SOUND_FILE`) is used when the worker is
+    first created; the file is read once and reused for every alert.
+    """
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = NotificationWorker(
+                sound_file=sound_file or config.NOTIFY_SOUND_FILE
+            )
+            _worker.start()
+        return _worker
+
+
+def stop_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is not None:
+            _worker.stop()
+            _worker = None
+
+
+def notify_dm(title: str, message: str, sound_file: str = None):
+    """Cross-platform notification for incoming DM.
+
+    Queues the alert on the shared notification worker, which coalesces bursts
+    and rate-limits sounds.
+    """
+    get_worker(sound_file).submit(None, message, title=title)
@@ -0,0 +1,94 @@
+"""Pure render builder for the chat history widget (no Tk here).
+
+`build_batch` turns a batch of messages into the flat argument list of one
+multi-segment `Text.insert(index, text, tags, text, tags, ...)` call plus
+the line offset of every message, so the caller can place its marks without
+asking Tk for indices one message at a time. Time labels are cached per
+hour/minute.
+"""
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Container, Iterable, List, Optional, Tuple
+
+NO_TIME = "[--:--]"
+USER_TAG = "user_msg"
+OTHER_TAG = "other_msg"
+
+
+def to_datetime(timestamp) -> Optional[datetime]:
+    """Normalise the timestamp shapes Firestore SDKs return."""
+    if not timestamp:
+        return None
+    try:
+        # native python datetime
+        if hasattr(timestamp, "strftime"):
+            return timestamp
+        # protobuf Timestamp (google.protobuf.Timestamp)
+        if hasattr(timestamp, "ToDatetime"):
+            return timestamp.ToDatetime()
+        # some SDKs return an object with .seconds
+        if hasattr(timestamp, "seconds"):
+            return datetime.fromtimestamp(timestamp.seconds, tz=timezone.utc)
+    except Exception:
+        pass
+    return None
+
+
+@lru_cache(maxsize=24 * 60)
+def _hhmm(hour: int, minute: int) -> str:
+    return f"[{hour:02d}:{minute:02d}]"
+
+
+def time_label(timestamp) -> str:
+    """ "[HH:MM]" for a message timestamp, or "[--:--]"."""
+    dt = to_datetime(timestamp)
+    if dt is None:
+        return NO_TIME
+    try:
+        return _hhmm(dt.hour, dt.minute)
+    except Exception:
+        return NO_TIME
+
+
+def format_prefix(data: dict) -> str:
+    return f"{time_label(data.get('timestamp'))} {data.get('username', '???')}: "
+
+
+class RenderBatch:
+    """Segments for one insert call plus where each message lands."""
+
+    def __init__(self):
+        # flat text, tags, text, tags, ... arguments for Text.insert
+        self.segments: List[object] = []
+        # (msg_id or None, first line offset, line count) in render order
+        self.entries: List[Tuple[Optional[str], int, int]] = []
+        self.lines = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.entries)
+
+
+def build_batch(
+    messages: Iterable[dict], me: Optional[str], skip_ids: Container = ()
+) -> RenderBatch:
+    """Build one insert for `messages`, skipping ids already rendered.
+
+    Ids in `skip_ids` and repeats within the batch are dropped. Every message
+    renders as "<time> <user>: " (tagged) + text + newline (untagged).
+    """
+    batch = RenderBatch()
+    seen = set()
+    for data in messages:
+        msg_id = data.get("_id") or data.get("id")
+        if msg_id and (msg_id in skip_ids or msg_id in seen):
+            continue
+        if msg_id:
+            seen.add(msg_id)
+        username = data.get("username", "???")
+        text = f"{data.get('text', '')}\n"
+        tag = USER_TAG if username == me else OTHER_TAG
+        batch.segments.extend((format_prefix(data), (tag,), text, ()))
+        line_count = text.count("\n")
+        batch.entries.append((msg_id, batch.lines, line_count))
+        batch.lines += line_count
+    return batch
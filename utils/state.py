@@ -0,0 +1,152 @@
+"""Single-writer store for the chat window's shared state.
+
+The active channel, the DM channels shown in the sidebar and the unread
+counts live in one immutable `ChatSnapshot`. Readers on any thread just
+take `store.snapshot` - swapping the reference is atomic, so they never
+lock and never see a half-applied update.
+
+Changes are pure functions `(snapshot, *args) -> snapshot` passed to
+`dispatch()`. Called on the writer thread (the Tk thread that created the
+store) they apply immediately; from any other thread they are handed to
+`post` (the GUI passes `lambda fn: self.after(0, fn)`) and applied there.
+Subscribers run on the writer thread after every change that alters the
+snapshot.
+"""
+import threading
+from typing import (
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+LOBBY = "lobby"
+
+
+class ChatSnapshot(NamedTuple):
+    current_channel: str = LOBBY
+    # DM channels (other usernames), sorted case-insensitively for the sidebar
+    dm_channels: Tuple[str, ...] = ()
+    # (channel, unread message count > 0), sorted by channel
+    unread_counts: Tuple[Tuple[str, int], ...] = ()
+
+    @property
+    def unread(self) -> FrozenSet[str]:
+        """Channels with unread messages."""
+        return frozenset(channel for channel, _ in self.unread_counts)
+
+
+def _sorted(channels: Iterable[str]) -> Tuple[str, ...]:
+    return tuple(sorted(set(channels), key=str.lower))
+
+
+def _counts(state: ChatSnapshot) -> Dict[str, int]:
+    return dict(state.unread_counts)
+
+
+def unread_count(state: ChatSnapshot, channel: str) -> int:
+    return _counts(state).get(channel, 0)
+
+
+def _with_counts(state: ChatSnapshot, counts: Dict[str, int]) -> ChatSnapshot:
+    counts = {c: n for c, n in counts.items() if n > 0}
+    return state._replace(unread_counts=tuple(sorted(counts.items())))
+
+
+def _without(state: ChatSnapshot, channel: str) -> Dict[str, int]:
+    counts = _counts(state)
+    counts.pop(channel, None)
+    return counts
+
+
+def select_channel(state: ChatSnapshot, channel: str) -> ChatSnapshot:
+    """Make `channel` active; it is read from now on."""
+    return _with_counts(
+        state._replace(current_channel=channel), _without(state, channel)
+    )
+
+
+def add_dms(state: ChatSnapshot, channels: Iterable[str]) -> ChatSnapshot:
+    channels = set(channels) - {LOBBY}
+    if channels <= set(state.dm_channels):
+        return state
+    return state._replace(dm_channels=_sorted(state.dm_channels + tuple(channels)))
+
+
+def remove_dm(state: ChatSnapshot, channel: str) -> ChatSnapshot:
+    return _with_counts(
+        state._replace(dm_channels=tuple(c for c in state.dm_channels if c != channel)),
+        _without(state, channel),
+    )
+
+
+def mark_unread(state: ChatSnapshot, channel: str, count: int = 1) -> ChatSnapshot:
+    """`count` new messages in `channel`, unless it is the one being viewed."""
+    if channel == state.current_channel or count <= 0:
+        return state
+    counts = _counts(state)
+    counts[channel] = counts.get(channel, 0) + count
+    return _with_counts(state, counts)
+
+
+def set_unread(state: ChatSnapshot, channel: str, count: int) -> ChatSnapshot:
+    """Replace the count of `channel` with a server-side one (0 = read)."""
+    if channel == state.current_channel or count == unread_count(state, channel):
+        return state
+    counts = _counts(state)
+    counts[channel] = count
+    return _with_counts(state, counts)
+
+
+def mark_read(state: ChatSnapshot, channel: str) -> ChatSnapshot:
+    return _with_counts(state, _without(state, channel))
+
+
+def reset(state: ChatSnapshot) -> ChatSnapshot:
+    """Forget DMs and unread markers (new login); keeps the active channel."""
+    return ChatSnapshot(current_channel=state.current_channel)
+
+
+class ChatStore:
+    """Holds the current `ChatSnapshot`; only the writer thread replaces it."""
+
+    def __init__(
+        self,
+        post: Optional[Callable[[Callable[[], None]], None]] = None,
+        initial: Optional[ChatSnapshot] = None,
+    ):
+        self._post = post
+        self._writer = threading.current_thread()
+        self._snapshot = initial or ChatSnapshot()
+        self._subscribers: List[Callable[[ChatSnapshot, ChatSnapshot], None]] = []
+
+    @property
+    def snapshot(self) -> ChatSnapshot:
+        return self._snapshot
+
+    def subscribe(
+        self, callback: Callable[[ChatSnapshot, ChatSnapshot], None]
+    ) -> Callable[[], None]:
+        """Call `callback(old, new)` after each change. Returns an unsubscribe."""
+        self._subscribers.append(callback)
+        return lambda: self._subscribers.remove(callback)
+
+    def dispatch(self, change: Callable[..., ChatSnapshot], *args):
+        """Apply `change(snapshot, *args)` on the writer thread."""
+        if self._post is None or threading.current_thread() is self._writer:
+            self._apply(change, args)
+        else:
+            self._post(lambda: self._apply(change, args))
+
+    def _apply(self, change, args):
+        old = self._snapshot
+        new = change(old, *args)
+        if new == old:
+            return
+        self._snapshot = new
+        for callback in list(self._subscribers):
+            callback(old, new)
@@ -0,0 +1,119 @@
+"""Managed background tasks with per-view generation tokens.
+
+Every `submit(view, fn)` gets a `CancelToken` carrying the view's current
+generation. Submitting again for the same view (e.g. the chat view after a
+channel switch) bumps the generation: queued tasks of the old generation are
+cancelled before they start, running ones can poll `token.cancelled`, and
+their results are dropped instead of being rendered into the wrong room.
+A bounded pool caps how many loads are in flight at once.
+
+Results are handed to the UI through `dispatch` (normally `app.after(0, ...)`)
+and the token is re-checked there, on the UI thread, right before use.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Set
+
+import config
+
+
+class CancelToken:
+    """Tells a task whether its view has moved on since it was submitted."""
+
+    def __init__(self, executor: "TaskExecutor", view: str, generation: int):
+        self._executor = executor
+        self.view = view
+        self.generation = generation
+
+    @property
+    def cancelled(self) -> bool:
+        return self._executor.generation(self.view) != self.generation
+
+
+class TaskExecutor:
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        dispatch: Optional[Callable[[Callable[[], None]], None]] = None,
+    ):
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers or config.TASK_MAX_WORKERS,
+            thread_name_prefix="task",
+        )
+        self._dispatch = dispatch or (lambda fn: fn())
+        self._lock = threading.Lock()
+        self._generations: Dict[str, int] = {}
+        self._futures: Dict[str, Set] = {}
+
+    def generation(self, view: str) -> int:
+        with self._lock:
+            return self._generations.get(view, 0)
+
+    def cancel(self, view: str):
+        """Invalidate every task of `view`; queued ones never start."""
+        with self._lock:
+            self._generations[view] = self._generations.get(view, 0) + 1
+            futures = self._futures.pop(view, set())
+        for future in futures:
+            future.cancel()
+
+    def cancel_all(self):
+        with self._lock:
+            views = list(self._generations) + list(self._futures)
+        for view in set(views):
+            self.cancel(view)
+
+    def submit(
+        self,
+        view: str,
+        fn: Callable[[CancelToken], object],
+        on_done: Optional[Callable[[object], None]] = None,
+        supersede: bool = True,
+    ) -> CancelToken:
+        """Run `fn(token)` in the pool; `on_done(result)` goes through dispatch.
+
+        With `supersede` (the default) earlier tasks of `view` are cancelled
+        first; otherwise the task joins the current generation.
+        """
+        if supersede:
+            self.cancel(view)
+        token = CancelToken(self, view, self.generation(view))
+        future = self._pool.submit(self._run, token, fn, on_done)
+        with self._lock:
+            if token.generation == self._generations.get(view, 0):
+                self._futures.setdefault(view, set()).add(future)
+        future.add_done_callback(lambda f: self._forget(view, f))
+        return token
+
+    def _forget(self, view: str, future):
+        with self._lock:
+            futures = self._futures.get(view)
+            if futures is not None:
+                futures.discard(future)
+
+    def _run(self, token: CancelToken, fn, on_done):
+        if token.cancelled:
+            return None
+        try:
+            result = fn(token)
+        except Exception as e:
+            print(f"[WARN] Background task for {token.view} failed: {e}")
+            return None
+        if on_done is not None:
+            self.deliver(token, lambda: on_done(result))
+        return result
+
+    def deliver(self, token: CancelToken, fn: Callable[[], None]):
+        """Run `fn` via dispatch unless the token is cancelled by then."""
+        if token.cancelled:
+            return
+
+        def guarded():
+            if not token.cancelled:
+                fn()
+
+        self._dispatch(guarded)
+
+    def shutdown(self):
+        self.cancel_all()
+        self._pool.shutdown(wait=False, cancel_futures=True)